@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the plugin import cost.
+
+certbot imports the plugin module on every run enumerating the plugins, even
+when the plugin is not selected. Measures `import certbot_external_auth.plugin`
+in fresh interpreters, on top of the modules certbot loads itself before the
+plugin discovery (`--base`), and lists the modules the plugin import adds:
+
+    python benchmarks/import_time.py --runs 20
+    python benchmarks/import_time.py --json results.json
+    python benchmarks/import_time.py --baseline results.json --threshold 0.2
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULE = 'certbot_external_auth.plugin'
+BASE = 'certbot.plugins.disco,certbot.interfaces'
+
+CASE = """
+import sys, time
+sys.path.insert(0, {root!r})
+for name in {base!r}:
+    __import__(name)
+before = set(sys.modules)
+start = time.time()
+__import__({module!r})
+duration = time.time() - start
+import json
+print(json.dumps({{'time': duration, 'modules': sorted(set(sys.modules) - before)}}))
+"""
+
+
+def run_once(module, base):
+    """
+    Imports the module in a fresh interpreter
+    :param module:
+    :param base: modules imported before the measurement
+    :return: dict with time (seconds) and modules added by the import
+    """
+    code = CASE.format(root=ROOT, base=base, module=module)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output.decode('UTF-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+def measure(module, base, runs):
+    """
+    Measures the import time over runs, the first run warms the bytecode cache and is dropped
+    :param module:
+    :param base:
+    :param runs:
+    :return: result dict
+    """
+    run_once(module, base)
+    samples = [run_once(module, base) for _ in range(runs)]
+    times = [x['time'] for x in samples]
+
+    res = OrderedDict()
+    res['module'] = module
+    res['base'] = base
+    res['runs'] = runs
+    res['median'] = round(median(times), 6)
+    res['min'] = round(min(times), 6)
+    res['max'] = round(max(times), 6)
+    res['modules'] = samples[-1]['modules']
+    return res
+
+
+def compare(res, baseline_file, threshold):
+    """
+    Compares the median import time with the baseline result
+    :param res:
+    :param baseline_file:
+    :param threshold: allowed relative slowdown
+    :return: regression message or None
+    """
+    with open(baseline_file) as fh:
+        base = json.load(fh)
+    if res['median'] > base['median'] * (1 + threshold):
+        return '%s: %.2f ms, baseline %.2f ms' % (res['module'], res['median'] * 1000, base['median'] * 1000)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the plugin import time')
+    parser.add_argument('--module', default=MODULE,
+                        help='module to import, default: %(default)s')
+    parser.add_argument('--base', default=BASE,
+                        help='comma separated modules imported before the measurement, default: %(default)s')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='number of fresh interpreters, default: %(default)s')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='writes the result to the JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON result to compare the import time with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed import time increase against the baseline, default: %(default)s')
+    args = parser.parse_args()
+
+    base = [x.strip() for x in args.base.split(',') if x.strip()]
+    res = measure(args.module, base, max(1, args.runs))
+
+    print('%s: median %.2f ms, min %.2f ms, max %.2f ms over %d runs'
+          % (res['module'], res['median'] * 1000, res['min'] * 1000, res['max'] * 1000, res['runs']))
+    print('%d modules added by the import:' % len(res['modules']))
+    for name in res['modules']:
+        print('  %s' % name)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as fh:
+            json.dump(res, fh, indent=2)
+
+    if args.baseline:
+        regression = compare(res, args.baseline, args.threshold)
+        if regression:
+            print('Regression: %s' % regression, file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the plugin perform / cleanup pipeline.
+
+Drives AuthenticatorOut with N synthetic dns-01 challenges in each plugin mode.
+Handler modes use a stub shell handler sleeping for the configured latency,
+JSON and text modes answer the prompts after the same latency.
+Self-verification is stubbed out, no network is touched.
+
+Per-challenge latency (p50 / p99) is the duration of the handler invocation or
+the prompt deploying the challenge, collected from the plugin profiler so the
+batch, async-core, bulk-json and grouped paths are covered too. A batch
+invocation counts for each of its records, one bulk-json acknowledgement once.
+
+Each case runs in its own process so the peak RSS is per case:
+
+    python benchmarks/pipeline.py --sizes 1,10,100 --modes handler,json --latency 0.01
+    python benchmarks/pipeline.py --json results.json
+    python benchmarks/pipeline.py --baseline results.json --threshold 0.2
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+
+# Benchmark the working tree, not an installed version
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ['json', 'handler', 'dehydrated', 'text']
+SIZES = [1, 10, 100, 1000]
+
+HANDLER = """#!/bin/sh
+if [ "$1" = "perform" ] || [ "$1" = "cleanup" ] || [ "$1" = "deploy_challenge" ] || [ "$1" = "clean_challenge" ]; then
+    sleep {latency}
+fi
+if [ "$1" = "perform-batch" ] || [ "$1" = "cleanup-batch" ]; then
+    sleep {latency}
+    exec "{python}" -c "import json, sys; sys.stdout.write(''.join(json.dumps({{'token': x['token'], 'status': 'ok'}}) + '\\n' for x in json.load(sys.stdin)))"
+fi
+exit 0
+"""
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile
+    :param values:
+    :param pct:
+    :return:
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    idx = max(0, min(len(values) - 1, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+    return values[idx]
+
+
+def get_config(workdir, mode, handler, options):
+    """
+    Builds the plugin configuration with option defaults
+    :param workdir:
+    :param mode:
+    :param handler:
+    :param options: dict of plugin options overriding defaults
+    :return:
+    """
+    from certbot import configuration
+    from certbot import constants
+    from certbot_external_auth.plugin import AuthenticatorOut
+
+    namespace = argparse.Namespace(**constants.CLI_DEFAULTS)
+    prefix = 'certbot_external_auth_'
+    for name, value in AuthenticatorOut.get_option_defaults().items():
+        setattr(namespace, prefix + name.replace('-', '_'), value)
+
+    namespace.config_dir = os.path.join(workdir, 'config')
+    namespace.work_dir = os.path.join(workdir, 'work')
+    namespace.logs_dir = os.path.join(workdir, 'logs')
+    namespace.noninteractive_mode = False
+    namespace.quiet = True
+
+    opts = dict(options)
+    opts['public-ip-logging-ok'] = True
+    opts['text-mode'] = mode == 'text'
+    if mode in ('handler', 'dehydrated'):
+        opts['handler'] = handler
+        opts['dehydrated-dns'] = mode == 'dehydrated'
+    for name, value in opts.items():
+        setattr(namespace, prefix + name.replace('-', '_'), value)
+    return configuration.NamespaceConfig(namespace)
+
+
+def get_achalls(count):
+    """
+    Generates dns-01 annotated challenges for count distinct domains
+    :param count:
+    :return:
+    """
+    import josepy
+    from acme import challenges
+    from acme import messages
+    from certbot import achallenges
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = josepy.JWKRSA(key=rsa.generate_private_key(65537, 2048, default_backend()))
+    achalls = []
+    for idx in range(count):
+        chall = challenges.DNS01(token=b'%032d' % idx)
+        challb = messages.ChallengeBody(chall=chall, uri='https://ca.example.com/chall/%d' % idx,
+                                        status=messages.STATUS_PENDING)
+        achalls.append(achallenges.KeyAuthorizationAnnotatedChallenge(
+            challb=challb, domain='d%d.bench.example.org' % idx, account_key=key))
+    return achalls
+
+
+def run_case(mode, size, latency, options):
+    """
+    Runs one benchmark case in this process
+    :param mode:
+    :param size:
+    :param latency: seconds the handler / user takes to deploy one challenge
+    :param options: plugin options
+    :return: result dict
+    """
+    import mock
+    import six
+    from certbot_external_auth import profiler
+    from certbot_external_auth.plugin import AuthenticatorOut
+
+    workdir = tempfile.mkdtemp(prefix='cbot-bench-')
+    handler = os.path.join(workdir, 'handler.sh')
+    with open(handler, 'w') as fh:
+        fh.write(HANDLER.format(latency=latency, python=sys.executable))
+    os.chmod(handler, os.stat(handler).st_mode | stat.S_IEXEC)
+
+    def prompt(*args):  # pylint: disable=unused-argument
+        if latency:
+            time.sleep(latency)
+        return ''
+
+    auth = AuthenticatorOut(get_config(workdir, mode, handler, options), 'certbot-external-auth')
+    achalls = get_achalls(size)
+
+    # Per-challenge latency - invocations deploying challenges in the perform stage,
+    # pre / post hooks run without the domain and are not counted
+    latencies = []
+    collecting = [True]
+    orig_record = auth.profiler.record
+    orig_batch = AuthenticatorOut._call_handler_batch
+
+    def timed_record(stage, duration, domain=None):
+        if collecting[0] and (stage == profiler.STAGE_INPUT_WAIT or (
+                stage in (profiler.STAGE_HANDLER_RUN, profiler.STAGE_HANDLER_DAEMON) and domain is not None)):
+            latencies.append(duration)
+        return orig_record(stage, duration, domain)
+
+    def timed_batch(self, command, records):
+        start = time.time()
+        res = orig_batch(self, command, records)
+        if collecting[0] and res is not NotImplemented:
+            latencies.extend([time.time() - start] * len(records))
+        return res
+
+    devnull = open(os.devnull, 'w')
+    try:
+        with mock.patch('acme.challenges.DNS01Response.simple_verify', return_value=True), \
+                mock.patch.object(auth.profiler, 'record', timed_record), \
+                mock.patch.object(AuthenticatorOut, '_call_handler_batch', timed_batch), \
+                mock.patch.object(six.moves, 'input', prompt), \
+                mock.patch('sys.stdout', devnull):
+            start = time.time()
+            auth.perform(achalls)
+            perform_time = time.time() - start
+            collecting[0] = False
+
+            start = time.time()
+            auth.cleanup(achalls)
+            cleanup_time = time.time() - start
+    finally:
+        devnull.close()
+        shutil.rmtree(workdir)
+
+    res = OrderedDict()
+    res['mode'] = mode
+    res['size'] = size
+    res['latency'] = latency
+    res['perform'] = round(perform_time, 6)
+    res['cleanup'] = round(cleanup_time, 6)
+    res['throughput'] = round(size / perform_time, 3) if perform_time else None
+    res['p50'] = round(percentile(latencies, 50), 6) if latencies else None
+    res['p99'] = round(percentile(latencies, 99), 6) if latencies else None
+    res['rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    res['children_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return res
+
+
+def spawn_case(mode, size, args):
+    """
+    Runs the case in a fresh interpreter
+    :param mode:
+    :param size:
+    :param args:
+    :return: result dict
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--case', '%s:%s' % (mode, size),
+           '--latency', str(args.latency)]
+    for opt in args.option or []:
+        cmd += ['--option', opt]
+    output = subprocess.check_output(cmd)
+    return json.loads(output.decode('UTF-8').strip().splitlines()[-1])
+
+
+def parse_options(specs):
+    """
+    Parses name=value plugin options, values are JSON or plain strings
+    :param specs:
+    :return:
+    """
+    options = {}
+    for spec in specs or []:
+        name, _, value = spec.partition('=')
+        try:
+            options[name] = json.loads(value)
+        except ValueError:
+            options[name] = value
+    return options
+
+
+ROW = '%-11s %6s %10s %10s %12s %10s %10s %10s'
+
+
+def print_header():
+    print(ROW % ('mode', 'size', 'perform s', 'cleanup s', 'chall/s', 'p50 ms', 'p99 ms', 'rss MB'))
+
+
+def print_row(res):
+    """
+    Prints human readable result of one case
+    :param res:
+    :return:
+    """
+    print(ROW % (res['mode'], res['size'], '%.3f' % res['perform'], '%.3f' % res['cleanup'],
+                 '%.1f' % res['throughput'] if res['throughput'] else '-',
+                 '%.2f' % (res['p50'] * 1000) if res['p50'] is not None else '-',
+                 '%.2f' % (res['p99'] * 1000) if res['p99'] is not None else '-',
+                 '%.1f' % (res['rss_kb'] / 1024.0)))
+    sys.stdout.flush()
+
+
+def compare(results, baseline_file, threshold):
+    """
+    Compares throughput with the baseline results
+    :param results:
+    :param baseline_file:
+    :param threshold: allowed relative slowdown
+    :return: list of regressions
+    """
+    with open(baseline_file) as fh:
+        baseline = dict(((x['mode'], x['size']), x) for x in json.load(fh))
+
+    regressions = []
+    for res in results:
+        base = baseline.get((res['mode'], res['size']))
+        if base is None or not base['throughput'] or not res['throughput']:
+            continue
+        if res['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append('%s/%s: %.1f chall/s, baseline %.1f chall/s'
+                               % (res['mode'], res['size'], res['throughput'], base['throughput']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the plugin perform / cleanup pipeline')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='comma separated plugin modes, default: %(default)s')
+    parser.add_argument('--sizes', default=','.join(str(x) for x in SIZES),
+                        help='comma separated challenge counts, default: %(default)s')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the handler / user takes per challenge, default: %(default)s')
+    parser.add_argument('--option', action='append',
+                        help='plugin option as name=value, e.g., max-parallel=8, repeatable')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='writes results to the JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results to compare the throughput with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed throughput drop against the baseline, default: %(default)s')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        mode, _, size = args.case.partition(':')
+        print(json.dumps(run_case(mode, int(size), args.latency, parse_options(args.option))))
+        return 0
+
+    print_header()
+    results = []
+    for mode in args.modes.split(','):
+        for size in (int(x) for x in args.sizes.split(',')):
+            results.append(spawn_case(mode.strip(), size, args))
+            print_row(results[-1])
+
+    if args.json_file:
+        with open(args.json_file, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        for regression in regressions:
+            print('Regression: %s' % regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
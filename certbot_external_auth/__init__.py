@@ -7,6 +7,7 @@ COMMAND_REPORT = 'report'
 COMMAND_DEPLOY_CERT = 'deploy_cert'
 COMMAND_SAVE = 'save'
 COMMAND_RESTART = 'restart'
+COMMAND_PROFILE = 'profile'
 
 # JSON FIELDS
 FIELD_CMD = 'cmd'
@@ -30,6 +31,10 @@ FIELD_KEY_PEM = 'key_pem'
 FIELD_PORT = 'port'
 FIELD_TIMESTAMP = 'port'
 FIELD_CERT_TIMESTAMP = 'cert_timestamp'
+FIELD_DOMAINS = 'domains'
+FIELD_TOKENS = 'tokens'
+FIELD_VALIDATIONS = 'validations'
+FIELD_ZONE = 'zone'
 
 
 
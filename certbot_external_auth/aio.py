@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""asyncio execution core for handler invocations. Python 3.5+ only, imported on demand."""
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+import threading
+
+from certbot_external_auth.profiler import monotonic, STAGE_HANDLER_SPAWN, STAGE_HANDLER_RUN
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCore(object):
+    """
+    Owns a private event loop the synchronous plugin methods run coroutines on.
+    Worker threads take turns running the loop.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._lock = threading.Lock()
+        if sys.version_info < (3, 8):
+            # Older child watchers have to be attached to the loop spawning the processes
+            asyncio.get_child_watcher().attach_loop(self.loop)
+
+    def run(self, coro):
+        """
+        Runs the coroutine to completion
+        :param coro:
+        :return: coroutine result
+        """
+        with self._lock:
+            return self.loop.run_until_complete(coro)
+
+    def map(self, func, items, limit=None):
+        """
+        Runs coroutine func on all items, at most limit of them in flight.
+        :param func: coroutine function
+        :param items:
+        :param limit:
+        :return: results in the items order, exceptions are returned in place of results
+        """
+        return self.run(gather_limited(func, items, limit))
+
+    def close(self):
+        """
+        Closes the event loop
+        :return:
+        """
+        if not self.loop.is_closed():
+            self.loop.close()
+
+
+async def gather_limited(func, items, limit=None):
+    """
+    Gathers func(item) coroutines with bounded concurrency
+    :param func:
+    :param items:
+    :param limit:
+    :return: results in the items order, exceptions are returned in place of results
+    """
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def limited(item):
+        if semaphore is None:
+            return await func(item)
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*[limited(item) for item in items], return_exceptions=True)
+
+
+async def run_process(arg_list, env=None, stdin_data=None, timeout=None, kill_grace=5, captures=None,
+                      profiler=None, domain=None):
+    """
+    Runs the process in its own process group, feeds the stdin and collects its outputs.
+    The process group is terminated after the timeout, killed if still running after kill_grace.
+    :param arg_list:
+    :param env:
+    :param stdin_data: bytes
+    :param timeout: seconds, None for no limit
+    :param kill_grace: seconds between SIGTERM and SIGKILL
+    :param captures: (stdout, stderr) OutputCapture streaming the outputs, whole outputs are buffered if None
+    :param profiler: records handler spawn & run times if given
+    :param domain: domain for the profiler
+    :return: (returncode, stdout, stderr), returncode is None if the process timed out
+    """
+    start = monotonic()
+    proc = await asyncio.create_subprocess_exec(*arg_list,
+                                                stdin=asyncio.subprocess.PIPE if stdin_data is not None else None,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE,
+                                                env=env,
+                                                start_new_session=True)
+    spawned = monotonic()
+    try:
+        if captures is None:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(stdin_data), timeout)
+        else:
+            stdout, stderr = await asyncio.wait_for(communicate_streaming(proc, stdin_data, captures), timeout)
+        returncode = proc.returncode
+    except asyncio.TimeoutError:
+        logger.warning("Handler PID %s timed out, terminating its process group", proc.pid)
+        await kill_process_group(proc, kill_grace)
+        stdout, stderr, returncode = b'', b'', None
+
+    if profiler is not None:
+        profiler.record(STAGE_HANDLER_SPAWN, spawned - start, domain)
+        profiler.record(STAGE_HANDLER_RUN, monotonic() - spawned, domain)
+    return returncode, stdout, stderr
+
+
+async def communicate_streaming(proc, stdin_data, captures):
+    """
+    Feeds the stdin and reads outputs incrementally into the captures
+    :param proc:
+    :param stdin_data: bytes
+    :param captures: (stdout, stderr) OutputCapture
+    :return: (stdout, stderr) kept by the captures
+    """
+    async def pump(stream, capture):
+        try:
+            while True:
+                data = await stream.read(capture.CHUNK_SIZE)
+                if not data:
+                    break
+                capture.feed(data)
+        finally:
+            capture.close()
+
+    async def feed():
+        if proc.stdin is None:
+            return
+        try:
+            proc.stdin.write(stdin_data)
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        proc.stdin.close()
+
+    await asyncio.gather(feed(), pump(proc.stdout, captures[0]), pump(proc.stderr, captures[1]))
+    await proc.wait()
+    return captures[0].getvalue(), captures[1].getvalue()
+
+
+async def kill_process_group(proc, grace=5):
+    """
+    Terminates the process group, kills it if not terminated in the grace period
+    :param proc:
+    :param grace: seconds
+    :return:
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            pass
+        try:
+            await asyncio.wait_for(proc.wait(), grace)
+            return
+        except asyncio.TimeoutError:
+            logger.warning("Handler PID %s did not terminate, killing its process group", proc.pid)
+
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""On-disk cache of handler results for idempotent stages."""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache(object):
+    """
+    Handler results keyed by (stage, domain, validation), valid for ttl seconds.
+    Loaded once, stored atomically by save(). Expired entries are evicted on load and save,
+    the oldest ones when there are more than max_entries.
+    """
+
+    MAX_ENTRIES = 1024
+
+    def __init__(self, path, ttl, max_entries=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dirty = False
+        self._load()
+
+    @staticmethod
+    def _key(stage, domain, validation):
+        data = u'\0'.join(u'%s' % x for x in (stage, domain, validation))
+        return hashlib.sha256(data.encode('UTF-8')).hexdigest()
+
+    def get(self, stage, domain, validation):
+        """
+        Returns the cached result or None if missing or expired
+        :param stage:
+        :param domain:
+        :param validation:
+        :return:
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(stage, domain, validation))
+            if entry is None or entry['time'] + self.ttl < time.time():
+                return None
+            return entry['result']
+
+    def put(self, stage, domain, validation, result=''):
+        """
+        Stores the handler result
+        :param stage:
+        :param domain:
+        :param validation:
+        :param result: handler stdout
+        :return:
+        """
+        if isinstance(result, bytes):
+            result = result.decode('UTF-8', 'replace')
+        with self._lock:
+            self._entries[self._key(stage, domain, validation)] = {'time': time.time(), 'result': result}
+            self._dirty = True
+
+    def invalidate(self, stage, domain, validation):
+        """
+        Removes the entry
+        :param stage:
+        :param domain:
+        :param validation:
+        :return:
+        """
+        with self._lock:
+            if self._entries.pop(self._key(stage, domain, validation), None) is not None:
+                self._dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def save(self):
+        """
+        Writes the cache to the file if changed, atomically
+        :return:
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._evict()
+            data = json.dumps(self._entries)
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory, 0o700)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.cache-')
+                with os.fdopen(fd, 'w') as fh:
+                    fh.write(data)
+                os.rename(tmp_path, self.path)
+                self._dirty = False
+            except (IOError, OSError) as e:
+                logger.warning("Could not store the handler cache %s: %s" % (self.path, e))
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as fh:
+                entries = json.load(fh)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("Could not load the handler cache %s, starting empty: %s" % (self.path, e))
+            return
+
+        if isinstance(entries, dict):
+            self._entries = dict((k, v) for k, v in entries.items()
+                                 if isinstance(v, dict) and 'time' in v and 'result' in v)
+        self._dirty = self._evict()
+
+    def _evict(self):
+        """
+        Drops expired entries and the oldest ones over the limit
+        :return: True if anything was dropped
+        """
+        size = len(self._entries)
+        deadline = time.time() - self.ttl
+        self._entries = dict((k, v) for k, v in self._entries.items() if v['time'] >= deadline)
+
+        if len(self._entries) > self.max_entries:
+            newest = sorted(self._entries.items(), key=lambda x: x[1]['time'], reverse=True)[:self.max_entries]
+            self._entries = dict(newest)
+        return len(self._entries) != size
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Bounded capture of handler output streams."""
+
+import collections
+import os
+
+
+class OutputCapture(object):
+    """
+    Keeps the last `limit` bytes of the stream. Complete lines are forwarded
+    to the callback as they arrive, lines longer than MAX_LINE are forwarded in parts.
+    """
+
+    MAX_LINE = 8192
+    CHUNK_SIZE = 8192
+
+    def __init__(self, limit, callback=None):
+        """
+        :param limit: maximal number of bytes kept
+        :param callback: called with each line (bytes, without the line end)
+        """
+        self.limit = limit
+        self.callback = callback
+        self.total = 0
+        self._chunks = collections.deque()
+        self._size = 0
+        self._line = b''
+
+    def feed(self, data):
+        """
+        Processes next chunk of the stream
+        :param data: bytes
+        :return:
+        """
+        if not data:
+            return
+        self.total += len(data)
+        self._keep(data)
+
+        if self.callback is None:
+            return
+        lines = (self._line + data).split(b'\n')
+        self._line = lines.pop()
+        while len(self._line) > self.MAX_LINE:
+            lines.append(self._line[:self.MAX_LINE])
+            self._line = self._line[self.MAX_LINE:]
+        for line in lines:
+            self.callback(line.rstrip(b'\r'))
+
+    def close(self):
+        """
+        Forwards the last incomplete line
+        :return:
+        """
+        if self._line and self.callback is not None:
+            self.callback(self._line)
+        self._line = b''
+
+    @property
+    def truncated(self):
+        return self.total > self._size
+
+    def getvalue(self):
+        """
+        Returns the kept output, prefixed with the truncation note if truncated
+        :return: bytes
+        """
+        data = b''.join(self._chunks)
+        if self.truncated:
+            data = ('[... %d bytes truncated]\n' % (self.total - self._size)).encode('ascii') + data
+        return data
+
+    def _keep(self, data):
+        if len(data) >= self.limit:
+            self._chunks.clear()
+            self._chunks.append(data[len(data) - self.limit:])
+            self._size = self.limit
+            return
+
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size > self.limit:
+            first = self._chunks.popleft()
+            excess = self._size - self.limit
+            if len(first) > excess:
+                self._chunks.appendleft(first[excess:])
+                self._size -= excess
+            else:
+                self._size -= len(first)
+
+
+def pump(stream, capture):
+    """
+    Reads the stream to its end into the capture, blocking
+    :param stream: file object of the pipe
+    :param capture: OutputCapture
+    :return:
+    """
+    try:
+        fd = stream.fileno()
+        while True:
+            data = os.read(fd, capture.CHUNK_SIZE)
+            if not data:
+                break
+            capture.feed(data)
+    finally:
+        capture.close()
+        stream.close()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Durable queue of deferred cleanup records, one JSON entry per line."""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+
+from collections import OrderedDict
+
+from certbot_external_auth import jsonutil
+
+logger = logging.getLogger(__name__)
+
+
+class CleanupQueue(object):
+    """
+    Append-only JSON-lines file of cleanup entries, shared by concurrent certbot runs.
+    put() appends and fsyncs under an exclusive lock of the `.lock` file.
+    take() moves the queue aside to the `.draining` file under the same lock, entries
+    left there by an interrupted drain are taken first. done() puts back the leftovers
+    and removes the `.draining` file.
+    The drain holds the `.drain.lock` file from take() to done(), a concurrent drain gets
+    no entries. The kernel releases the lock of a crashed drain.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.draining_path = path + '.draining'
+        self.lock_path = path + '.lock'
+        self.drain_lock_path = path + '.drain.lock'
+        self._drain_lock = None
+
+    def put(self, entries):
+        """
+        Appends the entries durably
+        :param entries: list of JSON serializable dicts
+        :return:
+        """
+        if not entries:
+            return
+        data = ''.join(jsonutil.dumps(x) + '\n' for x in entries).encode('UTF-8')
+        with self._locked():
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def take(self):
+        """
+        Takes all queued entries for draining, finish the drain with done()
+        :return: list of entries, empty if another drain is in progress
+        """
+        if self._drain_lock is None:
+            drain_lock = FileLock(self.drain_lock_path)
+            if not drain_lock.acquire(blocking=False):
+                logger.info("Cleanup queue %s is being drained by another process" % self.path)
+                return []
+            self._drain_lock = drain_lock
+
+        with self._locked():
+            if not os.path.exists(self.draining_path) and os.path.exists(self.path):
+                os.rename(self.path, self.draining_path)
+        if not os.path.exists(self.draining_path):
+            self._release_drain()
+            return []
+
+        entries = []
+        with open(self.draining_path) as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line, object_pairs_hook=OrderedDict))
+                except ValueError:
+                    # Torn write of a crashed run, the rest of the queue is still valid
+                    logger.warning("Skipping corrupted cleanup queue entry in %s: %s" % (self.draining_path, line))
+        return entries
+
+    def done(self, leftovers=None):
+        """
+        Finishes the drain, entries not processed are queued again
+        :param leftovers: list of entries
+        :return:
+        """
+        self.put(leftovers)
+        if self._drain_lock is None:
+            return
+        try:
+            if os.path.exists(self.draining_path):
+                os.remove(self.draining_path)
+        finally:
+            self._release_drain()
+
+    def __len__(self):
+        count = 0
+        for path in (self.path, self.draining_path):
+            if os.path.exists(path):
+                with open(path) as fh:
+                    count += sum(1 for line in fh if line.strip())
+        return count
+
+    def _locked(self):
+        return FileLock(self.lock_path)
+
+    def _release_drain(self):
+        if self._drain_lock is not None:
+            self._drain_lock.release()
+            self._drain_lock = None
+
+
+class FileLock(object):
+    """Exclusive flock of the file, created if missing"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        """
+        Locks the file
+        :param blocking: False to fail when locked by someone else
+        :return: True if locked
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(self._fd)
+            self._fd = None
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+
+    def release(self):
+        """
+        Unlocks the file
+        :return:
+        """
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
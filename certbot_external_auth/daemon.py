@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Persistent handler co-process speaking line-delimited JSON."""
+
+import itertools
+import json
+import logging
+import subprocess
+import threading
+
+import six
+from six.moves import queue  # pylint: disable=import-error
+
+logger = logging.getLogger(__name__)
+
+
+# Daemon protocol fields & statuses
+FIELD_ID = 'id'
+FIELD_CMD = 'cmd'
+FIELD_ARGS = 'args'
+FIELD_ENV = 'env'
+FIELD_STDIN = 'stdin'
+FIELD_STATUS = 'status'
+FIELD_STDOUT = 'stdout'
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_NOT_IMPLEMENTED = 'not_implemented'
+
+COMMAND_DAEMON = 'daemon'
+
+
+class HandlerDaemonError(Exception):
+    """
+    Handler daemon crashed or did not respond in time
+    """
+    pass
+
+
+class HandlerDaemon(object):
+    """
+    Handler started once for the whole run with the `daemon` command.
+
+    Each request is one JSON line written to the handler stdin:
+        {"id": 1, "cmd": "perform", "args": [], "env": {...}, "stdin": null}
+
+    The handler answers with one JSON line per request on its stdout, in any order:
+        {"id": 1, "status": "ok", "stdout": "..."}
+
+    Status is one of ok, error, not_implemented.
+    Lines not being JSON objects with a known id are logged and skipped.
+    """
+
+    def __init__(self, handler, env=None, timeout=None):
+        self.handler = handler
+        self.env = env
+        self.timeout = timeout
+
+        self._proc = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._waiting = {}
+        self._readers = []
+        self._eof = False
+
+    def start(self):
+        """
+        Starts the handler co-process
+        :return:
+        """
+        self._proc = subprocess.Popen([self.handler, COMMAND_DAEMON],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      env=self.env)
+
+        self._readers = [threading.Thread(target=self._read_stdout, args=(self._proc.stdout,)),
+                         threading.Thread(target=self._read_stderr, args=(self._proc.stderr,))]
+        for reader in self._readers:
+            reader.daemon = True
+            reader.start()
+        logger.debug("Handler daemon running as PID %s", self._proc.pid)
+
+    def is_alive(self):
+        """
+        Returns true if the co-process is running
+        :return:
+        """
+        return self._proc is not None and not self._eof and self._proc.poll() is None
+
+    def request(self, command, args=None, env=None, stdin=None, timeout=None):
+        """
+        Sends one request to the daemon and waits for its response.
+        Safe to call from multiple threads, requests are multiplexed by id.
+
+        :param command: handler stage
+        :param args: positional arguments
+        :param env: variables the classic handler would receive in ENV
+        :param stdin: data the classic handler would receive on stdin
+        :param timeout: seconds to wait for the response, None for the daemon default
+        :return: response dict
+        """
+        if not self.is_alive():
+            raise HandlerDaemonError("Handler daemon is not running")
+
+        timeout = self.timeout if timeout is None else timeout
+        response_queue = queue.Queue()
+        with self._lock:
+            # The reader may have hit EOF since is_alive(), it would not wake this request up
+            if self._eof:
+                raise HandlerDaemonError("Handler daemon terminated with code %s" % self._proc.poll())
+            req_id = next(self._ids)
+            self._waiting[req_id] = response_queue
+
+        line = json.dumps({FIELD_ID: req_id, FIELD_CMD: command, FIELD_ARGS: list(args or []),
+                           FIELD_ENV: env or {}, FIELD_STDIN: stdin}) + '\n'
+        try:
+            with self._write_lock:
+                self._proc.stdin.write(line.encode('UTF-8'))
+                self._proc.stdin.flush()
+        except (IOError, OSError) as e:
+            with self._lock:
+                self._waiting.pop(req_id, None)
+            raise HandlerDaemonError("Could not send request to the handler daemon: %s" % e)
+
+        try:
+            response = response_queue.get(timeout=timeout)
+        except queue.Empty:
+            raise HandlerDaemonError("Handler daemon did not respond to %s in %s s" % (command, timeout))
+        finally:
+            with self._lock:
+                self._waiting.pop(req_id, None)
+
+        if response is None:
+            raise HandlerDaemonError("Handler daemon terminated with code %s" % self._proc.poll())
+        return response
+
+    def close(self, timeout=5):
+        """
+        Closes the daemon stdin so it can terminate, kills it if it does not in time
+        :param timeout:
+        :return:
+        """
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+        except (IOError, OSError):
+            pass
+
+        for reader in self._readers:
+            reader.join(timeout)
+
+        if self._proc.poll() is None:
+            logger.warning("Handler daemon did not terminate, killing PID %s", self._proc.pid)
+            self._proc.kill()
+        self._proc.wait()
+        logger.debug("Handler daemon terminated with code %s", self._proc.returncode)
+
+    def _read_stdout(self, stream):
+        for line in iter(stream.readline, b''):
+            line = line.decode('UTF-8', 'replace').strip()
+            response = None
+            if line.startswith('{'):
+                try:
+                    response = json.loads(line)
+                except ValueError:
+                    pass
+
+            with self._lock:
+                waiting = self._waiting.get(response.get(FIELD_ID)) if isinstance(response, dict) else None
+            if waiting is None:
+                logger.debug("Handler daemon: %s", line)
+            else:
+                waiting.put(response)
+
+        # EOF - the process is gone, wake everybody up
+        with self._lock:
+            self._eof = True
+            for waiting in six.itervalues(self._waiting):
+                waiting.put(None)
+
+    def _read_stderr(self, stream):
+        for line in iter(stream.readline, b''):
+            logger.info("Handler daemon stderr: %s", line.decode('UTF-8', 'replace').rstrip())
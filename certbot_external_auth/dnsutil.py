@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""DNS helpers - zones of the challenge names, cached lookups, waiting for the TXT record propagation."""
+
+import logging
+import threading
+import time
+
+from six.moves import queue  # pylint: disable=import-error
+
+try:
+    import dns.exception
+    import dns.rdatatype
+    import dns.resolver
+except ImportError:  # pragma: no cover
+    dns = None
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # pragma: no cover
+    monotonic = time.time
+
+logger = logging.getLogger(__name__)
+
+
+def is_available():
+    """
+    Returns true if the optional dnspython dependency is installed
+    :return:
+    """
+    return dns is not None
+
+
+def parse_nameserver(spec, default_port=53):
+    """
+    Parses nameserver specification: 8.8.8.8, 127.0.0.1:5353, ::1, [::1]:5353
+    :param spec:
+    :param default_port:
+    :return: (address, port)
+    """
+    spec = spec.strip()
+    if spec.startswith('['):
+        host, _, port = spec[1:].partition(']')
+        return host, int(port.lstrip(':') or default_port)
+    if spec.count(':') == 1:
+        host, port = spec.split(':')
+        return host, int(port)
+    return spec, default_port
+
+
+def txt_values(answer):
+    """
+    Returns TXT record strings from the resolver answer
+    :param answer:
+    :return: set of strings
+    """
+    values = set()
+    for rdata in answer:
+        value = b''.join(rdata.strings)
+        values.add(value.decode('UTF-8', 'replace') if isinstance(value, bytes) else value)
+    return values
+
+
+def query(resolver, name, rdtype, raise_on_no_answer=True):
+    """
+    Resolver query compatible with dnspython 1.x and 2.x
+    :param resolver:
+    :param name:
+    :param rdtype:
+    :param raise_on_no_answer:
+    :return: answer
+    """
+    if hasattr(resolver, 'resolve'):
+        return resolver.resolve(name, rdtype, search=False, raise_on_no_answer=raise_on_no_answer)
+    return resolver.query(name, rdtype, raise_on_no_answer=raise_on_no_answer)
+
+
+def normalize_name(name):
+    """
+    Lower case name without the trailing dot
+    :param name:
+    :return:
+    """
+    return name.strip().rstrip('.').lower()
+
+
+def parent_names(name):
+    """
+    Returns the name and all its parents, TLD excluded:
+    _acme-challenge.a.example.com -> _acme-challenge.a.example.com, a.example.com, example.com
+    :param name:
+    :return: list of names
+    """
+    labels = normalize_name(name).split('.')
+    return ['.'.join(labels[idx:]) for idx in range(len(labels) - 1)]
+
+
+def read_zone_map(path):
+    """
+    Reads the zone map file, one zone per line, # starts a comment
+    :param path:
+    :return: list of zones
+    """
+    zones = []
+    with open(path) as fh:
+        for line in fh:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                zones.append(normalize_name(line))
+    return zones
+
+
+def soa_owner(response):
+    """
+    Returns owner of the SOA record in the authority section, None if there is none
+    :param response:
+    :return:
+    """
+    for rrset in response.authority if response is not None else []:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return normalize_name(rrset.name.to_text())
+    return None
+
+
+class ZoneFinder(object):
+    """
+    Finds the zone of a name: the longest zone of the zone map enclosing the name,
+    otherwise the owner of the SOA record found by walking up the name.
+    Negative answers carry the SOA of the zone in the authority section,
+    so a lookup usually costs one query.
+
+    Results are memoized for the name and all names between the name and its zone,
+    the finder is shared by the whole run. Thread safe.
+    """
+
+    def __init__(self, zones=None, lookup=True, nameservers=None, query_timeout=5.0):
+        """
+        :param zones: zone map, list of zones
+        :param lookup: look up SOA of names not in the zone map
+        :param nameservers: list of (address, port), system resolver is used if empty
+        :param query_timeout: timeout of one query
+        """
+        self.zones = set(normalize_name(x) for x in zones or [])
+        self.lookup = lookup
+        self.nameservers = list(nameservers or [])
+        self.query_timeout = query_timeout
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._resolver = None
+
+    def find(self, name):
+        """
+        Returns the zone of the name
+        :param name:
+        :return: zone without the trailing dot, None if not found
+        """
+        names = parent_names(name)
+        for cur_name in names:
+            if cur_name in self.zones:
+                return cur_name
+        if not names or not self.lookup or not is_available():
+            return None
+
+        zone = self._find_soa(names)
+        with self._lock:
+            if zone is None:
+                self._cache[names[0]] = None
+            else:
+                for cur_name in names[:names.index(zone) + 1]:
+                    self._cache[cur_name] = zone
+        return zone
+
+    def _find_soa(self, names):
+        """
+        Walks up the names until the SOA record is found
+        :param names: name and its parents
+        :return:
+        """
+        for idx, cur_name in enumerate(names):
+            with self._lock:
+                if cur_name in self._cache:
+                    return self._cache[cur_name]
+
+            try:
+                answer = query(self._get_resolver(), cur_name + '.', dns.rdatatype.SOA, raise_on_no_answer=False)
+                if answer.rrset is not None and normalize_name(answer.rrset.name.to_text()) == cur_name:
+                    return cur_name
+                responses = [answer.response]
+            except dns.resolver.NXDOMAIN as e:
+                responses = list(e.kwargs.get('responses', {}).values())
+            except dns.exception.DNSException as e:
+                logger.debug("SOA %s query failed: %s", cur_name, e)
+                return None
+
+            for response in responses:
+                zone = soa_owner(response)
+                if zone in names[idx + 1:]:
+                    return zone
+        return None
+
+    def _get_resolver(self):
+        """
+        Returns resolver of the configured nameservers, system resolver if none configured
+        :return:
+        """
+        with self._lock:
+            if self._resolver is None:
+                resolver = dns.resolver.Resolver(configure=not self.nameservers)
+                if self.nameservers:
+                    resolver.nameservers = [x[0] for x in self.nameservers]
+                    resolver.nameserver_ports = dict(self.nameservers)
+                resolver.lifetime = self.query_timeout
+                self._resolver = resolver
+            return self._resolver
+
+
+class DnsCache(object):
+    """
+    Caching DNS lookups shared by the whole run. Answers are cached per nameservers
+    for their TTL, negative answers for the negative TTL of the zone (RFC 2308).
+    Authoritative nameservers are discovered once per zone, concurrent discoveries
+    of the same zone wait for the first one. Thread safe.
+    """
+
+    NEGATIVE_TTL = 60
+    """Negative TTL used if the negative answer has no SOA."""
+
+    def __init__(self, nameservers=None, zones=None, query_timeout=5.0, ns_port=53):
+        """
+        :param nameservers: list of (address, port) of recursive nameservers, system resolver is used if empty
+        :param zones: zone map, zones of other names are looked up
+        :param query_timeout: timeout of one query
+        :param ns_port: port of the authoritative nameservers
+        """
+        self.nameservers = list(nameservers or [])
+        self.query_timeout = query_timeout
+        self.ns_port = ns_port
+        self.zone_finder = ZoneFinder(zones, lookup=True, nameservers=self.nameservers, query_timeout=query_timeout)
+        self._lock = threading.Lock()
+        self._answers = {}
+        self._resolvers = {}
+        self._zone_locks = {}
+
+    def query(self, name, rdtype, nameservers=None, fresh=False):
+        """
+        Returns records of the name, cached
+        :param name:
+        :param rdtype: record type, e.g., 'TXT'
+        :param nameservers: list of (address, port) to ask, the recursive nameservers by default
+        :param fresh: ignores the cached answer, the new one is cached
+        :return: list of rdata, empty for the negative answer
+        """
+        return self._lookup(name, rdtype, nameservers, fresh)[0]
+
+    def authoritative_nameservers(self, zone):
+        """
+        Returns authoritative nameservers of the zone, NS and their addresses are cached for their TTL
+        :param zone:
+        :return: list of (address, port), empty if not found
+        """
+        zone = normalize_name(zone)
+        with self._lock:
+            zone_lock = self._zone_locks.setdefault(zone, threading.Lock())
+
+        with zone_lock:
+            res = []
+            try:
+                for ns in self.query(zone, 'NS'):
+                    for rdata in self.query(ns.target.to_text(), 'A'):
+                        res.append((rdata.address, self.ns_port))
+            except dns.exception.DNSException as e:
+                logger.debug("Nameservers of %s not found: %s", zone, e)
+            return res
+
+    def verify_txt(self, name, value):
+        """
+        Returns true if the TXT record holds the value on all authoritative nameservers of its zone,
+        the recursive nameservers are asked if the nameservers are not found.
+        A cached answer without the value is checked again, the value may have been deployed since.
+        :param name:
+        :param value:
+        :return:
+        """
+        zone = self.zone_finder.find(name)
+        servers = self.authoritative_nameservers(zone) if zone is not None else []
+        for nameservers in [[x] for x in servers] or [None]:
+            rdatas, cached = self._lookup(name, 'TXT', nameservers)
+            if value not in txt_values(rdatas) and cached:
+                rdatas, cached = self._lookup(name, 'TXT', nameservers, fresh=True)
+            if value not in txt_values(rdatas):
+                logger.debug("TXT %s on %s is missing %s", name, nameservers or self.nameservers, value)
+                return False
+        return True
+
+    def _lookup(self, name, rdtype, nameservers=None, fresh=False):
+        """
+        Returns records of the name and true if the answer was cached
+        :param name:
+        :param rdtype:
+        :param nameservers:
+        :param fresh:
+        :return: (list of rdata, cached)
+        """
+        nameservers = tuple(nameservers or self.nameservers)
+        key = (nameservers, normalize_name(name), rdtype)
+        with self._lock:
+            entry = self._answers.get(key)
+        if entry is not None and not fresh and entry[0] > monotonic():
+            return entry[1], True
+
+        try:
+            answer = query(self._get_resolver(nameservers), key[1] + '.', rdtype, raise_on_no_answer=False)
+            if answer.rrset is not None:
+                rdatas, ttl = list(answer.rrset), answer.expiration - time.time()
+            else:
+                rdatas, ttl = [], self._negative_ttl([answer.response])
+        except dns.resolver.NXDOMAIN as e:
+            rdatas, ttl = [], self._negative_ttl(e.kwargs.get('responses', {}).values())
+
+        with self._lock:
+            self._answers[key] = (monotonic() + max(0, ttl), rdatas)
+        return rdatas, False
+
+    def _negative_ttl(self, responses):
+        """
+        Returns negative TTL, the minimum of the SOA TTL and the SOA minimum field
+        :param responses:
+        :return:
+        """
+        for response in responses:
+            for rrset in response.authority if response is not None else []:
+                if rrset.rdtype == dns.rdatatype.SOA:
+                    return min(rrset.ttl, rrset[0].minimum)
+        return self.NEGATIVE_TTL
+
+    def _get_resolver(self, nameservers):
+        """
+        Returns resolver of the nameservers, system resolver if empty. Resolvers are reused
+        :param nameservers: tuple of (address, port)
+        :return:
+        """
+        with self._lock:
+            resolver = self._resolvers.get(nameservers)
+            if resolver is None:
+                resolver = dns.resolver.Resolver(configure=not nameservers)
+                if nameservers:
+                    resolver.nameservers = [x[0] for x in nameservers]
+                    resolver.nameserver_ports = dict(nameservers)
+                resolver.lifetime = self.query_timeout
+                self._resolvers[nameservers] = resolver
+            return resolver
+
+
+class PropagationWaiter(object):
+    """
+    Polls TXT records until all expected values are visible on all resolvers.
+
+    All pending names are queried concurrently in rounds, rounds are separated
+    by exponentially growing delay. Returns as soon as everything is visible
+    or the overall timeout expires.
+    """
+
+    MAX_WORKERS = 32
+    """Maximum number of concurrent queries in one round."""
+
+    def __init__(self, nameservers=None, timeout=300, initial_delay=1.0, max_delay=30.0, query_timeout=5.0):
+        """
+        :param nameservers: list of (address, port), system resolver is used if empty
+        :param timeout: overall timeout in seconds
+        :param initial_delay: delay after the first round
+        :param max_delay: maximal delay between rounds
+        :param query_timeout: timeout of one query
+        """
+        self.nameservers = list(nameservers or [])
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.query_timeout = query_timeout
+
+    def wait(self, expected):
+        """
+        Waits until TXT records are visible.
+        :param expected: dict txt_domain -> iterable of expected TXT values
+        :return: dict txt_domain -> True if visible
+        """
+        pending = dict((name, set(values)) for name, values in expected.items())
+        visible = dict((name, False) for name in pending)
+        deadline = time.time() + self.timeout
+        delay = self.initial_delay
+        rounds = 0
+        resolvers = self._get_resolvers()
+
+        while pending:
+            rounds += 1
+            lifetime = self._get_lifetime(deadline)
+            for resolver in resolvers:
+                resolver.lifetime = lifetime
+            for name in self._poll_round(pending, resolvers):
+                visible[name] = True
+                del pending[name]
+
+            remaining = deadline - time.time()
+            if not pending or remaining <= 0:
+                break
+
+            logger.debug("Propagation round %s: %s of %s TXT records not visible yet, next check in %.1f s",
+                         rounds, len(pending), len(visible), min(delay, remaining))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.max_delay)
+
+        return visible
+
+    def _poll_round(self, pending, resolvers):
+        """
+        Queries all pending names concurrently
+        :param pending:
+        :param resolvers: shared by the workers
+        :return: list of names visible on all nameservers
+        """
+        work = queue.Queue()
+        for item in pending.items():
+            work.put(item)
+        found = []
+
+        def worker():
+            while True:
+                try:
+                    name, values = work.get_nowait()
+                except queue.Empty:
+                    return
+                if self.is_visible(name, values, resolvers=resolvers):
+                    found.append(name)
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.MAX_WORKERS, len(pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return found
+
+    def is_visible(self, name, values, deadline=None, resolvers=None):
+        """
+        Returns true if all values are present in the TXT record on all nameservers
+        :param name:
+        :param values:
+        :param deadline:
+        :param resolvers: resolvers to reuse, new ones are created if None
+        :return:
+        """
+        for resolver in resolvers or self._get_resolvers(deadline):
+            try:
+                answer = query(resolver, name, dns.rdatatype.TXT)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers) as e:
+                logger.debug("TXT %s not found on %s: %s", name, resolver.nameservers, e)
+                return False
+            except dns.exception.DNSException as e:
+                logger.debug("TXT %s query failed on %s: %s", name, resolver.nameservers, e)
+                return False
+
+            missing = set(values) - txt_values(answer)
+            if missing:
+                logger.debug("TXT %s on %s is missing %s", name, resolver.nameservers, missing)
+                return False
+        return True
+
+    def _get_resolvers(self, deadline=None):
+        """
+        Returns one resolver per configured nameserver, system resolver if none configured
+        :param deadline:
+        :return:
+        """
+        lifetime = self._get_lifetime(deadline)
+        if not self.nameservers:
+            resolver = dns.resolver.Resolver()
+            resolver.lifetime = lifetime
+            return [resolver]
+
+        resolvers = []
+        for address, port in self.nameservers:
+            resolver = dns.resolver.Resolver(configure=False)
+            resolver.nameservers = [address]
+            resolver.port = port
+            resolver.lifetime = lifetime
+            resolvers.append(resolver)
+        return resolvers
+
+    def _get_lifetime(self, deadline=None):
+        """
+        Returns the query timeout, shortened not to exceed the deadline
+        :param deadline:
+        :return:
+        """
+        if deadline is None:
+            return self.query_timeout
+        return max(0.1, min(self.query_timeout, deadline - time.time()))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Drains the cleanup queue written with --certbot-external-auth:out-cleanup-queue.
+
+Queued records are grouped by the plugin options of the run that queued them and
+by the DNS zone, each group is cleaned with one pre-cleanup / post-cleanup round
+(one cleanup-batch call in the batch handler mode). Failed records are retried,
+records still failing are queued again for the next drain:
+
+    certbot-ext-auth-drain /var/lib/letsencrypt/cleanup-queue.jsonl
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from collections import OrderedDict
+
+from certbot_external_auth import FIELD_DOMAIN, FIELD_TXT_DOMAIN, FIELD_ZONE
+from certbot_external_auth import jsonutil
+from certbot_external_auth.cleanup_queue import CleanupQueue
+
+logger = logging.getLogger(__name__)
+
+
+def zone_of(record):
+    """
+    Returns the zone the record belongs to. Without the zone field the last
+    two labels of the domain are used, only as a grouping key.
+    :param record:
+    :return:
+    """
+    if record.get(FIELD_ZONE):
+        return record[FIELD_ZONE]
+    domain = (record.get(FIELD_TXT_DOMAIN) or record.get(FIELD_DOMAIN) or '').rstrip('.').lower()
+    return '.'.join(domain.split('.')[-2:])
+
+
+def options_key(entry):
+    """
+    Returns key of the plugin configuration the entry was queued with
+    :param entry:
+    :return:
+    """
+    return json.dumps([entry.get('name'), entry.get('dirs'), entry.get('options')], sort_keys=True)
+
+
+def get_plugin(entry):
+    """
+    Creates the plugin configured as in the run that queued the entry.
+    Options missing in the entry, e.g., added by a newer plugin version, have their defaults.
+    :param entry:
+    :return:
+    """
+    from certbot import configuration
+    from certbot import constants
+    from certbot.plugins import common
+    from certbot_external_auth.plugin import AuthenticatorOut
+
+    namespace = argparse.Namespace(**constants.CLI_DEFAULTS)
+    for name, value in entry['dirs'].items():
+        setattr(namespace, name, value)
+    namespace.noninteractive_mode = True
+
+    prefix = common.dest_namespace(entry['name'])
+    options = AuthenticatorOut.get_option_defaults()
+    options.update(entry.get('options') or {})
+    for name, value in options.items():
+        setattr(namespace, prefix + name.replace('-', '_'), value)
+    return AuthenticatorOut(configuration.NamespaceConfig(namespace), entry['name'])
+
+
+def drain(path, retries=3, backoff=1.0, max_attempts=10):
+    """
+    Cleans up all queued records
+    :param path: cleanup queue file
+    :param retries: retries of failed records in this drain
+    :param backoff: seconds before the first retry, doubled for each next one
+    :param max_attempts: drains after which failed records are dropped, 0 to keep them
+    :return: number of records left in the queue or dropped
+    """
+    queue = CleanupQueue(path)
+    entries = queue.take()
+
+    # (options, zone) -> [(entry index, record)]
+    groups = OrderedDict()
+    for idx, entry in enumerate(entries):
+        key = options_key(entry)
+        for record in entry.get('records', []):
+            groups.setdefault((key, zone_of(record)), []).append((idx, jsonutil.Record(record)))
+
+    plugins = {}
+    leftovers = OrderedDict()
+    for (key, zone), pending in groups.items():
+        logger.info("Cleaning %d records in the zone %s" % (len(pending), zone))
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            try:
+                if key not in plugins:
+                    plugins[key] = get_plugin(entries[pending[0][0]])
+                failed = set(id(x) for x in plugins[key].drain_cleanup([x[1] for x in pending]))
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Cleanup of the zone %s failed: %s" % (zone, e), exc_info=True)
+                failed = set(id(x[1]) for x in pending)
+
+            pending = [x for x in pending if id(x[1]) in failed]
+            if not pending:
+                break
+
+        for idx, record in pending:
+            leftovers.setdefault(idx, []).append(record)
+
+    requeue, lost = [], 0
+    for idx, records in leftovers.items():
+        entry = OrderedDict(entries[idx])
+        entry['records'] = records
+        entry['attempts'] = entry.get('attempts', 0) + 1
+        lost += len(records)
+        if max_attempts and entry['attempts'] >= max_attempts:
+            logger.error("Dropping %d records failed in %d drains: %s"
+                         % (len(records), entry['attempts'], ', '.join(x[FIELD_DOMAIN] for x in records)))
+            continue
+        requeue.append(entry)
+
+    queue.done(requeue)
+    return lost
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cleans up challenges queued by the external-auth plugin')
+    parser.add_argument('queue', help='cleanup queue file')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='retries of failed records, default: %(default)s')
+    parser.add_argument('--backoff', type=float, default=1.0,
+                        help='seconds before the first retry, doubled for each next one, default: %(default)s')
+    parser.add_argument('--max-attempts', type=int, default=10,
+                        help='drains after which failed records are dropped, 0 keeps them, default: %(default)s')
+    parser.add_argument('--verbose', '-v', action='store_true', help='debug logging')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    return 1 if drain(args.queue, args.retries, args.backoff, args.max_attempts) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
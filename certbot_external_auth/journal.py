@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Crash-safe journal of the records deployed by the handler."""
+
+import errno
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+from collections import OrderedDict
+
+import six
+
+from certbot_external_auth import FIELD_TOKEN, FIELD_TOKENS
+from certbot_external_auth import jsonutil
+from certbot_external_auth.cleanup_queue import FileLock
+
+logger = logging.getLogger(__name__)
+
+
+OP_PERFORM = 'perform'
+OP_CLEANUP = 'cleanup'
+
+RUN_ID = uuid.uuid4().hex
+"""Identifies entries journaled by this process."""
+
+
+def record_key(record):
+    """
+    Identifies the deployed record by its tokens, the same for perform and cleanup records
+    :param record:
+    :return:
+    """
+    return ' '.join(sorted(record.get(FIELD_TOKENS) or [record.get(FIELD_TOKEN)]))
+
+
+def process_start_time(pid):
+    """
+    Returns start time of the process in clock ticks since boot, None if not known (no procfs)
+    :param pid:
+    :return:
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as fh:
+            # Process name in parentheses may contain spaces, starttime is the 22nd field
+            return int(fh.read().rsplit(')', 1)[1].split()[19])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def run_identity():
+    """
+    Returns identity of this run, stored with the journaled records.
+    A PID alone is not enough, containers start each run with the same PID and PIDs are recycled.
+    :return:
+    """
+    return OrderedDict([('id', RUN_ID), ('pid', os.getpid()), ('start_time', process_start_time(os.getpid()))])
+
+
+def is_running(pid, start_time=None):
+    """
+    Returns true if the process exists and, if the start time is given, was started at that time
+    :param pid:
+    :param start_time: clock ticks since boot, see process_start_time
+    :return:
+    """
+    if not isinstance(pid, six.integer_types) or isinstance(pid, bool) or pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+    if start_time is not None:
+        cur_start_time = process_start_time(pid)
+        if cur_start_time is not None and cur_start_time != start_time:
+            return False
+    return True
+
+
+def is_live(entry):
+    """
+    Returns true if the run that journaled the entry is still running
+    :param entry:
+    :return:
+    """
+    run = entry.get('run')
+    if not isinstance(run, dict):
+        # Entry without the run identity, this process has not written it
+        return entry.get('pid') != os.getpid() and is_running(entry.get('pid'))
+    if run.get('id') == RUN_ID:
+        return True
+    return is_running(run.get('pid'), run.get('start_time'))
+
+
+class Journal(object):
+    """
+    Append-only JSON-lines journal, one line per batch of records:
+        {"op": "perform", "pid": 123, "time": ..., <run context with the run identity>, "records": [...]}
+        {"op": "cleanup", "pid": 123, "time": ..., "keys": [...]}
+
+    Each batch is fsynced once. Records deployed by runs no longer running and not
+    cleaned up are stale, left behind by a crashed run. compact() drops what was cleaned up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    def deployed(self, records, context=None):
+        """
+        Journals records about to be deployed
+        :param records:
+        :param context: run context stored with the records, e.g., plugin options
+        :return:
+        """
+        if not records:
+            return
+        entry = OrderedDict([('op', OP_PERFORM), ('pid', os.getpid()), ('time', time.time())])
+        entry.update(context or {})
+        entry['records'] = records
+        self._append(entry)
+
+    def cleaned(self, records):
+        """
+        Journals records cleaned up
+        :param records:
+        :return:
+        """
+        if not records:
+            return
+        entry = OrderedDict([('op', OP_CLEANUP), ('pid', os.getpid()), ('time', time.time())])
+        entry['keys'] = [record_key(x) for x in records]
+        self._append(entry)
+
+    def stale(self):
+        """
+        Returns records deployed by runs no longer running, not cleaned up
+        :return: list of (perform entry, its stale records)
+        """
+        res = OrderedDict()
+        for entry, record in self._replay(self._read()).values():
+            if not is_live(entry):
+                res.setdefault(id(entry), (entry, []))[1].append(record)
+        return list(res.values())
+
+    def compact(self):
+        """
+        Rewrites the journal with records not cleaned up only, atomically
+        :return:
+        """
+        with FileLock(self.lock_path):
+            if not os.path.exists(self.path):
+                return
+            entries = OrderedDict()
+            for entry, record in self._replay(self._read()).values():
+                if id(entry) not in entries:
+                    entries[id(entry)] = OrderedDict(entry)
+                    entries[id(entry)]['records'] = []
+                entries[id(entry)]['records'].append(record)
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.journal-')
+            with os.fdopen(fd, 'w') as fh:
+                for entry in entries.values():
+                    fh.write(jsonutil.dumps(entry) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.rename(tmp_path, self.path)
+
+    def _append(self, entry):
+        data = (jsonutil.dumps(entry) + '\n').encode('UTF-8')
+        with FileLock(self.lock_path):
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path) as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line, object_pairs_hook=OrderedDict))
+                except ValueError:
+                    # Torn write of a crashed run
+                    logger.warning("Skipping corrupted journal entry in %s: %s" % (self.path, line))
+        return entries
+
+    @staticmethod
+    def _replay(entries):
+        """
+        Replays the journal in order, a record deployed again after its cleanup is pending again
+        :param entries:
+        :return: key -> (perform entry, record) of records not cleaned up
+        """
+        pending = OrderedDict()
+        for entry in entries:
+            if entry.get('op') == OP_PERFORM:
+                for record in entry.get('records', []):
+                    pending[record_key(record)] = (entry, record)
+            elif entry.get('op') == OP_CLEANUP:
+                for key in entry.get('keys', []):
+                    pending.pop(key, None)
+        return pending
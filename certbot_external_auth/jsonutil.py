@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""JSON serialization of the emitted records, uses orjson if installed."""
+
+import datetime
+import json
+
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def is_fast_available():
+    """
+    Returns true if the optional orjson backend is installed
+    :return:
+    """
+    return orjson is not None
+
+
+def to_str(val):
+    """
+    Decodes byte strings, other values are returned as they are
+    :param val:
+    :return:
+    """
+    return val.decode('UTF-8') if isinstance(val, bytes) else val
+
+
+class AutoJSONEncoder(json.JSONEncoder):
+    """
+    JSON encoder trying to_json() first
+    """
+    def default(self, obj):
+        try:
+            return obj.to_json()
+        except AttributeError:
+            return self.default_classic(obj)
+
+    def default_classic(self, o):
+        if isinstance(o, set):
+            return list(o)
+        elif isinstance(o, datetime.datetime):
+            return (o - datetime.datetime(1970, 1, 1)).total_seconds()
+        elif isinstance(o, bytes):
+            return o.decode('UTF-8')
+        else:
+            return super(AutoJSONEncoder, self).default(o)
+
+
+class Record(OrderedDict):
+    """
+    Record emitted on the stdout and passed to the handler.
+    Serialized once by dumps(), the JSON string is kept until the record is modified.
+    Values are expected to be already decoded to str.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.json_str = None
+        super(Record, self).__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        self.json_str = None
+        super(Record, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.json_str = None
+        super(Record, self).__delitem__(key)
+
+    def pop(self, *args):
+        self.json_str = None
+        return super(Record, self).pop(*args)
+
+    def clear(self):
+        self.json_str = None
+        super(Record, self).clear()
+
+
+# Compact like orjson, non-ASCII characters stay escaped
+_ENCODER = AutoJSONEncoder(separators=(',', ':'))
+
+
+def _dumps(data):
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=_ENCODER.default,
+                                option=orjson.OPT_PASSTHROUGH_DATETIME).decode('UTF-8')
+        except TypeError:
+            # e.g., non-str keys, the standard encoder handles them
+            pass
+    return _ENCODER.encode(data)
+
+
+def dumps(data):
+    """
+    Serializes data to a single line JSON, Record is serialized only once
+    :param data:
+    :return:
+    """
+    if not isinstance(data, Record):
+        return _dumps(data)
+    if data.json_str is None:
+        data.json_str = _dumps(data)
+    return data.json_str
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Buffered writer of the JSON-lines output."""
+
+import errno
+import os
+import sys
+import threading
+
+
+class LineWriter(object):
+    """
+    Collects output lines and writes them with one call on flush(),
+    or when more than buffer_size characters are pending.
+    Writes to the file descriptor if given, otherwise to the current sys.stdout.
+    """
+
+    BUFFER_SIZE = 65536
+
+    def __init__(self, fd=None, buffer_size=None, close_fd=False):
+        """
+        :param fd: file descriptor to write to, None for sys.stdout
+        :param buffer_size: maximal number of characters kept before writing
+        :param close_fd: close the file descriptor in close()
+        """
+        self.fd = fd
+        self.buffer_size = buffer_size or self.BUFFER_SIZE
+        self.close_fd = close_fd
+        self._lock = threading.Lock()
+        self._lines = []
+        self._size = 0
+
+    @classmethod
+    def open(cls, path, buffer_size=None):
+        """
+        Opens the file for appending, created if missing.
+        Opening a FIFO blocks until the reader opens it.
+        :param path:
+        :param buffer_size:
+        :return:
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        return cls(fd, buffer_size, close_fd=True)
+
+    def write(self, data):
+        """
+        Buffers the data, complete lines are expected
+        :param data:
+        :return:
+        """
+        with self._lock:
+            self._lines.append(data)
+            self._size += len(data)
+            if self._size >= self.buffer_size:
+                self._flush()
+
+    def flush(self):
+        """
+        Writes all pending lines
+        :return:
+        """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """
+        Writes pending lines and closes the file descriptor if owned
+        :return:
+        """
+        with self._lock:
+            self._flush()
+            if self.fd is not None and self.close_fd:
+                os.close(self.fd)
+                self.fd = None
+
+    def _flush(self):
+        if not self._lines:
+            return
+        data = ''.join(self._lines)
+        self._lines = []
+        self._size = 0
+
+        if self.fd is None:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+
+        data = data.encode('UTF-8')
+        while data:
+            try:
+                written = os.write(self.fd, data)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            data = data[written:]
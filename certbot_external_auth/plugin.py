@@ -3,30 +3,36 @@
 
 """Manual plugin on stereoids."""
 
-from past.builtins import basestring
-from builtins import bytes
 import six
 
+# Heavy modules are imported where used, the plugin module is imported by every
+# certbot run enumerating the plugins, even when the plugin is not selected.
+if six.PY2:  # pragma: no cover
+    from past.builtins import basestring
+    from builtins import bytes
+else:
+    basestring = str
+
 import atexit
 import calendar
 import collections
+import contextlib
 import json
 import logging
 import math
 import os
-import pipes
-import shutil
 import signal
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-import datetime
+import importlib
+import inspect
 
 from collections import OrderedDict
 
-import zope.component
 import zope.interface
 from acme import challenges
 from acme import errors as acme_errors
@@ -38,13 +44,23 @@ except:
 
 from certbot import errors
 from certbot import interfaces
-from certbot import reverter
-from certbot.display import util as display_util
 from certbot.plugins import common
 
 from six.moves import queue  # pylint: disable=import-error
 
+try:
+    from shlex import quote as shell_quote
+except ImportError:  # pragma: no cover
+    from pipes import quote as shell_quote
+
 from certbot_external_auth import *
+from certbot_external_auth.daemon import HandlerDaemon, HandlerDaemonError
+from certbot_external_auth import daemon
+from certbot_external_auth import capture
+from certbot_external_auth import profiler
+from certbot_external_auth import jsonutil
+from certbot_external_auth.jsonutil import AutoJSONEncoder
+from certbot_external_auth.output import LineWriter
 
 logger = logging.getLogger(__name__)
 
@@ -52,25 +68,70 @@ logger = logging.getLogger(__name__)
 INITIAL_PID = os.getpid()
 
 
-class AutoJSONEncoder(json.JSONEncoder):
+class RunState(object):
     """
-    JSON encoder trying to_json() first
+    Process-wide state shared by all plugin instances.
+    certbot renew creates and prepares a new plugin instance for each lineage,
+    the expensive parts are set up by the first one and reused by the rest.
+    Parts depending on plugin options are keyed by them, lineages may be configured differently.
     """
-    def default(self, obj):
-        try:
-            return obj.to_json()
-        except AttributeError:
-            return self.default_classic(obj)
-
-    def default_classic(self, o):
-        if isinstance(o, set):
-            return list(o)
-        elif isinstance(o, datetime.datetime):
-            return (o - datetime.datetime(1970, 1, 1)).total_seconds()
-        elif isinstance(o, bytes):
-            return o.decode('UTF-8')
-        else:
-            return super(AutoJSONEncoder, self).default(o)
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reverter = None
+        self.orig_reporter = None
+        self.messages = queue.PriorityQueue()
+        self.prepared = False
+        self.handler_daemons = {}
+        self.async_core = None
+        self.http_responder = None
+        self.profiler = profiler.Profiler()
+        self.handler_base_envs = {}
+        self.handler_caches = {}
+        self.handler_retry_budgets = {}
+        self.module_handlers = {}
+        self.output_writers = {}
+        self.journals = {}
+        self.journal_recovered = False
+        self.zone_finders = {}
+        self.dns_caches = {}
+
+    def get_reverter(self, config):
+        """
+        Returns reverter, the recovery routine is run only when created
+        :param config:
+        :return:
+        """
+        with self.lock:
+            if self.reverter is None:
+                from certbot import reverter
+                self.reverter = reverter.Reverter(config)
+                self.reverter.recovery_routine()
+            return self.reverter
+
+    def close(self):
+        """
+        Terminates handler daemons, the async core and the HTTP01 responder, registered with atexit
+        :return:
+        """
+        with self.lock:
+            for handler_daemon in list(self.handler_daemons.values()):
+                handler_daemon.close()
+            self.handler_daemons.clear()
+            if self.async_core is not None:
+                self.async_core.close()
+                self.async_core = None
+            if self.http_responder is not None:
+                self.http_responder.stop()
+                self.http_responder = None
+            for handler_cache in self.handler_caches.values():
+                handler_cache.save()
+            for output_writer in list(self.output_writers.values()):
+                output_writer.close()
+            self.output_writers.clear()
+
+
+RUN_STATE = RunState()
+atexit.register(RUN_STATE.close)
 
 
 @zope.interface.implementer(interfaces.IAuthenticator)
@@ -149,51 +210,203 @@ s.serve_forever()" """
 
     _msg_type = collections.namedtuple('ReporterMsg', 'priority text on_crash')
 
+    # Self-verification
+    VERIFY_MAX_WORKERS = 64
+    """Maximum number of challenges verified concurrently."""
+    VERIFY_VALID = 'valid'
+    VERIFY_INVALID = 'invalid'
+    VERIFY_TIMEOUT = 'timeout'
+    VERIFY_UNKNOWN = 'unknown'
+
+    # Handler environment policies & data channels
+    HANDLER_ENV_FULL = 'full'
+    HANDLER_ENV_ALLOWLIST = 'allowlist'
+    HANDLER_ENV_MINIMAL = 'minimal'
+    HANDLER_DATA_ENV = 'env'
+    HANDLER_DATA_STDIN = 'stdin'
+    HANDLER_DATA_FILE = 'file'
+
+    HANDLER_KILL_GRACE = 5
+    """Seconds a timed out handler gets to terminate after SIGTERM before SIGKILL."""
+
+    HANDLER_MINIMAL_ENV = ('PATH', 'HOME', 'USER', 'LOGNAME', 'SHELL', 'LANG', 'LC_ALL', 'LC_CTYPE', 'TMPDIR', 'TZ')
+    """Variables passed to the handler by the minimal and allowlist environment policies."""
+
     def __init__(self, *args, **kwargs):
         super(AuthenticatorOut, self).__init__(*args, **kwargs)
-        self._root = (tempfile.mkdtemp() if self.conf("test-mode")
-                      else "/tmp/certbot")
-        self._httpd = None
+        self._root = "/tmp/certbot"
         self._start_time = calendar.timegm(time.gmtime())
         self._handler_file_problem = False
 
-        # Set up reverter
-        self.reverter = reverter.Reverter(self.config)
-        self.reverter.recovery_routine()
+        # Set up reverter, once per process
+        self.reverter = RUN_STATE.get_reverter(self.config)
 
-        # Reporter
-        self.orig_reporter = None
-        self.messages = queue.PriorityQueue()
+        # Reporter, messages of all lineages are reported together
+        self.orig_reporter = RUN_STATE.orig_reporter
+        self.messages = RUN_STATE.messages
+        self.profiler = RUN_STATE.profiler
 
     @classmethod
     def add_parser_arguments(cls, add):
         add("test-mode", action="store_true",
-            help="Test mode. Executes the manual command in subprocess.")
+            help="Test mode. Serves http-01 challenges from the in-process HTTP server.")
         add("public-ip-logging-ok", action="store_true",
             help="Automatically allows public IP logging.")
         add("text-mode", action="store_true",
             help="Original text mode, by default turned off, produces JSON challenges")
         add("handler", default=None,
             help="Handler program that takes the action. Data is transferred in ENV vars")
+        add("handler-module", default=None,
+            help="Python handler called in-process instead of the handler program, pkg.module:Handler")
         add("dehydrated-dns", action="store_true",
             help="Switches handler mode to Dehydrated DNS compatible version")
+        add("max-parallel", default=1, type=int,
+            help="Maximum number of handler invocations running concurrently in the perform and cleanup stages")
+        add("handler-batch", action="store_true",
+            help="Sends all perform / cleanup records to a single handler invocation as a JSON array on stdin")
+        add("handler-daemon", action="store_true",
+            help="Handler is started once and receives all stages as line-delimited JSON on stdin")
+        add("handler-daemon-timeout", default=300, type=int,
+            help="Seconds to wait for the handler daemon response")
+        add("handler-env", default="full", choices=["full", "allowlist", "minimal"],
+            help="Environment the handler inherits: full, allowlist (minimal + handler-env-allow), minimal")
+        add("handler-env-allow", default=None,
+            help="Comma separated variables passed with the allowlist policy, NAME* matches a prefix")
+        add("handler-data", default="env", choices=["env", "stdin", "file"],
+            help="Passes the record to the handler in ENV vars, as JSON on stdin or in a JSON file")
+        add("handler-timeout", default=None, type=int,
+            help="Seconds a handler invocation may run, the handler process group is killed after. No limit by default")
+        add("handler-stage-timeouts", default=None,
+            help="Per-stage handler timeouts overriding handler-timeout, e.g., perform=60,cleanup=30")
+        add("handler-retries", default=0, type=int,
+            help="Retries of a failed or timed out handler invocation")
+        add("handler-retry-backoff", default=1.0, type=float,
+            help="Seconds before the first retry, doubled for each next one")
+        add("handler-retry-budget", default=10, type=int,
+            help="Maximum number of handler retries in the whole run")
+        add("handler-stream-output", action="store_true",
+            help="Logs handler output lines as they arrive and keeps only the last handler-output-limit bytes")
+        add("handler-output-limit", default=65536, type=int,
+            help="Bytes of each handler output stream kept with handler-stream-output")
+        add("handler-cache", action="store_true",
+            help="Skips perform of records the handler already deployed within handler-cache-ttl")
+        add("handler-cache-ttl", default=3600, type=int,
+            help="Seconds a deployed record is considered deployed by the handler cache")
+        add("handler-cache-file", default=None,
+            help="Handler cache file, external-auth-cache.json in the certbot work dir by default")
+        add("cleanup-queue", default=None,
+            help="Defers the handler cleanup, records are appended to the queue file and cleaned "
+                 "later by certbot-ext-auth-drain")
+        add("journal", action="store_true",
+            help="Journals records deployed by the handler, records left by a crashed run are cleaned up "
+                 "by the recovery routine of the next run")
+        add("journal-file", default=None,
+            help="Journal file, external-auth-journal.jsonl in the certbot work dir by default")
+        add("async-core", action="store_true",
+            help="Runs handler invocations as asyncio coroutines instead of threads. Python 3.5+ only")
+        add("bulk-json", action="store_true",
+            help="JSON mode emits all challenges first, then waits for one acknowledgement "
+                 "or per-token acknowledgements in any order")
+        add("output-fd", default=None, type=int,
+            help="Writes the JSON output to the file descriptor instead of the stdout")
+        add("output-file", default=None,
+            help="Writes the JSON output to the file or FIFO instead of the stdout")
+        add("verify-timeout", default=120, type=int,
+            help="Overall deadline in seconds for the self-verification of all challenges")
+        add("group-challenges", action="store_true",
+            help="dns-01 challenges with the same TXT domain are passed together in one record")
+        add("http-responder", action="store_true",
+            help="Serves http-01 challenges from an in-process HTTP server instead of the user / handler")
+        add("profile", action="store_true",
+            help="Emits per-stage timings as the final profile JSON record")
+        add("profile-file", default=None,
+            help="Writes per-stage timings as JSON to the file at exit")
+        add("dns-propagation-wait", action="store_true",
+            help="After deploying dns-01 challenges wait until all TXT records are visible. Requires dnspython")
+        add("dns-resolvers", default=None,
+            help="Comma separated nameservers used to check the TXT records propagation, e.g., 8.8.8.8,1.1.1.1:53")
+        add("dns-propagation-timeout", default=300, type=int,
+            help="Maximum number of seconds to wait for the TXT records propagation")
+        add("dns-zone-map", default=None,
+            help="File with DNS zones, one per line. dns-01 records get the zone field, "
+                 "challenges are passed ordered by the zone")
+        add("dns-zone-lookup", action="store_true",
+            help="Finds the zone of dns-01 challenges not in dns-zone-map by the SOA lookup. Requires dnspython")
+        add("dns-self-verify", action="store_true",
+            help="Self-verification of dns-01 challenges checks the TXT records on the authoritative "
+                 "nameservers, lookups are cached for the whole run. Requires dnspython")
 
     def prepare(self):  # pylint: disable=missing-docstring,no-self-use
-        # Re-register reporter - json only report
-        self.orig_reporter = zope.component.getUtility(interfaces.IReporter)
-        zope.component.provideUtility(self, provides=interfaces.IReporter)
-        atexit.register(self.atexit_print_messages)
-
-        # Re-register displayer - stderr only displayer
-        #displayer = display_util.NoninteractiveDisplay(sys.stderr)
-        displayer = display_util.FileDisplay(sys.stderr, False)
-        zope.component.provideUtility(displayer)
+        with RUN_STATE.lock:
+            if not RUN_STATE.prepared:
+                import zope.component
+                from certbot.display import util as display_util
+
+                # Re-register reporter - json only report
+                RUN_STATE.orig_reporter = zope.component.getUtility(interfaces.IReporter)
+                zope.component.provideUtility(self, provides=interfaces.IReporter)
+                atexit.register(self.atexit_print_messages)
+
+                # Re-register displayer - stderr only displayer
+                #displayer = display_util.NoninteractiveDisplay(sys.stderr)
+                displayer = display_util.FileDisplay(sys.stderr, False)
+                zope.component.provideUtility(displayer)
+                RUN_STATE.prepared = True
+            self.orig_reporter = RUN_STATE.orig_reporter
 
         # Non-interactive not yet supported
         if self.config.noninteractive_mode and not self.conf("test-mode"):
             raise errors.PluginError("Running manual mode non-interactively is not supported (yet)")
         if not self._is_handler_mode() and self._is_dehydrated_dns():
             raise errors.PluginError("dehydrated-dns switch is allowed only with handler specified")
+        if self.conf("max-parallel") is not None and self.conf("max-parallel") < 1:
+            raise errors.PluginError("max-parallel has to be a positive number")
+        if self._is_batch_handler_mode() and self._is_dehydrated_dns():
+            raise errors.PluginError("handler-batch switch is not supported in the dehydrated-dns mode")
+        if self.conf("group-challenges") and self._is_dehydrated_dns():
+            raise errors.PluginError("group-challenges switch is not supported in the dehydrated-dns mode")
+        if self.conf("handler-daemon") and not self._is_handler_mode():
+            raise errors.PluginError("handler-daemon switch is allowed only with handler specified")
+        if self._is_module_handler_mode():
+            if self._get_handler() is not None:
+                raise errors.PluginError("handler and handler-module are mutually exclusive")
+            if self._is_dehydrated_dns() or self.conf("handler-daemon"):
+                raise errors.PluginError("handler-module does not support dehydrated-dns and handler-daemon")
+            self._get_module_handler()
+        if self.conf("handler-cache") and not self._is_handler_mode():
+            raise errors.PluginError("handler-cache switch is allowed only with handler specified")
+        if self.conf("cleanup-queue") and not self._is_handler_mode():
+            raise errors.PluginError("cleanup-queue is allowed only with handler specified")
+        if self.conf("journal") and not self._is_handler_mode():
+            raise errors.PluginError("journal switch is allowed only with handler specified")
+        if self.conf("handler-stream-output") and (self.conf("handler-output-limit") or 0) < 1:
+            raise errors.PluginError("handler-output-limit has to be a positive number")
+        if self.conf("handler-retries") is not None and self.conf("handler-retries") < 0:
+            raise errors.PluginError("handler-retries has to be a non-negative number")
+        self._get_handler_stage_timeouts()
+
+        if self.conf("output-fd") is not None and self.conf("output-file"):
+            raise errors.PluginError("output-fd and output-file are mutually exclusive")
+        self._get_output_writer()
+
+        if self.conf("dns-zone-lookup"):
+            from certbot_external_auth import dnsutil
+            if not dnsutil.is_available():
+                logger.warning("Zone lookup requires optional dependency `dnspython` to be installed.")
+        self._get_zone_finder()
+
+        if self.conf("async-core") and sys.version_info < (3, 5):
+            raise errors.PluginError("async-core switch requires Python 3.5+")
+
+        if self._is_daemon_handler_mode() and self._get_handler_daemon() is None:
+            raise errors.PluginError("Could not start the handler daemon")
+
+        # Records left by a crashed run are cleaned up once per process
+        with RUN_STATE.lock:
+            run_recovery = self._is_journal_mode() and not RUN_STATE.journal_recovered
+            RUN_STATE.journal_recovered = True
+        if run_recovery:
+            self.recovery_routine()
 
     def more_info(self):  # pylint: disable=missing-docstring,no-self-use
         return ("This plugin requires user's manual intervention in setting "
@@ -218,22 +431,35 @@ s.serve_forever()" """
         """
         # pylint: disable=missing-docstring
         self._get_ip_logging_permission()
-        mapping = {"http-01": self._perform_http01_challenge,
-                   "dns-01": self._perform_dns01_challenge
-                   }
-        responses = []
-        # TODO: group achalls by the same socket.gethostbyname(_ex)
-        # and prompt only once per server (one "echo -n" per domain)
 
-        if self._is_classic_handler_mode() and self._call_handler("pre-perform") is None:
-            raise errors.PluginError("Error in calling the handler to do the pre-perform (challenge) stage")
+        with self.profiler.measure(profiler.STAGE_PERFORM), self._flushed_output():
+            # Challenges served by the plugin itself
+            served = [x for x in achalls if self._is_responder_challenge(x)]
+            deployed = [x for x in achalls if not self._is_responder_challenge(x)]
+            response_map = dict(zip((id(x) for x in served), self._perform_http01_responder(served)))
 
-        for achall in achalls:
-            responses.append(mapping[achall.typ](achall))
+            self._journal_deployed(deployed)
+
+            # TODO: group http-01 achalls by the same socket.gethostbyname(_ex)
+            # and prompt only once per server (one "echo -n" per domain)
+
+            # Nothing to deploy, hooks are not needed
+            run_hooks = self._is_classic_handler_mode() and not self._is_deployed_cached(deployed)
 
-        if self._is_classic_handler_mode() and self._call_handler("post-perform") is None:
-            raise errors.PluginError("Error in calling the handler to do the post-perform (challenge) stage")
+            if run_hooks and self._call_handler("pre-perform") is None:
+                raise errors.PluginError("Error in calling the handler to do the pre-perform (challenge) stage")
 
+            response_map.update(zip((id(x) for x in deployed), self._perform_deployed(deployed)))
+            responses = [response_map[id(x)] for x in achalls]
+
+            if run_hooks and self._call_handler("post-perform") is None:
+                raise errors.PluginError("Error in calling the handler to do the post-perform (challenge) stage")
+            self._save_handler_cache()
+
+            if self.conf("dns-propagation-wait") and not self.conf("test-mode"):
+                self._wait_for_propagation(achalls)
+
+            self._verify_challenges(achalls, responses)
         return responses
 
     def add_message(self, msg, priority, on_crash=True):
@@ -261,6 +487,7 @@ s.serve_forever()" """
         """Prints messages to the user and clears the message queue."""
         if self._is_text_mode():
             self.orig_reporter.print_messages()
+            self._profile_out()
             return
 
         no_exception = sys.exc_info()[0] is None
@@ -282,8 +509,53 @@ s.serve_forever()" """
         data = OrderedDict()
         data[FIELD_CMD] = COMMAND_REPORT
         data['messages'] = messages
+        handler_stats = self._get_handler_stats()
+        if handler_stats is not None:
+            data['handler_stats'] = handler_stats
         self._json_out(data, True)
-        pass
+        self._profile_out()
+        self._flush_output()
+
+    def _get_handler_stats(self):
+        """
+        Returns handler invocation statistics of the run, None if the handler was not invoked
+        :return:
+        """
+        stages = self.profiler.to_json()['stages']
+        run = stages.get(profiler.STAGE_HANDLER_RUN)
+        if run is None:
+            return None
+
+        stats = OrderedDict()
+        stats['invocations'] = run['count']
+        stats['failures'] = stages.get(profiler.STAGE_HANDLER_FAILURE, {}).get('count', 0)
+        stats['timeouts'] = stages.get(profiler.STAGE_HANDLER_TIMEOUT, {}).get('count', 0)
+        stats['retries'] = stages.get(profiler.STAGE_HANDLER_RETRY, {}).get('count', 0)
+        stats['total_time'] = run['total']
+        stats['max_time'] = run['max']
+        return stats
+
+    def _profile_out(self):
+        """
+        Emits the profile record with per-stage timings and writes it to the profile file
+        :return:
+        """
+        if self.profiler.is_empty() or not (self.conf("profile") or self.conf("profile-file")):
+            return
+
+        data = OrderedDict()
+        data[FIELD_CMD] = COMMAND_PROFILE
+        data.update(self.profiler.to_json())
+
+        if self.conf("profile") and not self._is_text_mode():
+            self._json_out(data, True)
+
+        if self.conf("profile-file"):
+            try:
+                with open(self.conf("profile-file"), 'w') as fh:
+                    fh.write(self._json_dumps(data, indent=2) + '\n')
+            except (IOError, OSError) as e:
+                logger.error("Could not write the profile file %s: %s" % (self.conf("profile-file"), e))
 
     def atexit_print_messages(self, pid=None):
         """Function to be registered with atexit to print messages.
@@ -298,20 +570,6 @@ s.serve_forever()" """
         if pid == os.getpid():
             self.print_messages()
 
-    @classmethod
-    def _test_mode_busy_wait(cls, port):
-        while True:
-            time.sleep(1)
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                sock.connect(("localhost", port))
-            except socket.error:  # pragma: no cover
-                pass
-            else:
-                break
-            finally:
-                sock.close()
-
     def cleanup(self, achalls):
         """
         Cleaning up challenges, called by AuthHandler
@@ -319,50 +577,672 @@ s.serve_forever()" """
         :return:
         """
         # pylint: disable=missing-docstring
+        with self.profiler.measure(profiler.STAGE_CLEANUP), self._flushed_output():
+            self._cleanup_http01_responder([x for x in achalls if self._is_responder_challenge(x)])
+            achalls = [x for x in achalls if not self._is_responder_challenge(x)]
 
-        if self._is_classic_handler_mode() \
-                and not self._is_handler_broken() \
-                and self._call_handler("pre-cleanup") is None:
-            raise errors.PluginError("Error in calling the handler to do the pre-cleanup stage")
+            if self._is_deferred_cleanup_mode():
+                self._defer_cleanup(achalls)
+                return
 
-        for achall in achalls:
-            cur_record = self._get_cleanup_json(achall)
+            if self._is_classic_handler_mode() \
+                    and not self._is_handler_broken() \
+                    and self._call_handler("pre-cleanup") is None:
+                raise errors.PluginError("Error in calling the handler to do the pre-cleanup stage")
 
+            records = self._get_cleanup_records(achalls)
             if self._is_json_mode() or self._is_handler_mode():
-                self._json_out(cur_record, True)
+                for cur_record in records:
+                    self._json_out(cur_record, True)
+            self._invalidate_cached_records(records)
+
+            failed = []
+            if self._is_batch_handler_mode() and not self._is_handler_broken():
+                failed = self._cleanup_batch_records(records)
+            elif self._is_handler_mode() and not self._is_handler_broken():
+                failed = self._cleanup_records(records)
 
-            if self._is_handler_mode() \
+            if self._is_handler_mode() and not self._is_handler_broken():
+                failed_ids = set(id(x) for x in failed)
+                self._journal_cleaned([x for x in records if id(x) not in failed_ids])
+
+            if self._is_classic_handler_mode() \
                     and not self._is_handler_broken() \
-                    and self._call_handler("cleanup", **(self._get_json_to_kwargs(cur_record))) is None:
-                raise errors.PluginError("Error in calling the handler to do the cleanup stage")
+                    and self._call_handler("post-cleanup") is None:
+                raise errors.PluginError("Error in calling the handler to do the post-cleanup stage")
+            self._save_handler_cache()
+
+            if failed:
+                raise errors.PluginError("Error in calling the handler to do the cleanup stage, failed %d of %d: %s"
+                                         % (len(failed), len(records),
+                                            ', '.join(x[FIELD_DOMAIN] for x in failed)))
+
+    def _get_cleanup_records(self, achalls):
+        """
+        Builds cleanup records, one per group of challenges
+        :param achalls:
+        :return:
+        """
+        return [self._get_group_record([self._get_cleanup_json(x) for x in group])
+                for group in self._group_achalls(achalls).values()]
+
+    def _defer_cleanup(self, achalls):
+        """
+        Appends cleanup records to the cleanup queue instead of calling the handler.
+        The queue entry holds plugin options and certbot directories of this run, so
+        certbot-ext-auth-drain calls the handler the same way later.
+        :param achalls:
+        :return:
+        """
+        records = self._get_cleanup_records(achalls)
+        for cur_record in records:
+            self._json_out(cur_record, True)
+        self._invalidate_cached_records(records)
+        self._save_handler_cache()
+        if not records:
+            return
+
+        entry = OrderedDict()
+        entry['time'] = time.time()
+        entry.update(self._get_run_context())
+        entry['records'] = records
+        entry['attempts'] = 0
+
+        from certbot_external_auth.cleanup_queue import CleanupQueue
+        try:
+            CleanupQueue(self.conf("cleanup-queue")).put([entry])
+        except (IOError, OSError) as e:
+            raise errors.PluginError("Could not queue the cleanup to %s: %s" % (self.conf("cleanup-queue"), e))
+        logger.info("Cleanup of %d records queued to %s" % (len(records), self.conf("cleanup-queue")))
+
+        # The queue owns the records now
+        self._journal_cleaned(records)
+
+    def drain_cleanup(self, records):
+        """
+        Cleans up records taken from the cleanup queue, see drain.py.
+        Errors are not raised, records failed to clean up are returned.
+        :param records:
+        :return: list of records the handler failed to clean up
+        """
+        # Even failed records may be partially removed, the next perform has to deploy them again
+        self._invalidate_cached_records(records)
+
+        if self._is_classic_handler_mode() and self._call_handler("pre-cleanup") is None:
+            logger.error("Error in calling the handler to do the pre-cleanup stage")
+            self._save_handler_cache()
+            return records
+
+        if self._is_batch_handler_mode():
+            failed = self._cleanup_batch_records(records)
+        else:
+            failed = self._cleanup_records(records)
+
+        if self._is_classic_handler_mode() and self._call_handler("post-cleanup") is None:
+            logger.error("Error in calling the handler to do the post-cleanup stage")
+        self._save_handler_cache()
+        return failed
+
+    def _get_run_context(self):
+        """
+        Returns plugin name, certbot directories and plugin options of this run,
+        stored with queued / journaled records to create the same plugin later, see drain.get_plugin.
+        The run identity tells the journal whether the run is still alive.
+        :return:
+        """
+        from certbot_external_auth import journal
+        context = OrderedDict()
+        context['run'] = journal.run_identity()
+        context['name'] = self.name
+        context['dirs'] = OrderedDict((x, getattr(self.config, x)) for x in ('config_dir', 'work_dir', 'logs_dir'))
+        context['options'] = self._get_plugin_options()
+        return context
+
+    def _get_journal(self):
+        """
+        Returns the journal of deployed records shared by the whole run, None if not enabled
+        :return:
+        """
+        if not self._is_journal_mode():
+            return None
+
+        path = os.path.abspath(self.conf("journal-file") or os.path.join(
+            self.config.work_dir, 'external-auth-journal.jsonl'))
+        with RUN_STATE.lock:
+            if path not in RUN_STATE.journals:
+                from certbot_external_auth.journal import Journal
+                RUN_STATE.journals[path] = Journal(path)
+            return RUN_STATE.journals[path]
+
+    def _journal_deployed(self, achalls):
+        """
+        Journals records of the challenges before the handler deploys them, one fsync for all
+        :param achalls:
+        :return:
+        """
+        journal = self._get_journal()
+        if journal is None or not achalls:
+            return
+        try:
+            journal.deployed(self._get_perform_records(achalls)[1], self._get_run_context())
+        except (IOError, OSError) as e:
+            raise errors.PluginError("Could not write the journal %s: %s" % (journal.path, e))
+
+    def _journal_cleaned(self, records):
+        """
+        Journals records cleaned up by the handler
+        :param records:
+        :return:
+        """
+        journal = self._get_journal()
+        if journal is None or not records:
+            return
+        try:
+            journal.cleaned(records)
+        except (IOError, OSError) as e:
+            # Only makes the next recovery routine clean the records again
+            logger.warning("Could not write the journal %s: %s" % (journal.path, e))
+
+    def _recover_journal(self):
+        """
+        Cleans up stale records of the journal, left by crashed runs. Records of runs
+        with the same plugin configuration are cleaned up together, see drain_cleanup.
+        :return: number of records failed to clean up
+        """
+        from certbot_external_auth import drain
+        journal = self._get_journal()
+
+        groups = OrderedDict()
+        for entry, records in journal.stale():
+            key = drain.options_key(entry)
+            groups.setdefault(key, (entry, []))[1].extend(records)
+
+        lost = 0
+        for entry, records in groups.values():
+            cleanup_records = []
+            for record in records:
+                cur_record = jsonutil.Record(record)
+                cur_record[FIELD_CMD] = COMMAND_CLEANUP
+                cleanup_records.append(cur_record)
+
+            logger.info("Cleaning up %d records left by a crashed run" % len(cleanup_records))
+            try:
+                failed = drain.get_plugin(entry).drain_cleanup(cleanup_records)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Could not clean up records left by a crashed run: %s" % e, exc_info=True)
+                failed = cleanup_records
+
+            failed_ids = set(id(x) for x in failed)
+            journal.cleaned([x for x in cleanup_records if id(x) not in failed_ids])
+            lost += len(failed)
+
+        journal.compact()
+        return lost
+
+    @classmethod
+    def get_option_defaults(cls):
+        """
+        Returns default values of all plugin options, as argparse sets them
+        :return: option name -> default value
+        """
+        defaults = OrderedDict()
+
+        def add(name, **kwargs):
+            defaults[name] = kwargs.get('default', False if kwargs.get('action') == 'store_true' else None)
+        cls.add_parser_arguments(add)
+        return defaults
+
+    def _get_plugin_options(self):
+        """
+        Returns values of all plugin options
+        :return: option name -> value
+        """
+        options = OrderedDict()
+
+        def add(name, **kwargs):  # pylint: disable=unused-argument
+            options[name] = self.conf(name)
+        self.add_parser_arguments(add)
+        return options
+
+    def _cleanup_records(self, records):
+        """
+        Calls the handler cleanup for each record, at most max-parallel of them at once.
+        All records are attempted, a failure does not stop the others.
+        :param records:
+        :return: list of records the handler failed to clean up
+        """
+        if self._is_async_core_mode() and self._is_module_handler_mode():
+            results = self._call_handler_module_async("cleanup", records)
+        elif self._is_async_core_mode():
+            results = self._call_handler_async("cleanup", [self._get_json_to_kwargs(x) for x in records])
+        else:
+            results = self._run_parallel(lambda x: self._cleanup_record(x), records, self._get_max_parallel())
+
+        failed = [x for x, res in zip(records, results) if res is None]
+        for cur_record in failed:
+            logger.error("Handler failed to clean up the challenge for %s" % cur_record[FIELD_DOMAIN])
+        return failed
+
+    def _cleanup_record(self, cur_record):
+        """
+        Calls the handler cleanup for the record, errors are not raised
+        :param cur_record:
+        :return: None on failure, see _call_handler_record
+        """
+        try:
+            return self._call_handler_record("cleanup", cur_record)
+        except errors.PluginError as e:
+            logger.error("Error in calling the handler to do the cleanup stage: %s" % e)
+            return None
+
+    def _perform_deployed(self, achalls):
+        """
+        Passes challenges to the user / handler to deploy, depending on the mode.
+        :param achalls:
+        :return: responses in the achalls order
+        """
+        if self._is_batch_handler_mode() and not self.conf("test-mode"):
+            return self._perform_batch(achalls)
+
+        elif self._is_async_core_mode() and self._is_handler_mode() and not self.conf("test-mode"):
+            return self._perform_async(achalls)
+
+        elif self.conf("bulk-json") and self._is_json_mode() and not self.conf("test-mode"):
+            return self._perform_bulk_json(achalls)
+
+        # Handler invocations are independent, the rest of modes waits for the user on each challenge
+        max_parallel = self._get_max_parallel() if self._is_handler_mode() and not self.conf("test-mode") else 1
+        groups = list(self._group_achalls(achalls).values())
+        group_responses = self._run_parallel(self._perform_group, groups, max_parallel)
+
+        response_map = {}
+        for group, cur_responses in zip(groups, group_responses):
+            response_map.update(zip((id(x) for x in group), cur_responses))
+        return [response_map[id(x)] for x in achalls]
+
+    def _perform_http01_responder(self, achalls):
+        """
+        Serves http-01 challenges from the in-process responder
+        :param achalls:
+        :return: responses in the achalls order
+        """
+        responses = []
+        for achall in achalls:
+            response, validation = achall.response_and_validation()
+            responder = self._get_http01_responder(self._get_http01_port(response))
+            responder.add(achall.chall.path, validation)
+            responses.append(response)
+        return responses
+
+    def _cleanup_http01_responder(self, achalls):
+        """
+        Stops serving http-01 challenges, stops the responder when nothing is left to serve
+        :param achalls:
+        :return:
+        """
+        with RUN_STATE.lock:
+            responder = RUN_STATE.http_responder
+            if responder is None or not responder.is_running():
+                return
+
+            for achall in achalls:
+                responder.remove(achall.chall.path)
+            if len(responder) == 0:
+                responder.stop()
+                RUN_STATE.http_responder = None
+
+    def _get_http01_responder(self, port):
+        """
+        Returns running HTTP01 responder, starts it on the port if not running
+        :param port:
+        :return:
+        """
+        with RUN_STATE.lock:
+            responder = RUN_STATE.http_responder
+            if responder is not None and responder.is_running():
+                if port and responder.port != port:
+                    logger.warning("HTTP01 responder already runs on port %s, requested %s" % (responder.port, port))
+                return responder
+
+            from certbot_external_auth.responder import HTTP01Responder
+            responder = HTTP01Responder(port)
+            try:
+                with self.profiler.measure(profiler.STAGE_RESPONDER_START):
+                    responder.start()
+            except (socket.error, OSError) as e:
+                raise errors.PluginError("Could not start HTTP01 responder on port %s: %s" % (port, e))
+            RUN_STATE.http_responder = responder
+            return responder
+
+    def _perform_batch(self, achalls):
+        """
+        Deploys all challenges with one handler invocation.
+        Falls back to per-challenge calls if the handler does not implement the batch command.
+        :param achalls:
+        :return: responses in the achalls order
+        """
+        responses, records = self._get_perform_records(achalls)
+        for json_data in records:
+            self._json_out(json_data, True)
+
+        records = self._get_uncached_records(records)
+        if not records:
+            return responses
+
+        res = self._call_handler_batch("perform-batch", records)
+        if res is None:
+            raise errors.PluginError("Error in calling the handler to do the perform (challenge) stage")
+
+        if res is NotImplemented:
+            logger.info("Handler does not support batches, deploying challenges one by one")
+            self._run_parallel(lambda x: self._handler_perform(x), records, self._get_max_parallel())
+        else:
+            self._cache_records(records, res)
+
+        return responses
+
+    def _wait_for_propagation(self, achalls):
+        """
+        Polls TXT records of deployed dns-01 challenges until all are visible or timeout expires
+        :param achalls:
+        :return: dict txt_domain -> True if visible
+        """
+        expected = OrderedDict()
+        for achall in achalls:
+            if isinstance(achall.chall, challenges.DNS01):
+                txt_domain = achall.validation_domain_name(achall.domain)
+                expected.setdefault(txt_domain, set()).add(achall.validation(achall.account_key))
+        if not expected:
+            return {}
+
+        from certbot_external_auth import dnsutil
+        if not dnsutil.is_available():
+            logger.warning("Waiting for the DNS propagation requires optional "
+                           "dependency `dnspython` to be installed.")
+            return {}
+
+        waiter = dnsutil.PropagationWaiter(nameservers=self._get_dns_resolvers(),
+                                           timeout=self.conf("dns-propagation-timeout"))
+        with self.profiler.measure(profiler.STAGE_PROPAGATION_WAIT):
+            visible = waiter.wait(expected)
+
+        missing = [name for name in visible if not visible[name]]
+        if missing:
+            logger.warning("TXT records not visible after %s s: %s"
+                           % (self.conf("dns-propagation-timeout"), ', '.join(missing)))
+        else:
+            logger.info("All %s TXT records are visible" % len(visible))
+        return visible
+
+    def _verify_challenges(self, achalls, responses):
+        """
+        Self-verification of all deployed challenges, run concurrently with one overall deadline.
+        Failures are only reported, the CA is the one deciding.
+        :param achalls:
+        :param responses:
+        :return: list of verification statuses, in the achalls order
+        """
+        def verify(pair):
+            achall, response = pair
+            try:
+                with self.profiler.measure(profiler.STAGE_VERIFY, achall.domain):
+                    if isinstance(achall.chall, challenges.HTTP01):
+                        res = self._verify_http01_challenge(achall, response)
+                    else:
+                        res = self._verify_dns01_challenge(achall, response)
+            except Exception as e:
+                logger.debug("Self-verify of challenge for %s failed with exception: %s", achall.domain, e)
+                res = False
+
+            if res is None:
+                return self.VERIFY_UNKNOWN
+            return self.VERIFY_VALID if res else self.VERIFY_INVALID
+
+        statuses = self._run_parallel(verify, list(zip(achalls, responses)),
+                                      min(self.VERIFY_MAX_WORKERS, len(achalls)),
+                                      timeout=self.conf("verify-timeout"), default=self.VERIFY_TIMEOUT)
+
+        summary = ["Self-verification of challenges:"]
+        for achall, status in zip(achalls, statuses):
+            summary.append(" - %s (%s): %s" % (achall.domain, achall.typ, status))
+        if any(x in (self.VERIFY_INVALID, self.VERIFY_TIMEOUT) for x in statuses):
+            logger.warning('\n'.join(summary))
+        else:
+            logger.info('\n'.join(summary))
+        return statuses
+
+    def _perform_async(self, achalls):
+        """
+        Deploys all challenges with handler processes running as coroutines on the async core.
+        :param achalls:
+        :return: responses in the achalls order
+        """
+        responses, records = self._get_perform_records(achalls)
+        for json_data in records:
+            self._json_out(json_data, True)
+
+        records = self._get_uncached_records(records)
+        if self._is_module_handler_mode():
+            results = self._call_handler_module_async("perform", records)
+        else:
+            results = self._call_handler_async("perform", [self._get_json_to_kwargs(x) for x in records])
+        if any(x is None for x in results):
+            raise errors.PluginError("Error in calling the handler to do the perform (challenge) stage")
+
+        for json_data, res in zip(records, results):
+            self._cache_records([json_data], res)
+        return responses
+
+    def _perform_bulk_json(self, achalls):
+        """
+        Emits all perform records first, then waits for acknowledgements.
+        An empty line acknowledges all records, a line with a token (or a JSON object
+        with the token field) acknowledges the record with the token, in any order.
+        :param achalls:
+        :return: responses in the achalls order
+        """
+        responses, records = self._get_perform_records(achalls)
+        for json_data in records:
+            self._json_out(json_data, True)
+        self._flush_output()
+
+        pending = {}
+        for json_data in records:
+            for token in json_data.get(FIELD_TOKENS, [json_data[FIELD_TOKEN]]):
+                pending[token] = json_data
+
+        while pending:
+            try:
+                with self.profiler.measure(profiler.STAGE_INPUT_WAIT):
+                    line = six.moves.input("").strip()
+            except EOFError:
+                raise errors.PluginError("Input closed before all challenges were acknowledged")
+
+            if not line:
+                break
+
+            token = line
+            if line.startswith('{'):
+                try:
+                    token = json.loads(line).get(FIELD_TOKEN)
+                except ValueError:
+                    logger.warning("Could not parse the acknowledgement: %s" % line)
+                    continue
+
+            json_data = pending.get(token)
+            if json_data is None:
+                logger.warning("Acknowledgement for unknown token: %s" % token)
+                continue
+            for token in json_data.get(FIELD_TOKENS, [json_data[FIELD_TOKEN]]):
+                pending.pop(token, None)
+        return responses
+
+    def _get_perform_records(self, achalls):
+        """
+        Builds perform records of all challenges, grouped if enabled
+        :param achalls:
+        :return: responses in the achalls order, records
+        """
+        response_map, records = {}, []
+        for group in self._group_achalls(achalls).values():
+            group_records = []
+            for achall in group:
+                response, json_data = self._get_perform_json(achall)
+                response_map[id(achall)] = response
+                group_records.append(json_data)
+            records.append(self._get_group_record(group_records))
+        return [response_map[id(x)] for x in achalls], records
+
+    def _perform_group(self, group):
+        """
+        Deploys group of dns-01 challenges sharing the TXT domain with one record.
+        :param group: list of achalls
+        :return: responses in the group order
+        """
+        if len(group) == 1:
+            mapping = {"http-01": self._perform_http01_challenge,
+                       "dns-01": self._perform_dns01_challenge
+                       }
+            return [mapping[group[0].typ](group[0])]
+
+        responses, records = [], []
+        for achall in group:
+            response, json_data = self._get_perform_json(achall)
+            responses.append(response)
+            records.append(json_data)
+
+        json_data = self._get_group_record(records)
+        if self._is_json_mode():
+            self._json_out_and_wait(json_data)
+
+        elif self._is_handler_mode():
+            self._json_out(json_data, True)
+            self._handler_perform(json_data)
+
+        else:
+            raise errors.PluginError("Unknown plugin mode selected")
+        return responses
+
+    def _group_achalls(self, achalls):
+        """
+        Groups dns-01 achalls by the TXT domain if grouping is enabled, otherwise (and for http-01,
+        an order never has two http-01 challenges for the same name) each achall forms its own group. Groups are ordered by the zone if zones are resolved.
+        :param achalls:
+        :return: OrderedDict group key -> list of achalls
+        """
+        zones = self._get_zones(achalls)
+        if zones:
+            # Challenges of one zone are passed one after another, zone-less last
+            achalls = sorted(achalls, key=lambda x: (zones.get(id(x)) is None, zones.get(id(x)) or ''))
+
+        groups = OrderedDict()
+        for idx, achall in enumerate(achalls):
+            if self._is_grouping_mode() and isinstance(achall.chall, challenges.DNS01):
+                key = (achall.typ, achall.validation_domain_name(achall.domain).lower())
+            else:
+                key = idx
+            groups.setdefault(key, []).append(achall)
+        return groups
+
+    def _get_zones(self, achalls):
+        """
+        Finds zones of dns-01 challenges, lookups of distinct names run concurrently
+        :param achalls:
+        :return: dict id(achall) -> zone or None, empty if zones are not resolved
+        """
+        finder = self._get_zone_finder()
+        dns_achalls = [x for x in achalls if isinstance(x.chall, challenges.DNS01)]
+        if finder is None or not dns_achalls:
+            return {}
+
+        names = list(OrderedDict.fromkeys(x.validation_domain_name(x.domain) for x in dns_achalls))
+        with self.profiler.measure(profiler.STAGE_ZONE_LOOKUP):
+            zones = dict(zip(names, self._run_parallel(finder.find, names, min(self.VERIFY_MAX_WORKERS, len(names)))))
+        return dict((id(x), zones[x.validation_domain_name(x.domain)]) for x in dns_achalls)
+
+    def _get_zone(self, txt_domain):
+        """
+        Returns the zone of the TXT domain, None if not found or zones are not resolved
+        :param txt_domain:
+        :return:
+        """
+        finder = self._get_zone_finder()
+        return None if finder is None else finder.find(txt_domain)
+
+    def _get_zone_finder(self):
+        """
+        Returns the zone finder, shared by the whole run so lookups are memoized across lineages
+        :return: None if zones are not resolved
+        """
+        if not self.conf("dns-zone-map") and not self.conf("dns-zone-lookup"):
+            return None
+
+        nameservers = self._get_dns_resolvers()
+        key = (self.conf("dns-zone-map"), bool(self.conf("dns-zone-lookup")), tuple(nameservers))
+        with RUN_STATE.lock:
+            finder = RUN_STATE.zone_finders.get(key)
+            if finder is not None:
+                return finder
+
+            from certbot_external_auth import dnsutil
+            zones = []
+            if self.conf("dns-zone-map"):
+                try:
+                    zones = dnsutil.read_zone_map(self.conf("dns-zone-map"))
+                except (IOError, OSError) as e:
+                    raise errors.PluginError("Could not read the zone map %s: %s" % (self.conf("dns-zone-map"), e))
+
+            finder = dnsutil.ZoneFinder(zones, lookup=self.conf("dns-zone-lookup"), nameservers=nameservers)
+            RUN_STATE.zone_finders[key] = finder
+            return finder
+
+    def _get_group_record(self, records):
+        """
+        Merges records of one group. The first record is extended with lists of
+        all domains, tokens and validations.
+        :param records:
+        :return:
+        """
+        if len(records) == 1:
+            return records[0]
 
-            if isinstance(achall.chall, challenges.HTTP01):
-                self._cleanup_http01_challenge(achall)
+        json_data = jsonutil.Record(records[0])
+        json_data[FIELD_DOMAINS] = [x[FIELD_DOMAIN] for x in records]
+        json_data[FIELD_TOKENS] = [x[FIELD_TOKEN] for x in records]
+        json_data[FIELD_VALIDATIONS] = [x[FIELD_VALIDATION] for x in records]
+        return json_data
 
-        if self._is_classic_handler_mode() \
-                and not self._is_handler_broken() \
-                and self._call_handler("post-cleanup") is None:
-            raise errors.PluginError("Error in calling the handler to do the post-cleanup stage")
+    def _cleanup_batch_records(self, records):
+        """
+        Cleans the records with one handler invocation, one by one if the handler does not support batches
+        :param records:
+        :return: list of records the handler failed to clean up
+        """
+        res = self._call_handler_batch("cleanup-batch", records)
+        if res is NotImplemented:
+            logger.info("Handler does not support batches, cleaning challenges one by one")
+            return self._cleanup_records(records)
+        return records if res is None else []
 
     def _get_cleanup_json(self, achall):
         response, validation = achall.response_and_validation()
 
-        cur_record = OrderedDict()
+        cur_record = jsonutil.Record()
         cur_record[FIELD_CMD] = COMMAND_CLEANUP
         cur_record[FIELD_TYPE] = achall.chall.typ
 
         if isinstance(achall.chall, challenges.HTTP01):
             pass
         elif isinstance(achall.chall, challenges.DNS01):
-            pass
+            zone = self._get_zone(achall.validation_domain_name(achall.domain))
+            if zone is not None:
+                cur_record[FIELD_ZONE] = zone
 
         cur_record[FIELD_STATUS] = None
         cur_record[FIELD_DOMAIN] = achall.domain
-        cur_record[FIELD_TOKEN] = b64.b64encode(achall.chall.token)
-        if type(cur_record[FIELD_TOKEN]) == bytes:
-            cur_record[FIELD_TOKEN] = cur_record[FIELD_TOKEN].decode('UTF-8')
+        cur_record[FIELD_TOKEN] = jsonutil.to_str(b64.b64encode(achall.chall.token))
         cur_record[FIELD_VALIDATION] = validation if isinstance(validation, basestring) else ''
-        cur_record[FIELD_KEY_AUTH] = response.key_authorization.decode('UTF-8') if isinstance(response.key_authorization, bytes) else response.key_authorization
+        cur_record[FIELD_KEY_AUTH] = jsonutil.to_str(response.key_authorization)
         cur_record[FIELD_VALIDATED] = None
         cur_record[FIELD_ERROR] = None
 
@@ -390,77 +1270,84 @@ s.serve_forever()" """
         """
         Augments json data before passing to the handler script.
         Prefixes all keys with cbot_ value to avoid clashes + serializes
-        itself to JSON - for JSON parsing stuff.
+        itself to JSON - for JSON parsing stuff. The record JSON emitted
+        on the stdout is reused, see jsonutil.Record.
 
         :param json_data:
         :return:
         """
         n_data = OrderedDict()
-        for k in json_data:
-            val = json_data[k]
+        for k, val in json_data.items():
             if k == 'command':
                 continue
-            if isinstance(val, float):
+            if isinstance(val, basestring):
+                pass
+            elif isinstance(val, float):
                 val = str(math.ceil(val))
-            if not isinstance(val, (str, basestring)):
+            elif isinstance(val, (list, tuple)):
+                val = ' '.join(str(x) for x in val)
+            else:
                 val = str(val)
-            if val is not None:
-                n_data[k] = val
-                n_data['cbot_' + k] = val
+            n_data[k] = val
+            n_data['cbot_' + k] = val
 
         n_data['cbot_json'] = self._json_dumps(json_data)
         return n_data
 
-    def _perform_http01_challenge(self, achall):
+    def _get_perform_json(self, achall):
+        """
+        Builds the perform record for the challenge
+        :param achall:
+        :return: response, json record
+        """
+        if isinstance(achall.chall, challenges.HTTP01):
+            return self._get_http01_json(achall)
+        return self._get_dns01_json(achall)
+
+    def _get_http01_port(self, response):
+        """
+        Returns port the http-01 challenge is served on
+        :param response:
+        :return:
+        """
+        return (response.port if self.config.http01_port is None
+                else int(self.config.http01_port))
+
+    def _get_http01_json(self, achall):
+        """
+        Builds the perform record for the http-01 challenge
+        :param achall:
+        :return: response, json record
+        """
         # same path for each challenge response would be easier for
         # users, but will not work if multiple domains point at the
         # same server: default command doesn't support virtual hosts
         response, validation = achall.response_and_validation()
-        port = (response.port if self.config.http01_port is None
-                else int(self.config.http01_port))
+        port = self._get_http01_port(response)
 
         command = self.CMD_TEMPLATE.format(
             root=self._root, achall=achall, response=response,
-            validation=pipes.quote(validation),
+            validation=shell_quote(validation),
             encoded_token=achall.chall.encode("token"),
             port=port)
 
-        json_data = OrderedDict()
+        json_data = jsonutil.Record()
         json_data[FIELD_CMD] = COMMAND_PERFORM
         json_data[FIELD_TYPE] = achall.chall.typ
         json_data[FIELD_DOMAIN] = achall.domain
-        json_data[FIELD_TOKEN] = b64.b64encode(achall.chall.token)
-        json_data[FIELD_VALIDATION] = validation
+        json_data[FIELD_TOKEN] = jsonutil.to_str(b64.b64encode(achall.chall.token))
+        json_data[FIELD_VALIDATION] = jsonutil.to_str(validation)
         json_data[FIELD_URI] = achall.chall.uri(achall.domain)
         json_data['command'] = command
-        json_data[FIELD_KEY_AUTH] = response.key_authorization
+        json_data[FIELD_KEY_AUTH] = jsonutil.to_str(response.key_authorization)
+        return response, json_data
 
-        json_data = self._json_sanitize_dict(json_data)
-
-        if self.conf("test-mode"):
-            logger.debug("Test mode. Executing the manual command: %s", command)
-            # sh shipped with OS X does't support echo -n, but supports printf
-            try:
-                self._httpd = subprocess.Popen(
-                    command,
-                    # don't care about setting stdout and stderr,
-                    # we're in test mode anyway
-                    shell=True,
-                    executable=None,
-                    # "preexec_fn" is UNIX specific, but so is "command"
-                    preexec_fn=os.setsid)
-            except OSError as error:  # ValueError should not happen!
-                logger.debug(
-                    "Couldn't execute manual command: %s", error, exc_info=True)
-                return False
-            logger.debug("Manual command running as PID %s.", self._httpd.pid)
-            # give it some time to bootstrap, before we try to verify
-            # (cert generation in case of simpleHttpS might take time)
-            self._test_mode_busy_wait(port)
+    def _perform_http01_challenge(self, achall):
+        response, json_data = self._get_http01_json(achall)
+        validation = json_data[FIELD_VALIDATION]
+        command = json_data['command']
 
-            if self._httpd.poll() is not None:
-                raise errors.Error("Couldn't execute manual command")
-        else:
+        if not self.conf("test-mode"):
             if self._is_text_mode():
                 self._notify_and_wait(
                     self._get_message(achall).format(
@@ -474,32 +1361,47 @@ s.serve_forever()" """
 
             elif self._is_handler_mode():
                 self._json_out(json_data, True)
-                if self._call_handler("perform", **(self._get_json_to_kwargs(json_data))) is None:
-                    raise errors.PluginError("Error in calling the handler to do the perform (challenge) stage")
+                self._handler_perform(json_data)
 
             else:
                 raise errors.PluginError("Unknown plugin mode selected")
 
-        if not response.simple_verify(
-                achall.chall, achall.domain,
-                achall.account_key.public_key(), self.config.http01_port):
-            logger.warning("Self-verify of challenge failed.")
-
         return response
 
-    def _perform_dns01_challenge(self, achall):
+    def _verify_http01_challenge(self, achall, response):
+        """
+        Self-verification of the deployed http-01 challenge
+        :param achall:
+        :param response:
+        :return: True if verified
+        """
+        return response.simple_verify(
+            achall.chall, achall.domain,
+            achall.account_key.public_key(), self.config.http01_port)
+
+    def _get_dns01_json(self, achall):
+        """
+        Builds the perform record for the dns-01 challenge
+        :param achall:
+        :return: response, json record
+        """
         response, validation = achall.response_and_validation()
 
-        json_data = OrderedDict()
+        json_data = jsonutil.Record()
         json_data[FIELD_CMD] = COMMAND_PERFORM
         json_data[FIELD_TYPE] = achall.chall.typ
         json_data[FIELD_DOMAIN] = achall.domain
-        json_data[FIELD_TOKEN] = b64.b64encode(achall.chall.token)
-        json_data[FIELD_VALIDATION] = validation
+        json_data[FIELD_TOKEN] = jsonutil.to_str(b64.b64encode(achall.chall.token))
+        json_data[FIELD_VALIDATION] = jsonutil.to_str(validation)
         json_data[FIELD_TXT_DOMAIN] = achall.validation_domain_name(achall.domain)
-        json_data[FIELD_KEY_AUTH] = response.key_authorization
+        zone = self._get_zone(json_data[FIELD_TXT_DOMAIN])
+        if zone is not None:
+            json_data[FIELD_ZONE] = zone
+        json_data[FIELD_KEY_AUTH] = jsonutil.to_str(response.key_authorization)
+        return response, json_data
 
-        json_data = self._json_sanitize_dict(json_data)
+    def _perform_dns01_challenge(self, achall):
+        response, json_data = self._get_dns01_json(achall)
 
         if not self.conf("test-mode"):
             if self._is_text_mode():
@@ -514,37 +1416,162 @@ s.serve_forever()" """
 
             elif self._is_handler_mode():
                 self._json_out(json_data, True)
-                if self._call_handler("perform", **(self._get_json_to_kwargs(json_data))) is None:
-                    raise errors.PluginError("Error in calling the handler to do the perform (challenge) stage")
+                self._handler_perform(json_data)
 
             else:
                 raise errors.PluginError("Unknown plugin mode selected")
 
+        return response
+
+    def _verify_dns01_challenge(self, achall, response):
+        """
+        Self-verification of the deployed dns-01 challenge
+        :param achall:
+        :param response:
+        :return: True if verified, None if the verification is not possible
+        """
         try:
-            verification_status = response.simple_verify(
+            verified = response.simple_verify(
                 achall.chall, achall.domain,
                 achall.account_key.public_key())
         except acme_errors.DependencyError:
             logger.warning("Self verification requires optional "
                            "dependency `dnspython` to be installed.")
-        else:
-            if not verification_status:
-                logger.warning("Self-verify of challenge failed.")
+            return None
+        if not verified or not self.conf("dns-self-verify"):
+            return verified
 
-        return response
+        dns_cache = self._get_dns_cache()
+        if dns_cache is None:
+            logger.warning("Self verification requires optional "
+                           "dependency `dnspython` to be installed.")
+            return None
+        return dns_cache.verify_txt(achall.validation_domain_name(achall.domain),
+                                    achall.validation(achall.account_key))
+
+    def _get_dns_cache(self):
+        """
+        Returns the DNS cache shared by the whole run, the zone map is used if configured
+        :return: None if dnspython is not installed
+        """
+        from certbot_external_auth import dnsutil
+        if not dnsutil.is_available():
+            return None
+
+        nameservers = self._get_dns_resolvers()
+        zone_finder = self._get_zone_finder()
+        key = (self.conf("dns-zone-map"), tuple(nameservers))
+        with RUN_STATE.lock:
+            dns_cache = RUN_STATE.dns_caches.get(key)
+            if dns_cache is None:
+                dns_cache = dnsutil.DnsCache(nameservers, zones=zone_finder.zones if zone_finder else None)
+                RUN_STATE.dns_caches[key] = dns_cache
+            return dns_cache
+
+    def _handler_perform(self, json_data):
+        """
+        Calls the handler to deploy one challenge record
+        :param json_data:
+        :return:
+        """
+        if not self._get_uncached_records([json_data]):
+            return
+
+        res = self._call_handler_record("perform", json_data)
+        if res is None:
+            raise errors.PluginError("Error in calling the handler to do the perform (challenge) stage")
+        self._cache_records([json_data], res)
+
+    def _get_handler_cache(self):
+        """
+        Returns the handler result cache shared by the whole run, None if not enabled
+        :return:
+        """
+        if not self.conf("handler-cache") or not self._is_handler_mode() or self.conf("test-mode"):
+            return None
+
+        path = os.path.abspath(self.conf("handler-cache-file") or os.path.join(self.config.work_dir,
+                                                                               'external-auth-cache.json'))
+        key = (path, self.conf("handler-cache-ttl"))
+        with RUN_STATE.lock:
+            if key not in RUN_STATE.handler_caches:
+                from certbot_external_auth.cache import ResultCache
+                RUN_STATE.handler_caches[key] = ResultCache(path, self.conf("handler-cache-ttl"))
+            return RUN_STATE.handler_caches[key]
+
+    def _get_record_cache_key(self, json_data):
+        """
+        Returns (domain, validation) identifying the deployed record
+        :param json_data:
+        :return:
+        """
+        validations = json_data.get(FIELD_VALIDATIONS, [json_data.get(FIELD_VALIDATION)])
+        return json_data.get(FIELD_DOMAIN), ' '.join(str(x) for x in validations)
 
-    def _cleanup_http01_challenge(self, achall):
-        # pylint: disable=missing-docstring,unused-argument
-        if self.conf("test-mode"):
-            assert self._httpd is not None, (
-                "cleanup() must be called after perform()")
-            if self._httpd.poll() is None:
-                logger.debug("Terminating manual command process")
-                os.killpg(self._httpd.pid, signal.SIGTERM)
+    def _get_uncached_records(self, records):
+        """
+        Returns records not yet deployed by the handler according to the cache
+        :param records:
+        :return:
+        """
+        handler_cache = self._get_handler_cache()
+        if handler_cache is None:
+            return records
+
+        res = []
+        for json_data in records:
+            domain, validation = self._get_record_cache_key(json_data)
+            if handler_cache.get("perform", domain, validation) is None:
+                res.append(json_data)
             else:
-                logger.debug("Manual command process already terminated "
-                             "with %s code", self._httpd.returncode)
-            shutil.rmtree(self._root)
+                logger.info("Handler already deployed the record for %s, skipping perform" % domain)
+        return res
+
+    def _is_deployed_cached(self, achalls):
+        """
+        Returns true if all challenges were already deployed by the handler according to the cache
+        :param achalls:
+        :return:
+        """
+        if not achalls or self._get_handler_cache() is None:
+            return False
+        return not self._get_uncached_records(self._get_perform_records(achalls)[1])
+
+    def _cache_records(self, records, result):
+        """
+        Marks the records as deployed by the handler
+        :param records:
+        :param result: handler stdout
+        :return:
+        """
+        handler_cache = self._get_handler_cache()
+        if handler_cache is None or result is NotImplemented:
+            return
+        for json_data in records:
+            domain, validation = self._get_record_cache_key(json_data)
+            handler_cache.put("perform", domain, validation, result)
+
+    def _invalidate_cached_records(self, records):
+        """
+        Removes the cleaned up records from the cache
+        :param records:
+        :return:
+        """
+        handler_cache = self._get_handler_cache()
+        if handler_cache is None:
+            return
+        for json_data in records:
+            domain, validation = self._get_record_cache_key(json_data)
+            handler_cache.invalidate("perform", domain, validation)
+
+    def _save_handler_cache(self):
+        """
+        Stores the handler cache if enabled
+        :return:
+        """
+        handler_cache = self._get_handler_cache()
+        if handler_cache is not None:
+            handler_cache.save()
 
     #
     # Installer section
@@ -554,7 +1581,7 @@ s.serve_forever()" """
         return []
 
     def deploy_cert(self, domain, cert_path, key_path, chain_path, fullchain_path):
-        cur_record = OrderedDict()
+        cur_record = jsonutil.Record()
         cur_record[FIELD_CMD] = COMMAND_DEPLOY_CERT
         cur_record[FIELD_DOMAIN] = domain
         cur_record[FIELD_CERT_PATH] = cert_path
@@ -566,11 +1593,14 @@ s.serve_forever()" """
 
         if self._is_json_mode() or self._is_handler_mode():
             self._json_out(cur_record, True)
+            self._flush_output()
 
         hook_cmd = "deploy_cert" if cur_record[FIELD_CERT_TIMESTAMP] >= cur_record[FIELD_TIMESTAMP] else 'unchanged_cert'
-        if self._is_handler_mode() and self._call_handler(hook_cmd, **(self._get_json_to_kwargs(cur_record))) is None:
-            raise errors.PluginError("Error in calling the handler to do the deploy_cert stage")
-        pass
+        if self._is_handler_mode():
+            with self.profiler.measure(profiler.STAGE_DEPLOY_CERT, domain):
+                res = self._call_handler_record(hook_cmd, cur_record)
+            if res is None:
+                raise errors.PluginError("Error in calling the handler to do the deploy_cert stage")
 
     def enhance(self, domain, enhancement, options=None):
         pass  # pragma: no cover
@@ -588,12 +1618,21 @@ s.serve_forever()" """
         cur_record['temporary'] = temporary
         if self._is_json_mode() or self._is_handler_mode():
             self._json_out(cur_record, True)
+            self._flush_output()
 
     def rollback_checkpoints(self, rollback=1):
        pass  # pragma: no cover
 
     def recovery_routine(self):
-        pass  # pragma: no cover
+        """
+        Cleans up records deployed by crashed runs, see --journal
+        :return:
+        """
+        if self._is_journal_mode() and not self.conf("test-mode"):
+            try:
+                self._recover_journal()
+            except (IOError, OSError) as e:
+                logger.error("Journal recovery failed: %s" % e)
 
     def view_config_changes(self):
         pass  # pragma: no cover
@@ -606,6 +1645,7 @@ s.serve_forever()" """
         cur_record[FIELD_CMD] = COMMAND_RESTART
         if self._is_json_mode() or self._is_handler_mode():
             self._json_out(cur_record, True)
+            self._flush_output()
 
     #
     # Caller
@@ -619,9 +1659,138 @@ s.serve_forever()" """
         :param kwargs:
         :return:
         """
-        env = dict(os.environ)
-        env.update(kwargs)
+        if self._is_module_handler_mode():
+            return self._call_handler_module(command, kwargs or None)
+
+        command, args = self._get_handler_command(command, args, kwargs)
+        env_vars, stdin_data, data_file = self._get_handler_data(kwargs)
+        try:
+            return self._invoke_handler(command, args, env_vars, stdin_data, domain=kwargs.get(FIELD_DOMAIN))
+        finally:
+            self._remove_handler_data_file(data_file)
+
+    def _call_handler_record(self, command, json_data):
+        """
+        Invokes the handler for the record. The Python handler gets the record itself,
+        the handler program gets it serialized, see _get_json_to_kwargs
+        :param command:
+        :param json_data:
+        :return: None on failure, NotImplemented if not supported by the handler, handler output otherwise
+        """
+        if self._is_module_handler_mode():
+            return self._call_handler_module(command, json_data)
+        return self._call_handler(command, **(self._get_json_to_kwargs(json_data)))
+
+    def _call_handler_module(self, command, json_data=None):
+        """
+        Calls the Python handler method named after the command, e.g., perform, pre_perform, perform_batch.
+        Exception raised by the method is a failure. Missing method or NotImplemented returned means
+        the command is not supported. Coroutine methods are run on the async core.
+        :param command:
+        :param json_data: record, list of records for batch commands, None for hooks
+        :return: None on failure, NotImplemented if not supported by the handler, method result otherwise
+        """
+        method = self._get_module_handler_method(command)
+        if method is None:
+            logger.debug("Python handler does not implement the command %s" % command)
+            return NotImplemented
+
+        domain = json_data.get(FIELD_DOMAIN) if isinstance(json_data, dict) else None
+        try:
+            with self.profiler.measure(profiler.STAGE_HANDLER_RUN, domain):
+                res = method() if json_data is None else method(json_data)
+                if hasattr(inspect, 'isawaitable') and inspect.isawaitable(res):
+                    res = self._get_async_core().run(res)
+        except Exception as e:
+            self.profiler.record(profiler.STAGE_HANDLER_FAILURE, 0, domain)
+            logger.error("Python handler failed to process %s: %s" % (command, e), exc_info=True)
+            return None
+        return self._module_handler_result(command, res)
+
+    def _call_handler_module_async(self, command, records):
+        """
+        Calls the Python handler for each record concurrently. Coroutine methods run on the async core,
+        plain methods in worker threads.
+        :param command:
+        :param records:
+        :return: list of results, see _call_handler_module
+        """
+        method = self._get_module_handler_method(command)
+        if method is None or not inspect.iscoroutinefunction(method):
+            return self._run_parallel(lambda x: self._call_handler_module(command, x), records,
+                                      self._get_max_parallel())
+
+        with self.profiler.measure(profiler.STAGE_HANDLER_RUN):
+            outputs = self._get_async_core().map(method, records, self._get_max_parallel())
+
+        results = []
+        for json_data, res in zip(records, outputs):
+            if isinstance(res, Exception):
+                self.profiler.record(profiler.STAGE_HANDLER_FAILURE, 0, json_data.get(FIELD_DOMAIN))
+                logger.error("Python handler failed to process %s for %s: %s"
+                             % (command, json_data.get(FIELD_DOMAIN), res))
+                results.append(None)
+            else:
+                results.append(self._module_handler_result(command, res))
+        return results
+
+    def _module_handler_result(self, command, res):
+        """
+        Interprets the Python handler method result
+        :param command:
+        :param res:
+        :return: NotImplemented if not supported by the handler, the result otherwise ('' for None)
+        """
+        if res is NotImplemented:
+            logger.warning("Python handler does not implement the command %s", command)
+            return NotImplemented
+
+        logger.info("Python handler %s finished: %s", command, res)
+        return '' if res is None else res
+
+    def _get_module_handler(self):
+        """
+        Returns the Python handler, imported and instantiated once per run.
+        The spec is pkg.module:attr, the attribute is a class instantiated without arguments
+        or any object with the handler methods. Without attr the module itself is the handler.
+        :return:
+        """
+        spec = self.conf("handler-module")
+        with RUN_STATE.lock:
+            handler = RUN_STATE.module_handlers.get(spec)
+            if handler is not None:
+                return handler
+
+            module_name, _, attr = spec.partition(':')
+            try:
+                handler = importlib.import_module(module_name)
+                for name in attr.split('.') if attr else []:
+                    handler = getattr(handler, name)
+                if inspect.isclass(handler):
+                    handler = handler()
+            except Exception as e:
+                raise errors.PluginError("Could not load the Python handler %s: %s" % (spec, e))
+
+            RUN_STATE.module_handlers[spec] = handler
+            return handler
+
+    def _get_module_handler_method(self, command):
+        """
+        Returns the Python handler method for the command, None if not implemented
+        :param command: e.g., pre-perform, perform-batch
+        :return:
+        """
+        method = getattr(self._get_module_handler(), command.replace('-', '_'), None)
+        return method if callable(method) else None
 
+    def _get_handler_command(self, command, args, kwargs):
+        """
+        Translates the handler command and arguments for the selected handler mode
+        :param command:
+        :param args:
+        :param kwargs:
+        :return: command, args
+        """
         # Dehydrated compatibility mode - translate commands
         if self._is_dehydrated_dns():
             auth_cmd_map = {'perform': 'deploy_challenge', 'cleanup': 'clean_challenge'}
@@ -642,11 +1811,510 @@ s.serve_forever()" """
             else:
                 logger.info("Dehydrated mode does not support this handler command: %s" % command)
 
-        proc = None
-        stdout, stderr = None, None
+        return command, list(args)
+
+    def _call_handler_async(self, command, kwargs_list):
+        """
+        Invokes the handler for each of kwargs concurrently on the async core.
+        Handler daemon does not use processes, its requests are dispatched by worker threads.
+        :param command:
+        :param kwargs_list:
+        :return: list of results, see _invoke_handler
+        """
+        if self._is_daemon_handler_mode():
+            return self._run_parallel(lambda x: self._call_handler(command, **x), kwargs_list,
+                                      self._get_max_parallel())
+
+        if not self._check_handler_file():
+            return [None] * len(kwargs_list)
+
+        from certbot_external_auth import aio
+        invocations = []
+        data_files = []
+        for kwargs in kwargs_list:
+            cur_command, args = self._get_handler_command(command, (), kwargs)
+            env_vars, stdin_data, data_file = self._get_handler_data(kwargs)
+            data_files.append(data_file)
+            if isinstance(stdin_data, six.text_type):
+                stdin_data = stdin_data.encode('UTF-8')
+            invocations.append((cur_command, [self._get_handler(), cur_command] + args,
+                                self._get_handler_env(env_vars), stdin_data, kwargs.get(FIELD_DOMAIN)))
+
+        def run(invocation):
+            captures = self._get_handler_captures(invocation[0]) if self._is_stream_output_mode() else None
+            return aio.run_process(invocation[1], env=invocation[2], stdin_data=invocation[3],
+                                   timeout=self._get_handler_timeout(invocation[0]),
+                                   kill_grace=self.HANDLER_KILL_GRACE, captures=captures,
+                                   profiler=self.profiler, domain=invocation[4])
+
+        # Failed invocations are retried in rounds
+        results = [None] * len(invocations)
+        pending = list(range(len(invocations)))
+        attempt = 0
+        try:
+            while pending:
+                outputs = self._get_async_core().map(run, [invocations[i] for i in pending], self._get_max_parallel())
+                failed = []
+                for idx, output in zip(pending, outputs):
+                    cur_command, arg_list, _, _, domain = invocations[idx]
+                    if isinstance(output, Exception):
+                        self._handler_invocation_failed(arg_list, output)
+                        continue
+                    results[idx] = self._handler_process_result(cur_command, arg_list, output, domain)
+                    if results[idx] is None:
+                        failed.append(idx)
+
+                pending = [i for i in failed if self._take_handler_retry(invocations[i][0], attempt)]
+                if pending:
+                    self._handler_retry_backoff(attempt)
+                attempt += 1
+        finally:
+            for data_file in data_files:
+                self._remove_handler_data_file(data_file)
+        return results
+
+    def _call_handler_batch(self, command, records):
+        """
+        Invokes the handler once for all records. Records are passed as a JSON array on stdin,
+        the handler answers with one JSON line per record: {"token": "...", "status": "ok"}.
+        :param command:
+        :param records:
+        :return: None on failure, NotImplemented if not supported by the handler, stdout otherwise
+        """
+        if self._is_module_handler_mode():
+            # Python handler returns token -> status record, or None if all records are processed
+            stdout = self._call_handler_module(command, records)
+            if stdout is None or stdout is NotImplemented:
+                return stdout
+            if not isinstance(stdout, dict):
+                stdout = dict((x[FIELD_TOKEN], 'ok') for x in records)
+            statuses = dict((token, status if isinstance(status, dict) else {FIELD_STATUS: status})
+                            for token, status in stdout.items())
+
+        else:
+            env_vars = {'cbot_batch_size': str(len(records))}
+
+            # Status lines are needed, output is not truncated
+            stdout = self._invoke_handler(command, [], env_vars, stdin_data=self._json_dumps(records) + '\n',
+                                          full_output=True)
+            if stdout is None or stdout is NotImplemented:
+                return stdout
+            statuses = self._parse_batch_statuses(stdout)
+
+        failed = []
+        for record in records:
+            status = statuses.get(record[FIELD_TOKEN])
+            if status is None or status.get(FIELD_STATUS) != 'ok':
+                failed.append(record)
+                logger.error("Handler failed to process %s for %s: %s"
+                             % (command, record[FIELD_DOMAIN],
+                                'no status reported' if status is None else status.get(FIELD_ERROR)))
+
+        return None if failed else stdout
+
+    def _parse_batch_statuses(self, stdout):
+        """
+        Parses per-record status lines of the batch handler.
+        Lines not being JSON objects are skipped.
+        :param stdout:
+        :return: token -> status record
+        """
+        if isinstance(stdout, bytes):
+            stdout = stdout.decode('UTF-8', 'replace')
+
+        statuses = {}
+        for line in stdout.splitlines():
+            line = line.strip()
+            if not line.startswith('{'):
+                continue
+            try:
+                status = json.loads(line)
+            except ValueError:
+                logger.debug("Could not parse handler status line: %s" % line)
+                continue
+            if FIELD_TOKEN in status:
+                statuses[status[FIELD_TOKEN]] = status
+        return statuses
+
+    def _invoke_handler(self, command, args, env_vars, stdin_data=None, domain=None, full_output=False):
+        """
+        Runs the handler script process, or passes the request to the handler daemon
+        :param command:
+        :param args:
+        :param env_vars: variables added to the handler environment
+        :param stdin_data: data written to the handler stdin
+        :param domain: domain the invocation is for, for the profiler
+        :param full_output: the whole stdout is returned even in the streaming mode
+        :return: None on failure, NotImplemented if not supported by the handler, stdout otherwise
+        """
+        if not self._check_handler_file():
+            return None
+
+        if self._is_daemon_handler_mode():
+            return self._invoke_handler_daemon(command, args, env_vars, stdin_data, domain)
+
         arg_list = [self._get_handler(), command] + list(args)
+        env = self._get_handler_env(env_vars)
+        if isinstance(stdin_data, six.text_type):
+            stdin_data = stdin_data.encode('UTF-8')
+
+        # The handler invocation, failed or timed out one is retried
+        timeout = self._get_handler_timeout(command)
+        stream = self._is_stream_output_mode() and not full_output
+        attempt = 0
+        while True:
+            try:
+                captures = self._get_handler_captures(command) if stream else None
+                output = self._run_handler_process(arg_list, env, stdin_data, timeout, domain, captures)
+            except Exception as e:
+                self._handler_invocation_failed(arg_list, e)
+                return None
+
+            res = self._handler_process_result(command, arg_list, output, domain)
+            if res is not None or not self._take_handler_retry(command, attempt):
+                return res
+            self._handler_retry_backoff(attempt)
+            attempt += 1
+
+    def _run_handler_process(self, arg_list, env, stdin_data, timeout, domain=None, captures=None):
+        """
+        Runs the handler process in its own process group. The group is killed after the timeout.
+        :param arg_list:
+        :param env:
+        :param stdin_data: bytes
+        :param timeout: seconds, None for no limit
+        :param domain: for the profiler
+        :param captures: (stdout, stderr) OutputCapture streaming the outputs, whole outputs are buffered if None
+        :return: (returncode, stdout, stderr), returncode is None if the handler timed out
+        """
+        # preexec_fn is not safe with threads, Python 2 has no start_new_session
+        if six.PY2:
+            session_kwargs = {'preexec_fn': os.setsid if hasattr(os, 'setsid') else None}
+        else:
+            session_kwargs = {'start_new_session': True}
+
+        with self.profiler.measure(profiler.STAGE_HANDLER_SPAWN, domain):
+            proc = subprocess.Popen(arg_list,
+                                    stdin=subprocess.PIPE if stdin_data is not None else None,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    env=env,
+                                    **session_kwargs)
+
+        killer = None
+        if timeout:
+            killer = threading.Timer(timeout, self._kill_handler_process, (proc,))
+            killer.daemon = True
+            killer.start()
+
+        try:
+            with self.profiler.measure(profiler.STAGE_HANDLER_RUN, domain):
+                if captures is None:
+                    stdout, stderr = proc.communicate(stdin_data)
+                else:
+                    stdout, stderr = self._communicate_streaming(proc, stdin_data, captures)
+        finally:
+            if killer is not None:
+                killer.cancel()
 
-        # Check if the handler exists
+        if getattr(proc, '_cbot_killed', False):
+            return None, stdout, stderr
+        return proc.returncode, stdout, stderr
+
+    def _communicate_streaming(self, proc, stdin_data, captures):
+        """
+        Feeds the stdin and reads outputs incrementally into the captures
+        :param proc:
+        :param stdin_data:
+        :param captures: (stdout, stderr) OutputCapture
+        :return: (stdout, stderr) kept by the captures
+        """
+        readers = [threading.Thread(target=capture.pump, args=(stream, cur_capture))
+                   for stream, cur_capture in zip((proc.stdout, proc.stderr), captures)]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        if proc.stdin is not None:
+            try:
+                proc.stdin.write(stdin_data)
+                proc.stdin.close()
+            except (IOError, OSError) as e:
+                logger.debug("Could not write handler stdin: %s" % e)
+
+        for reader in readers:
+            reader.join()
+        proc.wait()
+        return captures[0].getvalue(), captures[1].getvalue()
+
+    def _get_handler_captures(self, command):
+        """
+        Returns stdout and stderr captures logging the handler output lines live
+        :param command:
+        :return: (stdout, stderr) OutputCapture
+        """
+        def log_line(name):
+            return lambda line: logger.info("Handler %s %s: %s", command, name, line.decode('UTF-8', 'replace'))
+
+        limit = self.conf("handler-output-limit")
+        return capture.OutputCapture(limit, log_line('stdout')), capture.OutputCapture(limit, log_line('stderr'))
+
+    def _kill_handler_process(self, proc):
+        """
+        Terminates the handler process group, kills it if it does not terminate in the grace period
+        :param proc:
+        :return:
+        """
+        if proc.poll() is not None:
+            return
+        proc._cbot_killed = True
+        logger.warning("Handler PID %s timed out, terminating its process group" % proc.pid)
+        self._signal_handler_process(proc, signal.SIGTERM)
+
+        deadline = time.time() + self.HANDLER_KILL_GRACE
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if proc.poll() is None:
+            logger.warning("Handler PID %s did not terminate, killing its process group" % proc.pid)
+            self._signal_handler_process(proc, getattr(signal, 'SIGKILL', signal.SIGTERM))
+
+    def _signal_handler_process(self, proc, sig):
+        """
+        Sends the signal to the handler process group, to the process only if groups are not supported
+        :param proc:
+        :param sig:
+        :return:
+        """
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(proc.pid, sig)
+            else:
+                proc.send_signal(sig)
+        except OSError as e:
+            logger.debug("Could not signal handler PID %s: %s" % (proc.pid, e))
+
+    def _handler_process_result(self, command, arg_list, output, domain=None):
+        """
+        Interprets the handler process output, timed out process is a failure
+        :param command:
+        :param arg_list:
+        :param output: (returncode, stdout, stderr), returncode None on timeout
+        :param domain:
+        :return: None on failure, NotImplemented if not supported by the handler, stdout otherwise
+        """
+        returncode, stdout, stderr = output
+        if returncode is None:
+            timeout = self._get_handler_timeout(command)
+            self.profiler.record(profiler.STAGE_HANDLER_TIMEOUT, timeout, domain)
+            logger.error("Handler script timed out after %s s and was killed.\n - Script: %s\n - Stderr: \n%s"
+                         % (timeout, ' '.join(arg_list), stderr))
+            return None
+
+        res = self._handler_result(command, returncode, stdout, stderr)
+        if res is None:
+            self.profiler.record(profiler.STAGE_HANDLER_FAILURE, 0, domain)
+        return res
+
+    def _get_handler_timeout(self, command):
+        """
+        Returns timeout of the handler stage in seconds, None for no limit
+        :param command: handler command
+        :return:
+        """
+        timeout = self._get_handler_stage_timeouts().get(command, self.conf("handler-timeout"))
+        return timeout if timeout and timeout > 0 else None
+
+    def _get_handler_stage_timeouts(self):
+        """
+        Parses handler-stage-timeouts: perform=60,cleanup=30
+        :return: dict command -> seconds
+        """
+        spec = self.conf("handler-stage-timeouts")
+        timeouts = {}
+        if not spec:
+            return timeouts
+
+        for item in spec.split(','):
+            if not item.strip():
+                continue
+            command, _, value = item.partition('=')
+            try:
+                timeouts[command.strip()] = int(value)
+            except ValueError:
+                raise errors.PluginError("Invalid handler-stage-timeouts item: %s" % item)
+        return timeouts
+
+    def _take_handler_retry(self, command, attempt):
+        """
+        Decides whether the failed invocation is retried, takes the retry from the run budget
+        :param command:
+        :param attempt: number of retries already done
+        :return: True if the invocation should be retried
+        """
+        if attempt >= (self.conf("handler-retries") or 0):
+            return False
+
+        # Lineages with the same budget share it
+        budget = self.conf("handler-retry-budget") or 0
+        with RUN_STATE.lock:
+            remaining = RUN_STATE.handler_retry_budgets.setdefault(budget, budget)
+            if remaining <= 0:
+                logger.warning("Handler retry budget exhausted, not retrying %s" % command)
+                return False
+            RUN_STATE.handler_retry_budgets[budget] = remaining - 1
+
+        logger.warning("Retrying handler command %s, retry %s" % (command, attempt + 1))
+        return True
+
+    def _handler_retry_backoff(self, attempt):
+        """
+        Waits before the retry, exponential backoff
+        :param attempt: number of retries already done
+        :return:
+        """
+        delay = (self.conf("handler-retry-backoff") or 0) * (2 ** attempt)
+        self.profiler.record(profiler.STAGE_HANDLER_RETRY, delay)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _handler_result(self, command, returncode, stdout, stderr):
+        """
+        Handler processing - interprets the finished handler process
+        :param command:
+        :param returncode:
+        :param stdout:
+        :param stderr:
+        :return: None on failure, NotImplemented if not supported by the handler, stdout otherwise
+        """
+        if returncode != 0:
+            if stdout.strip() in ("NotImplemented", b"NotImplemented"):
+                logger.warning("Handler script does not implement the command %s\n - Stderr: \n%s",
+                               command, stderr)
+                return NotImplemented
+
+            else:
+                logger.error("Handler script failed!\n - Stdout: \n%s\n - Stderr: \n%s", stdout, stderr)
+                return None
+
+        if self._is_stream_output_mode():
+            logger.info("Handler %s finished", command)
+        else:
+            logger.info("Handler output (%s):\n - Stdout: \n%s\n - Stderr: \n%s",
+                        command, stdout, stderr)
+        return stdout
+
+    def _handler_invocation_failed(self, arg_list, e):
+        """
+        Marks the handler as broken after the process could not be started
+        :param arg_list:
+        :param e:
+        :return:
+        """
+        self._handler_file_problem = True
+        logger.error("Handler script invocation failed with an exception. \n - Script: %s\n - Exception: %s"
+                     % (' '.join(arg_list), e))
+        self._log_handler_exec_problem()
+
+    def _get_handler_env(self, env_vars):
+        """
+        Returns environment for the handler process
+        :param env_vars: variables added to the process environment
+        :return:
+        """
+        env = dict(self._get_handler_base_env())
+        env.update(env_vars)
+        return env
+
+    def _get_handler_base_env(self):
+        """
+        Returns the environment inherited by handler processes according to the handler-env policy.
+        Computed once per run.
+        :return:
+        """
+        policy = self.conf("handler-env") or self.HANDLER_ENV_FULL
+        allowed = self.conf("handler-env-allow") if policy == self.HANDLER_ENV_ALLOWLIST else None
+        key = (policy, allowed)
+
+        with RUN_STATE.lock:
+            base_env = RUN_STATE.handler_base_envs.get(key)
+            if base_env is not None:
+                return base_env
+
+            if policy == self.HANDLER_ENV_FULL:
+                base_env = dict(os.environ)
+            else:
+                names = list(self.HANDLER_MINIMAL_ENV)
+                if allowed:
+                    names += [x.strip() for x in allowed.split(',') if x.strip()]
+                base_env = dict((k, v) for k, v in os.environ.items() if self._is_env_allowed(k, names))
+
+            RUN_STATE.handler_base_envs[key] = base_env
+            return base_env
+
+    def _is_env_allowed(self, name, patterns):
+        """
+        Returns true if the variable name matches one of names, NAME* matches a prefix
+        :param name:
+        :param patterns:
+        :return:
+        """
+        for pattern in patterns:
+            if pattern.endswith('*'):
+                if name.startswith(pattern[:-1]):
+                    return True
+            elif name == pattern:
+                return True
+        return False
+
+    def _get_handler_data(self, kwargs):
+        """
+        Passes the record to the handler via the channel selected by handler-data.
+        With stdin the record JSON is written to the handler stdin, with file
+        the record JSON is stored to a temporary file named in cbot_json_file.
+        :param kwargs: record variables, see _get_json_to_kwargs
+        :return: env_vars, stdin_data, data_file to be removed after the call
+        """
+        channel = self.conf("handler-data") or self.HANDLER_DATA_ENV
+        if channel == self.HANDLER_DATA_ENV or 'cbot_json' not in kwargs:
+            return kwargs, None, None
+
+        if channel == self.HANDLER_DATA_STDIN:
+            return {}, kwargs['cbot_json'] + '\n', None
+
+        fd, data_file = tempfile.mkstemp(prefix='cbot-', suffix='.json')
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(kwargs['cbot_json'])
+        return {'cbot_json_file': data_file}, None, data_file
+
+    def _remove_handler_data_file(self, data_file):
+        """
+        Removes the record file of the file data channel
+        :param data_file:
+        :return:
+        """
+        if data_file is None:
+            return
+        try:
+            os.remove(data_file)
+        except OSError as e:
+            logger.debug("Could not remove handler data file %s: %s" % (data_file, e))
+
+    def _get_async_core(self):
+        """
+        Returns the asyncio execution core, created on the first use
+        :return:
+        """
+        with RUN_STATE.lock:
+            if RUN_STATE.async_core is None:
+                from certbot_external_auth import aio
+                RUN_STATE.async_core = aio.AsyncCore()
+            return RUN_STATE.async_core
+
+    def _check_handler_file(self):
+        """
+        Checks the handler file exists, logs the problem otherwise
+        :return: True if the handler file exists
+        """
         if not os.path.isfile(self._get_handler()):
             self._handler_file_problem = True
             logger.error("Handler script file `%s` not found. Absolute path: %s"
@@ -655,75 +2323,156 @@ s.serve_forever()" """
             if os.path.exists(self._get_handler()):
                 logger.error("Handler script `%s` is not a file" % self._get_handler())
 
-            return None
+            return False
+        return True
 
-        # Check if is executable
-        # Still try to run, throw an exception only if problem really did occur.
-        exec_problem = not self._is_file_executable(self._get_handler())
+    def _log_handler_exec_problem(self):
+        """
+        Logs hints after the handler could not be started
+        :return:
+        """
+        if not self._is_file_executable(self._get_handler()):
+            logger.error("Handler script %s does not have the executable permission set so it cannot be executed. "
+                         "\n - Try running: chmod +x \"%s\" " % (self._get_handler(), self._try_get_abs_path(self._get_handler())))
+        else:
+            logger.warning("Make sure the handler file exists and is executable (+x permission on a Posix system)")
+
+    def _invoke_handler_daemon(self, command, args, env_vars, stdin_data=None, domain=None):
+        """
+        Passes the stage request to the handler daemon
+        :param command:
+        :param args:
+        :param env_vars:
+        :param stdin_data:
+        :param domain:
+        :return: None on failure, NotImplemented if not supported by the handler, stdout otherwise
+        """
+        handler_daemon = self._get_handler_daemon()
+        if handler_daemon is None:
+            return None
 
-        # The handler invocation
         try:
-            proc = subprocess.Popen(arg_list,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    env=env)
-            stdout, stderr = proc.communicate()
+            with self.profiler.measure(profiler.STAGE_HANDLER_DAEMON, domain):
+                response = handler_daemon.request(command, args=[str(x) for x in args], env=env_vars,
+                                                  stdin=stdin_data)
+        except HandlerDaemonError as e:
+            logger.error("Handler daemon failed to process %s: %s" % (command, e))
+            return None
 
-            # Handler processing
-            if proc.returncode != 0:
-                if stdout.strip() == "NotImplemented":
-                    logger.warning("Handler script does not implement the command %s\n - Stderr: \n%s",
-                                   command, stderr)
-                    return NotImplemented
+        stdout = response.get(daemon.FIELD_STDOUT) or ''
+        status = response.get(daemon.FIELD_STATUS)
+        if status == daemon.STATUS_NOT_IMPLEMENTED:
+            logger.warning("Handler daemon does not implement the command %s", command)
+            return NotImplemented
 
-                else:
-                    logger.error("Handler script failed!\n - Stdout: \n%s\n - Stderr: \n%s", stdout, stderr)
-                    return None
+        elif status != daemon.STATUS_OK:
+            logger.error("Handler daemon failed to process %s!\n - Response: \n%s", command, response)
+            return None
 
-            else:
-                    logger.info("Handler output (%s):\n - Stdout: \n%s\n - Stderr: \n%s",
-                                command, stdout, stderr)
-            return stdout
+        logger.info("Handler daemon output (%s):\n - Stdout: \n%s", command, stdout)
+        return stdout
 
-        except Exception as e:
-            self._handler_file_problem = True
-            logger.error("Handler script invocation failed with an exception. \n - Script: %s\n - Exception: %s"
-                         % (' '.join(arg_list), e))
-            if exec_problem:
-                logger.error("Handler script %s does not have the executable permission set so it cannot be executed. "
-                             "\n - Try running: chmod +x \"%s\" " % (self._get_handler(), self._try_get_abs_path(self._get_handler())))
-            else:
-                logger.warning("Make sure the handler file exists and is executable (+x permission on a Posix system)")
+    def _get_handler_daemon(self):
+        """
+        Returns running handler daemon, starts a new one if not running (crashed).
+        The daemon is shared by all plugin instances using the same handler.
+        :return: None if the daemon could not be started
+        """
+        with RUN_STATE.lock:
+            handler_daemon = RUN_STATE.handler_daemons.get(self._get_handler())
+            if handler_daemon is not None and handler_daemon.is_alive():
+                return handler_daemon
+
+            if handler_daemon is not None:
+                logger.warning("Handler daemon is not running, restarting")
+                handler_daemon.close()
+                del RUN_STATE.handler_daemons[self._get_handler()]
+            elif not self._check_handler_file():
+                return None
+
+            handler_daemon = HandlerDaemon(self._get_handler(), env=self._get_handler_env({}),
+                                           timeout=self.conf("handler-daemon-timeout"))
+            try:
+                handler_daemon.start()
+            except Exception as e:
+                self._handler_file_problem = True
+                logger.error("Handler daemon could not be started. \n - Script: %s\n - Exception: %s"
+                             % (self._get_handler(), e))
+                self._log_handler_exec_problem()
+                return None
+
+            RUN_STATE.handler_daemons[self._get_handler()] = handler_daemon
+            return handler_daemon
+
+    def _close_handler_daemon(self):
+        """
+        Terminates the handler daemon
+        :return:
+        """
+        with RUN_STATE.lock:
+            handler_daemon = RUN_STATE.handler_daemons.pop(self._get_handler(), None)
+            if handler_daemon is not None:
+                handler_daemon.close()
 
     #
     # Helper methods & UI
     #
 
-    def _json_sanitize_dict(self, dictionary):
+    def _run_parallel(self, func, items, max_workers=1, timeout=None, default=None):
         """
-        Sanitizes dictionary prior JSON serialization, handles byte string serialization
-        :param dictionary:
+        Calls func on each item, using at most max_workers worker threads.
+        Results are returned in the order of items. When any call fails no new items
+        are started and the first exception (in the items order) is re-raised.
+        :param func:
+        :param items:
+        :param max_workers:
+        :param timeout: overall deadline in seconds, results not finished in time are set to default
+        :param default:
         :return:
         """
-        for key, val in list(dictionary.items()):
-            # Not highly efficient, would be neater to clean up FIELD_TOKEN.
-            # But if any of the others turn to bytes in the future, this will solve it:
-            if isinstance(key, bytes):
-                del dictionary[key]
-                key = key.decode('UTF-8')
-                dictionary[key] = val
-
-            if isinstance(val, bytes):
-                dictionary[key] = val.decode('UTF-8')
-
-            elif type(val) in (list, tuple):
-                nval = []
-                for item in val:
-                    if isinstance(item, bytes):
-                        item = item.decode('UTF-8')
-                    nval.append(item)
-                dictionary[key] = nval
-        return dictionary
+        items = list(items)
+        if timeout is None and (max_workers is None or max_workers <= 1 or len(items) <= 1):
+            return [func(item) for item in items]
+
+        max_workers = max(1, max_workers or 1)
+        results = [default] * len(items)
+        failures = [None] * len(items)
+        finished = [False] * len(items)
+        expired = threading.Event()
+        work = queue.Queue()
+        for idx, item in enumerate(items):
+            work.put((idx, item))
+
+        def worker():
+            while not any(failures) and not expired.is_set():
+                try:
+                    idx, item = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[idx] = func(item)
+                except Exception:
+                    failures[idx] = sys.exc_info()
+                finished[idx] = True
+
+        threads = [threading.Thread(target=worker) for _ in range(min(max_workers, len(items)))]
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
+
+        if any(thread.is_alive() for thread in threads):
+            # Abandon the rest, workers are daemon threads
+            expired.set()
+            results = [res if done else default for res, done in zip(results, finished)]
+            logger.warning("%s of %s tasks did not finish in %s s", finished.count(False), len(items), timeout)
+
+        for failure in failures:
+            if failure is not None:
+                six.reraise(*failure)
+        return results
 
     def _is_file_executable(self, fpath):
         """
@@ -777,7 +2526,28 @@ s.serve_forever()" """
         Returns true if handler mode is selected
         :return:
         """
-        return self.conf("handler") is not None
+        return self.conf("handler") is not None or self._is_module_handler_mode()
+
+    def _is_module_handler_mode(self):
+        """
+        Returns true if the in-process Python handler is selected
+        :return:
+        """
+        return self.conf("handler-module") is not None
+
+    def _is_journal_mode(self):
+        """
+        Returns true if the records deployed by the handler are journaled
+        :return:
+        """
+        return self._is_handler_mode() and self.conf("journal") and not self.conf("test-mode")
+
+    def _is_deferred_cleanup_mode(self):
+        """
+        Returns true if the handler cleanup is deferred to the cleanup queue
+        :return:
+        """
+        return self._is_handler_mode() and bool(self.conf("cleanup-queue")) and not self.conf("test-mode")
 
     def _is_handler_broken(self):
         """
@@ -800,6 +2570,70 @@ s.serve_forever()" """
         """
         return self.conf("handler")
 
+    def _is_batch_handler_mode(self):
+        """
+        Returns true if records are sent to the handler in batches
+        :return:
+        """
+        return self._is_handler_mode() and self.conf("handler-batch")
+
+    def _is_responder_challenge(self, achall):
+        """
+        Returns true if the challenge is served by the in-process HTTP01 responder.
+        Test mode always serves http-01 challenges this way.
+        :param achall:
+        :return:
+        """
+        return (self.conf("http-responder") or self.conf("test-mode")) and isinstance(achall.chall, challenges.HTTP01)
+
+    def _is_stream_output_mode(self):
+        """
+        Returns true if handler outputs are streamed to the log with bounded buffers
+        :return:
+        """
+        return self.conf("handler-stream-output")
+
+    def _is_async_core_mode(self):
+        """
+        Returns true if handler processes run as asyncio coroutines
+        :return:
+        """
+        return self.conf("async-core")
+
+    def _is_daemon_handler_mode(self):
+        """
+        Returns true if the handler runs as a co-process for the whole run
+        :return:
+        """
+        return self._is_handler_mode() and self.conf("handler-daemon")
+
+    def _get_dns_resolvers(self):
+        """
+        Returns nameservers configured for DNS checks
+        :return: list of (address, port)
+        """
+        resolvers = self.conf("dns-resolvers")
+        if not resolvers:
+            return []
+
+        from certbot_external_auth import dnsutil
+        return [dnsutil.parse_nameserver(x) for x in resolvers.split(',') if x.strip()]
+
+    def _is_grouping_mode(self):
+        """
+        Returns true if dns-01 challenges sharing the TXT domain are grouped
+        :return:
+        """
+        return self.conf("group-challenges") and not self.conf("test-mode") and not self._is_text_mode()
+
+    def _get_max_parallel(self):
+        """
+        Returns maximum number of concurrent handler invocations
+        :return:
+        """
+        max_parallel = self.conf("max-parallel")
+        return 1 if max_parallel is None else int(max_parallel)
+
     def _is_dehydrated_dns(self):
         """
         Returns true if dehydrated dns mode is used
@@ -810,37 +2644,89 @@ s.serve_forever()" """
     def _json_dumps(self, data, **kwargs):
         """
         Dumps data to the json string
-        Using custom serializer by default
+        Using custom serializer by default, single line records go through the fast path, see jsonutil
         :param data:
         :param kwargs:
         :return:
         """
+        if not kwargs:
+            return jsonutil.dumps(data)
         kwargs.setdefault('cls', AutoJSONEncoder)
         return json.dumps(data, **kwargs)
 
     def _json_out(self, data, new_line=False):
         """
-        Dumps data as JSON to the stdout
+        Dumps data as JSON to the output. Buffered, written by _flush_output()
         :param data:
         :param new_line:
         :return:
         """
-        # pylint: disable=no-self-use
         json_str = self._json_dumps(data)
         if new_line:
             json_str += '\n'
-        sys.stdout.write(json_str)
-        sys.stdout.flush()
+        self._get_output_writer().write(json_str)
+
+    def _flush_output(self):
+        """
+        Writes the buffered output, called before waiting for the input and at the stage end
+        :return:
+        """
+        with RUN_STATE.lock:
+            output_writer = RUN_STATE.output_writers.get(self._get_output_key())
+        if output_writer is not None:
+            output_writer.flush()
+
+    @contextlib.contextmanager
+    def _flushed_output(self):
+        """
+        Flushes the buffered output when the block ends, also on error
+        :return:
+        """
+        try:
+            yield
+        finally:
+            self._flush_output()
+
+    def _get_output_key(self):
+        """
+        Identifies the JSON output of this plugin instance
+        :return:
+        """
+        if self.conf("output-file"):
+            return 'file', os.path.abspath(self.conf("output-file"))
+        return 'fd', self.conf("output-fd")
+
+    def _get_output_writer(self):
+        """
+        Returns the JSON output writer, shared by lineages writing to the same output
+        :return:
+        """
+        key = self._get_output_key()
+        with RUN_STATE.lock:
+            if key in RUN_STATE.output_writers:
+                return RUN_STATE.output_writers[key]
+
+            try:
+                if key[0] == 'file':
+                    output_writer = LineWriter.open(key[1])
+                else:
+                    output_writer = LineWriter(key[1])
+            except (IOError, OSError) as e:
+                raise errors.PluginError("Could not open the JSON output: %s" % e)
+            RUN_STATE.output_writers[key] = output_writer
+            return output_writer
 
     def _json_out_and_wait(self, data):
         """
-        Dumps data as JSON to stdout and waits for prompt
+        Dumps data as JSON to the output and waits for prompt
         :param data:
         :return:
         """
         # pylint: disable=no-self-use
         self._json_out(data, True)
-        six.moves.input("")
+        self._flush_output()
+        with self.profiler.measure(profiler.STAGE_INPUT_WAIT, data.get(FIELD_DOMAIN)):
+            six.moves.input("")
 
     def _notify_and_wait(self, message):
         """
@@ -849,10 +2735,12 @@ s.serve_forever()" """
         :return:
         """
         # pylint: disable=no-self-use
+        self._flush_output()
         sys.stdout.write(message)
         sys.stdout.write("Press ENTER to continue")
         sys.stdout.flush()
-        six.moves.input("")
+        with self.profiler.measure(profiler.STAGE_INPUT_WAIT):
+            six.moves.input("")
 
     def _get_ip_logging_permission(self):
         """
@@ -868,6 +2756,7 @@ s.serve_forever()" """
             raise errors.PluginError("Must agree to the public IP logging to proceed")
 
         if not (self.conf("test-mode") or self.conf("public-ip-logging-ok")):
+            import zope.component
             if not zope.component.getUtility(interfaces.IDisplay).yesno(
                     self.IP_DISCLAIMER, "Yes", "No",
                     cli_flag="--certbot-external-auth:out-public-ip-logging-ok"):
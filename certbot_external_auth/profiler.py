@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Per-stage timing of the plugin run."""
+
+import contextlib
+import threading
+import time
+
+from collections import OrderedDict
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # pragma: no cover
+    monotonic = time.time
+
+
+# Stages
+STAGE_PERFORM = 'perform'
+STAGE_CLEANUP = 'cleanup'
+STAGE_HANDLER_SPAWN = 'handler-spawn'
+STAGE_HANDLER_RUN = 'handler-run'
+STAGE_HANDLER_DAEMON = 'handler-daemon'
+STAGE_HANDLER_FAILURE = 'handler-failure'
+STAGE_HANDLER_TIMEOUT = 'handler-timeout'
+STAGE_HANDLER_RETRY = 'handler-retry'
+STAGE_INPUT_WAIT = 'input-wait'
+STAGE_RESPONDER_START = 'responder-start'
+STAGE_PROPAGATION_WAIT = 'propagation-wait'
+STAGE_ZONE_LOOKUP = 'zone-lookup'
+STAGE_VERIFY = 'verify'
+STAGE_DEPLOY_CERT = 'deploy-cert'
+
+
+class Profiler(object):
+    """
+    Collects monotonic durations per stage and per domain. Thread safe.
+    """
+
+    def __init__(self):
+        self.start_time = monotonic()
+        self._lock = threading.Lock()
+        self._stages = OrderedDict()
+        self._domains = OrderedDict()
+
+    def record(self, stage, duration, domain=None):
+        """
+        Records one stage duration
+        :param stage:
+        :param duration: seconds
+        :param domain: domain the stage was run for, if any
+        :return:
+        """
+        with self._lock:
+            self._add(self._stages, stage, duration)
+            if domain is not None:
+                self._add(self._domains.setdefault(domain, OrderedDict()), stage, duration)
+
+    @contextlib.contextmanager
+    def measure(self, stage, domain=None):
+        """
+        Context manager recording duration of its body
+        :param stage:
+        :param domain:
+        :return:
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, monotonic() - start, domain)
+
+    def is_empty(self):
+        """
+        Returns true if nothing was recorded
+        :return:
+        """
+        return not self._stages
+
+    def to_json(self):
+        """
+        Returns the collected timings, durations in seconds
+        :return:
+        """
+        with self._lock:
+            data = OrderedDict()
+            data['wall'] = round(monotonic() - self.start_time, 6)
+            data['stages'] = OrderedDict((stage, self._stats(stats)) for stage, stats in self._stages.items())
+            data['domains'] = OrderedDict(
+                (domain, OrderedDict((stage, self._stats(stats)) for stage, stats in stages.items()))
+                for domain, stages in self._domains.items())
+            return data
+
+    @staticmethod
+    def _add(stages, stage, duration):
+        stats = stages.get(stage)
+        if stats is None:
+            stages[stage] = [1, duration, duration, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = min(stats[2], duration)
+            stats[3] = max(stats[3], duration)
+
+    @staticmethod
+    def _stats(stats):
+        count, total, min_duration, max_duration = stats
+        res = OrderedDict()
+        res['count'] = count
+        res['total'] = round(total, 6)
+        res['min'] = round(min_duration, 6)
+        res['max'] = round(max_duration, 6)
+        return res
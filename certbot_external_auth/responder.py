@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""In-process HTTP-01 responder serving validations from memory."""
+
+import logging
+import threading
+
+from six.moves import BaseHTTPServer  # pylint: disable=import-error
+from six.moves import socketserver  # pylint: disable=import-error
+
+logger = logging.getLogger(__name__)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server, holds the resources being served"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        self.resources = {}
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+
+
+class _HTTP01RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves resources of the server, 404 for the rest"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        body = self.server.resources.get(self.path.split('?')[0])
+        if body is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug("HTTP01 responder: %s - %s", self.address_string(), format % args)
+
+
+class HTTP01Responder(object):
+    """
+    Serves http-01 validations of all challenges on one port from an in-memory dict.
+    The server is bound in start(), so it is ready to answer when start() returns.
+    """
+
+    def __init__(self, port, address=''):
+        self.address = address
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Binds the port and starts serving in a background thread
+        :return:
+        """
+        self._server = _ThreadingHTTPServer((self.address, self.port), _HTTP01RequestHandler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.debug("HTTP01 responder listening on port %s", self.port)
+
+    def is_running(self):
+        """
+        Returns true if the server is serving
+        :return:
+        """
+        return self._server is not None
+
+    def add(self, path, validation):
+        """
+        Starts serving the validation on the path
+        :param path: e.g., /.well-known/acme-challenge/token
+        :param validation:
+        :return:
+        """
+        if not isinstance(validation, bytes):
+            validation = validation.encode('UTF-8')
+        self._server.resources[path] = validation
+
+    def remove(self, path):
+        """
+        Stops serving the path
+        :param path:
+        :return:
+        """
+        self._server.resources.pop(path, None)
+
+    def __len__(self):
+        return len(self._server.resources) if self._server is not None else 0
+
+    def stop(self):
+        """
+        Shuts the server down
+        :return:
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        logger.debug("HTTP01 responder on port %s stopped", self.port)
@@ -0,0 +1,73 @@
+"""Tests for certbot_external_auth.cache."""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from certbot_external_auth.cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'cache', 'cache.json')
+        self.cache = ResultCache(self.path, ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_put_get(self):
+        self.assertTrue(self.cache.get('perform', 'example.com', 'val') is None)
+        self.cache.put('perform', 'example.com', 'val', b'out')
+        self.assertEqual(self.cache.get('perform', 'example.com', 'val'), 'out')
+        self.assertTrue(self.cache.get('perform', 'example.com', 'other') is None)
+        self.assertTrue(self.cache.get('cleanup', 'example.com', 'val') is None)
+
+        self.cache.invalidate('perform', 'example.com', 'val')
+        self.assertTrue(self.cache.get('perform', 'example.com', 'val') is None)
+
+    def test_persist(self):
+        self.cache.save()
+        self.assertFalse(os.path.exists(self.path))
+
+        self.cache.put('perform', 'example.com', 'val')
+        self.cache.save()
+        self.assertEqual(ResultCache(self.path, ttl=60).get('perform', 'example.com', 'val'), '')
+
+    def test_ttl(self):
+        with mock.patch('time.time', return_value=1000.0):
+            self.cache.put('perform', 'example.com', 'val')
+            self.cache.save()
+        with mock.patch('time.time', return_value=1059.0):
+            self.assertEqual(self.cache.get('perform', 'example.com', 'val'), '')
+        with mock.patch('time.time', return_value=1061.0):
+            self.assertTrue(self.cache.get('perform', 'example.com', 'val') is None)
+            self.assertEqual(len(ResultCache(self.path, ttl=60)), 0)
+
+    def test_evict(self):
+        cache = ResultCache(self.path, ttl=60, max_entries=2)
+        for idx in range(3):
+            with mock.patch('time.time', return_value=1000.0 + idx):
+                cache.put('perform', 'd%d.example.com' % idx, 'val')
+        with mock.patch('time.time', return_value=1010.0):
+            cache.save()
+            self.assertTrue(cache.get('perform', 'd0.example.com', 'val') is None)
+            self.assertEqual(cache.get('perform', 'd2.example.com', 'val'), '')
+
+    def test_corrupted(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as fh:
+            fh.write('{')
+        self.assertEqual(len(ResultCache(self.path, ttl=60)), 0)
+
+        with open(self.path, 'w') as fh:
+            json.dump({'key': 'value'}, fh)
+        self.assertEqual(len(ResultCache(self.path, ttl=60)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
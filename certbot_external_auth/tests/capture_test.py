@@ -0,0 +1,52 @@
+"""Tests for certbot_external_auth.capture."""
+import os
+import unittest
+
+from certbot_external_auth import capture
+
+
+class OutputCaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = []
+        self.capture = capture.OutputCapture(16, self.lines.append)
+
+    def test_lines(self):
+        self.capture.limit = 64
+        self.capture.feed(b'first\nsec')
+        self.capture.feed(b'ond\r\nthi')
+        self.assertEqual(self.lines, [b'first', b'second'])
+        self.capture.close()
+        self.assertEqual(self.lines, [b'first', b'second', b'thi'])
+        self.assertEqual(self.capture.getvalue(), b'first\nsecond\r\nthi')
+        self.assertFalse(self.capture.truncated)
+
+    def test_limit(self):
+        for idx in range(10):
+            self.capture.feed(b'line %d\n' % idx)
+        self.assertEqual(len(self.lines), 10)
+        self.assertTrue(self.capture.truncated)
+        self.assertEqual(self.capture.getvalue(), b'[... 54 bytes truncated]\n7\nline 8\nline 9\n')
+
+        self.capture.feed(b'x' * 100)
+        self.assertEqual(self.capture.getvalue(), b'[... 154 bytes truncated]\n' + b'x' * 16)
+
+    def test_long_line(self):
+        self.capture.feed(b'y' * (capture.OutputCapture.MAX_LINE * 2 + 1))
+        self.capture.close()
+        self.assertEqual([len(x) for x in self.lines], [capture.OutputCapture.MAX_LINE] * 2 + [1])
+
+    def test_not_implemented(self):
+        self.capture.feed(b'NotImplemented\n')
+        self.assertEqual(self.capture.getvalue().strip(), b'NotImplemented')
+
+    def test_pump(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'a\nb\n' * 3)
+        os.close(write_fd)
+        capture.pump(os.fdopen(read_fd, 'rb'), self.capture)
+        self.assertEqual(self.lines, [b'a', b'b'] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
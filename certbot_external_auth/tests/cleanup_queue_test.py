@@ -0,0 +1,73 @@
+"""Tests for certbot_external_auth.cleanup_queue."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from certbot_external_auth.cleanup_queue import CleanupQueue
+
+
+class CleanupQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'queue', 'cleanup.jsonl')
+        self.queue = CleanupQueue(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_put_take(self):
+        self.assertEqual(self.queue.take(), [])
+        self.queue.put([{'records': [1]}, {'records': [2]}])
+        self.queue.put([{'records': [3]}])
+        self.assertEqual(len(self.queue), 3)
+
+        self.assertEqual([x['records'] for x in self.queue.take()], [[1], [2], [3]])
+        # Entries queued during the drain are kept for the next one
+        self.queue.put([{'records': [4]}])
+        self.queue.done([{'records': [2]}])
+
+        self.assertFalse(os.path.exists(self.queue.draining_path))
+        self.assertEqual([x['records'] for x in self.queue.take()], [[4], [2]])
+
+    def test_interrupted_drain(self):
+        # pylint: disable=protected-access
+        self.queue.put([{'records': [1]}])
+        self.queue.take()
+        self.queue.put([{'records': [2]}])
+        # The drain crashed, its lock is gone
+        self.queue._drain_lock.release()
+
+        # Leftovers of the interrupted drain first, the new entries in the next drain
+        queue = CleanupQueue(self.path)
+        self.assertEqual([x['records'] for x in queue.take()], [[1]])
+        queue.done()
+        self.assertEqual([x['records'] for x in queue.take()], [[2]])
+
+    def test_concurrent_drain(self):
+        self.queue.put([{'records': [1]}])
+        self.assertEqual([x['records'] for x in self.queue.take()], [[1]])
+
+        # The draining file is not claimed twice, nor removed by the other drain
+        other = CleanupQueue(self.path)
+        self.queue.put([{'records': [2]}])
+        self.assertEqual(other.take(), [])
+        other.done()
+        self.assertTrue(os.path.exists(self.queue.draining_path))
+
+        self.queue.done()
+        self.assertEqual([x['records'] for x in other.take()], [[2]])
+        other.done()
+        self.assertEqual(len(other), 0)
+
+    def test_corrupted_entry(self):
+        self.queue.put([{'records': [1]}])
+        with open(self.path, 'a') as fh:
+            fh.write('{"records": [2\n')
+        self.queue.put([{'records': [3]}])
+        self.assertEqual([x['records'] for x in self.queue.take()], [[1], [3]])
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
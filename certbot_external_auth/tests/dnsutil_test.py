@@ -0,0 +1,278 @@
+"""Tests for certbot_external_auth.dnsutil."""
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from certbot_external_auth import dnsutil
+
+try:
+    import dns.message
+    import dns.rcode
+    import dns.rdatatype
+    import dns.resolver
+    import dns.rrset
+except ImportError:  # pragma: no cover
+    dns = None
+
+
+class StubDnsServer(object):
+    """Minimal UDP DNS server answering from the records dict."""
+
+    def __init__(self):
+        self.records = {}
+        self.queries = []
+        self.authority = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, name, rdtype, *values):
+        self.records.setdefault((name.lower().rstrip('.') + '.', rdtype), []).extend(values)
+
+    def close(self):
+        self.sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except (socket.error, OSError):
+                return
+
+            msg = dns.message.from_wire(data)
+            resp = dns.message.make_response(msg)
+            question = msg.question[0]
+            key = (question.name.to_text().lower(), dns.rdatatype.to_text(question.rdtype))
+            self.queries.append(key)
+            if key in self.records:
+                resp.answer.append(dns.rrset.from_text(question.name, 60, 'IN', key[1], *self.records[key]))
+            else:
+                zone = self._get_zone(key[0])
+                if zone is not None and self.authority:
+                    resp.authority.append(dns.rrset.from_text(zone, 60, 'IN', 'SOA', *self.records[(zone, 'SOA')]))
+                if not any(name == key[0] for name, _ in self.records):
+                    resp.set_rcode(dns.rcode.NXDOMAIN)
+            self.sock.sendto(resp.to_wire(), addr)
+
+    def _get_zone(self, name):
+        labels = name.split('.')
+        for idx in range(len(labels) - 1):
+            if ('.'.join(labels[idx:]), 'SOA') in self.records:
+                return '.'.join(labels[idx:])
+        return None
+
+
+class ParseNameserverTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(dnsutil.parse_nameserver('8.8.8.8'), ('8.8.8.8', 53))
+        self.assertEqual(dnsutil.parse_nameserver(' 127.0.0.1:5353'), ('127.0.0.1', 5353))
+        self.assertEqual(dnsutil.parse_nameserver('::1'), ('::1', 53))
+        self.assertEqual(dnsutil.parse_nameserver('[::1]:5353'), ('::1', 5353))
+
+
+@unittest.skipIf(dns is None, "dnspython is not installed")
+class PropagationWaiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubDnsServer()
+        self.waiter = dnsutil.PropagationWaiter(nameservers=[('127.0.0.1', self.server.port)],
+                                                timeout=5, initial_delay=0.05, max_delay=0.2, query_timeout=1)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_visible(self):
+        self.server.add('_acme-challenge.a.example.com', 'TXT', '"val-a"')
+        self.server.add('_acme-challenge.example.com', 'TXT', '"val-apex"', '"val-wildcard"')
+
+        visible = self.waiter.wait({'_acme-challenge.a.example.com': ['val-a'],
+                                    '_acme-challenge.example.com': ['val-apex', 'val-wildcard']})
+        self.assertEqual(visible, {'_acme-challenge.a.example.com': True,
+                                   '_acme-challenge.example.com': True})
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_propagates_later(self):
+        timer = threading.Timer(0.3, self.server.add, ('_acme-challenge.example.com', 'TXT', '"val"'))
+        timer.start()
+
+        start = time.time()
+        visible = self.waiter.wait({'_acme-challenge.example.com': ['val']})
+        timer.join()
+
+        self.assertTrue(visible['_acme-challenge.example.com'])
+        self.assertTrue(time.time() - start < 3)
+        self.assertTrue(len(self.server.queries) > 1)
+
+    def test_resolvers_reused(self):
+        self.waiter.timeout = 0.5
+        with mock.patch('dns.resolver.Resolver', wraps=dns.resolver.Resolver) as mock_resolver:
+            visible = self.waiter.wait({'_acme-challenge.example.com': ['val'],
+                                        '_acme-challenge.b.example.com': ['val']})
+
+        self.assertEqual(visible, {'_acme-challenge.example.com': False,
+                                   '_acme-challenge.b.example.com': False})
+        self.assertTrue(len(self.server.queries) > 2)
+        self.assertEqual(mock_resolver.call_count, 1)
+
+    def test_timeout(self):
+        self.waiter.timeout = 0.5
+        self.server.add('_acme-challenge.example.com', 'TXT', '"old"')
+
+        visible = self.waiter.wait({'_acme-challenge.example.com': ['val'],
+                                    '_acme-challenge.b.example.com': ['val']})
+        self.assertEqual(visible, {'_acme-challenge.example.com': False,
+                                   '_acme-challenge.b.example.com': False})
+
+
+class ZoneMapTest(unittest.TestCase):
+
+    def test_parent_names(self):
+        self.assertEqual(dnsutil.parent_names('_acme-challenge.A.example.com.'),
+                         ['_acme-challenge.a.example.com', 'a.example.com', 'example.com'])
+        self.assertEqual(dnsutil.parent_names('localhost'), [])
+
+    def test_read_zone_map(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'zones')
+        with open(path, 'w') as fh:
+            fh.write('# zones\nexample.com\n\n Sub.Example.com.  # delegated\n')
+        self.assertEqual(dnsutil.read_zone_map(path), ['example.com', 'sub.example.com'])
+
+    def test_find_mapped(self):
+        finder = dnsutil.ZoneFinder(['example.com', 'sub.example.com'], lookup=False)
+        self.assertEqual(finder.find('_acme-challenge.a.sub.example.com'), 'sub.example.com')
+        self.assertEqual(finder.find('_acme-challenge.example.com'), 'example.com')
+        self.assertEqual(finder.find('_acme-challenge.example.org'), None)
+
+
+@unittest.skipIf(dns is None, "dnspython is not installed")
+class ZoneFinderTest(unittest.TestCase):
+
+    SOA = 'ns1.example.com. hostmaster.example.com. 1 7200 3600 1209600 300'
+
+    def setUp(self):
+        self.server = StubDnsServer()
+        self.server.add('example.com', 'SOA', self.SOA)
+        self.server.add('sub.example.com', 'SOA', self.SOA)
+        self.server.add('a.example.com', 'A', '127.0.0.1')
+        self.finder = dnsutil.ZoneFinder(nameservers=[('127.0.0.1', self.server.port)], query_timeout=1)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_find(self):
+        self.assertEqual(self.finder.find('_acme-challenge.a.example.com'), 'example.com')
+        self.assertEqual(self.finder.find('_acme-challenge.x.sub.example.com.'), 'sub.example.com')
+        # SOA of the zone is in the authority section of the negative answer
+        self.assertEqual(len(self.server.queries), 2)
+
+        # Memoized for the names between the name and the zone
+        self.assertEqual(self.finder.find('_ACME-challenge.a.example.com'), 'example.com')
+        self.assertEqual(self.finder.find('a.example.com'), 'example.com')
+        self.assertEqual(self.finder.find('sub.example.com'), 'sub.example.com')
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_find_walk(self):
+        self.server.authority = False
+        self.assertEqual(self.finder.find('_acme-challenge.a.example.com'), 'example.com')
+        self.assertEqual(len(self.server.queries), 3)
+
+        # The walk stops at the memoized parent
+        self.assertEqual(self.finder.find('_acme-challenge.b.example.com'), 'example.com')
+        self.assertEqual(len(self.server.queries), 5)
+
+    def test_not_found(self):
+        self.assertEqual(self.finder.find('_acme-challenge.example.org'), None)
+        self.assertEqual(self.finder.find('_acme-challenge.example.org'), None)
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_zone_map_first(self):
+        self.finder.zones = set(['a.example.com'])
+        self.assertEqual(self.finder.find('_acme-challenge.a.example.com'), 'a.example.com')
+        self.assertEqual(self.server.queries, [])
+
+
+@unittest.skipIf(dns is None, "dnspython is not installed")
+class DnsCacheTest(unittest.TestCase):
+
+    SOA = 'ns1.example.com. hostmaster.example.com. 1 7200 3600 1209600 30'
+
+    def setUp(self):
+        self.server = StubDnsServer()
+        self.server.add('example.com', 'SOA', self.SOA)
+        self.server.add('example.com', 'NS', 'ns1.example.com.')
+        self.server.add('ns1.example.com', 'A', '127.0.0.1')
+        self.cache = dnsutil.DnsCache(nameservers=[('127.0.0.1', self.server.port)],
+                                      query_timeout=1, ns_port=self.server.port)
+
+    def tearDown(self):
+        self.server.close()
+
+    def _queries(self, rdtype):
+        return [x[0] for x in self.server.queries if x[1] == rdtype]
+
+    def test_verify_txt(self):
+        names = ['_acme-challenge.d%d.example.com' % idx for idx in range(5)]
+        for name in names:
+            self.server.add(name, 'TXT', '"val"')
+
+        for name in names:
+            self.assertTrue(self.cache.verify_txt(name, 'val'))
+        self.assertFalse(self.cache.verify_txt('_acme-challenge.missing.example.com', 'val'))
+
+        # One nameservers discovery for the zone
+        self.assertEqual(self._queries('NS'), ['example.com.'])
+        self.assertEqual(self._queries('A'), ['ns1.example.com.'])
+        self.assertEqual(len(self._queries('TXT')), 6)
+
+        # Cached for the TTL
+        self.assertTrue(self.cache.verify_txt(names[0], 'val'))
+        self.assertEqual(len(self._queries('TXT')), 6)
+
+    def test_verify_txt_deployed_later(self):
+        name = '_acme-challenge.example.com'
+        self.assertFalse(self.cache.verify_txt(name, 'val'))
+        self.server.add(name, 'TXT', '"val"')
+
+        # Cached negative answer is checked again
+        self.assertTrue(self.cache.verify_txt(name, 'val'))
+        self.assertEqual(self._queries('TXT'), [name + '.'] * 2)
+
+    def test_ttl(self):
+        self.server.add('a.example.com', 'A', '127.0.0.2')
+        now = dnsutil.monotonic()
+        self.assertEqual([x.address for x in self.cache.query('a.example.com', 'A')], ['127.0.0.2'])
+        self.assertEqual(self.cache.query('b.example.com', 'A'), [])
+
+        with mock.patch('certbot_external_auth.dnsutil.monotonic', return_value=now + 45):
+            self.cache.query('a.example.com', 'A')
+            # Negative TTL is the SOA minimum
+            self.cache.query('b.example.com', 'A')
+        self.assertEqual(self._queries('A'), ['a.example.com.', 'b.example.com.', 'b.example.com.'])
+
+        with mock.patch('certbot_external_auth.dnsutil.monotonic', return_value=now + 61):
+            self.cache.query('a.example.com', 'A')
+        self.assertEqual(len(self._queries('A')), 4)
+
+    def test_no_nameservers(self):
+        self.server.records.pop(('example.com.', 'NS'))
+        self.server.add('_acme-challenge.example.com', 'TXT', '"val"')
+
+        # Falls back to the recursive nameservers
+        self.assertEqual(self.cache.authoritative_nameservers('example.com'), [])
+        self.assertTrue(self.cache.verify_txt('_acme-challenge.example.com', 'val'))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,92 @@
+"""Tests for certbot_external_auth.journal."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from certbot_external_auth import journal
+from certbot_external_auth.journal import Journal
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'journal.jsonl')
+        self.journal = Journal(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _stale(self):
+        with mock.patch('certbot_external_auth.journal.is_live', return_value=False):
+            return [(entry['options'], [x['token'] for x in records]) for entry, records in self.journal.stale()]
+
+    def _context(self, options, **run):
+        context = {'run': journal.run_identity(), 'options': options}
+        context['run'].update(run)
+        return context
+
+    def test_stale(self):
+        self.journal.deployed([{'token': 'a'}, {'token': 'b'}], self._context(1))
+        self.journal.deployed([{'token': 'c', 'tokens': ['c', 'd']}], self._context(2))
+        self.journal.cleaned([{'token': 'b'}, {'token': 'd', 'tokens': ['d', 'c']}])
+
+        # Records of this run are not stale
+        self.assertEqual(self.journal.stale(), [])
+        self.assertEqual(self._stale(), [(1, ['a'])])
+
+    def test_stale_same_pid(self):
+        # Previous run of a container started with the same PID
+        self.journal.deployed([{'token': 'a'}], self._context(1, id='previous', start_time=-1))
+        # Entry without the run identity or with an invalid PID
+        self.journal.deployed([{'token': 'b'}], {'options': 2})
+        self.journal.deployed([{'token': 'c'}], self._context(3, id='previous', pid=None))
+        self.journal.deployed([{'token': 'd'}], self._context(4))
+
+        self.assertEqual([(entry['options'], [x['token'] for x in records]) for entry, records in self.journal.stale()],
+                         [(1, ['a']), (2, ['b']), (3, ['c'])])
+
+    def test_deployed_again(self):
+        self.journal.deployed([{'token': 'a'}], {'options': 1})
+        self.journal.cleaned([{'token': 'a'}])
+        self.journal.deployed([{'token': 'a'}], {'options': 2})
+        self.assertEqual(self._stale(), [(2, ['a'])])
+
+    def test_compact(self):
+        self.journal.compact()
+        self.assertFalse(os.path.exists(self.path))
+
+        self.journal.deployed([{'token': 'a'}, {'token': 'b'}], {'options': 1})
+        self.journal.cleaned([{'token': 'a'}])
+        with open(self.path, 'a') as fh:
+            fh.write('{"op": "cleanup", "keys": ["b"\n')
+        self.journal.compact()
+
+        with open(self.path) as fh:
+            self.assertEqual(len(fh.readlines()), 1)
+        self.assertEqual(self._stale(), [(1, ['b'])])
+
+        self.journal.cleaned([{'token': 'b'}])
+        self.journal.compact()
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_is_running(self):
+        self.assertTrue(journal.is_running(os.getpid()))
+        self.assertTrue(journal.is_running(os.getpid(), journal.process_start_time(os.getpid())))
+        self.assertFalse(journal.is_running(None))
+        self.assertFalse(journal.is_running('1'))
+        with mock.patch('os.kill', side_effect=OSError(3, 'No such process')):
+            self.assertFalse(journal.is_running(1))
+
+    @unittest.skipUnless(os.path.exists('/proc/self/stat'), "procfs is not available")
+    def test_is_running_recycled_pid(self):
+        start_time = journal.process_start_time(os.getpid())
+        self.assertTrue(isinstance(start_time, int))
+        self.assertFalse(journal.is_running(os.getpid(), start_time + 1))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,54 @@
+"""Tests for certbot_external_auth.jsonutil."""
+import datetime
+import json
+import unittest
+
+import mock
+
+from certbot_external_auth import jsonutil
+
+
+class JsonUtilTest(unittest.TestCase):
+
+    DATA = {'token': b'abc', 'domains': set(['a.example.com']), 'time': datetime.datetime(1970, 1, 2)}
+
+    def test_dumps_std(self):
+        with mock.patch('certbot_external_auth.jsonutil.orjson', new=None):
+            data = json.loads(jsonutil.dumps(self.DATA))
+        self.assertEqual(data, {'token': 'abc', 'domains': ['a.example.com'], 'time': 86400.0})
+
+    def test_dumps_compact(self):
+        record = jsonutil.Record([('domain', 'a.example.com'), ('validations', ['a', 'b'])])
+        with mock.patch('certbot_external_auth.jsonutil.orjson', new=None):
+            self.assertEqual(jsonutil._dumps(record), '{"domain":"a.example.com","validations":["a","b"]}')
+        if jsonutil.is_fast_available():
+            self.assertEqual(jsonutil._dumps(record), '{"domain":"a.example.com","validations":["a","b"]}')
+
+    @unittest.skipUnless(jsonutil.is_fast_available(), "orjson is not installed")
+    def test_dumps_fast(self):
+        self.assertEqual(json.loads(jsonutil.dumps(self.DATA)),
+                         {'token': 'abc', 'domains': ['a.example.com'], 'time': 86400.0})
+        # Non-str keys fall back to the standard encoder
+        self.assertEqual(json.loads(jsonutil.dumps({1: 'a'})), {'1': 'a'})
+
+    def test_record_serialized_once(self):
+        record = jsonutil.Record([('domain', 'a.example.com'), ('token', 'abc')])
+        with mock.patch('certbot_external_auth.jsonutil._dumps', wraps=jsonutil._dumps) as mock_dumps:
+            json_str = jsonutil.dumps(record)
+            self.assertTrue(jsonutil.dumps(record) is json_str)
+            self.assertEqual(mock_dumps.call_count, 1)
+
+            record['token'] = 'def'
+            self.assertEqual(json.loads(jsonutil.dumps(record))['token'], 'def')
+            record.pop('token')
+            self.assertEqual(list(json.loads(jsonutil.dumps(record))), ['domain'])
+            self.assertEqual(mock_dumps.call_count, 3)
+
+    def test_to_str(self):
+        self.assertEqual(jsonutil.to_str(b'abc'), 'abc')
+        self.assertEqual(jsonutil.to_str(u'abc'), 'abc')
+        self.assertTrue(jsonutil.to_str(None) is None)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,59 @@
+"""Tests for certbot_external_auth.output."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import six
+
+from certbot_external_auth.output import LineWriter
+
+
+class LineWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_stdout_buffered(self):
+        writer = LineWriter(buffer_size=10)
+        with mock.patch('sys.stdout', new=six.StringIO()) as stdout:
+            writer.write('{"a": 1}\n')
+            self.assertEqual(stdout.getvalue(), '')
+            writer.write('{"b": 2}\n')
+            self.assertEqual(stdout.getvalue(), '{"a": 1}\n{"b": 2}\n')
+
+            writer.write('{"c": 3}\n')
+            writer.flush()
+            self.assertEqual(stdout.getvalue(), '{"a": 1}\n{"b": 2}\n{"c": 3}\n')
+
+    def test_fd(self):
+        read_fd, write_fd = os.pipe()
+        writer = LineWriter(write_fd)
+        writer.write(u'{"domain": "č.example.com"}\n')
+        writer.flush()
+        self.assertEqual(os.read(read_fd, 1024).decode('UTF-8'), u'{"domain": "č.example.com"}\n')
+
+        writer.close()
+        os.write(write_fd, b'x')  # not owned, left open
+        os.close(read_fd)
+        os.close(write_fd)
+
+    def test_open(self):
+        path = os.path.join(self.tempdir, 'out.json')
+        with open(path, 'w') as fh:
+            fh.write('{"old": 1}\n')
+
+        writer = LineWriter.open(path)
+        writer.write('{"new": 2}\n')
+        writer.close()
+        self.assertTrue(writer.fd is None)
+        with open(path) as fh:
+            self.assertEqual(fh.read(), '{"old": 1}\n{"new": 2}\n')
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
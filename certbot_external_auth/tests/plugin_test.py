@@ -1,9 +1,14 @@
 """Tests for certbot.auth_handler."""
 import functools
+import json
 import logging
 import unittest
 import os
+import stat
+import sys
 import tempfile
+import threading
+import time
 import shutil
 
 import mock
@@ -15,6 +20,7 @@ from acme import client as acme_client
 from acme import messages
 
 from certbot import achallenges, configuration
+from certbot import auth_handler
 from certbot import errors
 from certbot import interfaces
 from certbot import util
@@ -23,6 +29,26 @@ from certbot import constants
 from certbot.tests import acme_util
 from certbot.tests import util as test_util
 
+from certbot_external_auth import FIELD_ZONE
+from certbot_external_auth import dnsutil
+from certbot_external_auth.tests.dnsutil_test import StubDnsServer
+
+
+def set_plugin_options(config, name_cfg, **options):
+    """
+    Sets all plugin options to their defaults, keyword arguments override them
+    :param config:
+    :param name_cfg: option prefix
+    :param options: option_name -> value
+    :return:
+    """
+    from certbot_external_auth.plugin import AuthenticatorOut
+    for name, value in AuthenticatorOut.get_option_defaults().items():
+        config.__setattr__(name_cfg + name.replace('-', '_'), value)
+    for name, value in options.items():
+        config.__setattr__(name_cfg + name, value)
+
+
 @unittest.skip
 class ChallengeFactoryTest(unittest.TestCase):
     # pylint: disable=protected-access
@@ -95,11 +121,7 @@ class GetAuthorizationsTest(unittest.TestCase):
         self.config.fullchain_path = constants.CLI_DEFAULTS['auth_chain_path']
         self.config.chain_path = constants.CLI_DEFAULTS['auth_chain_path']
         self.config.server = "example.com"
-        self.config.__setattr__(self.name_cfg + 'handler', None)
-        self.config.__setattr__(self.name_cfg + 'public_ip_logging_ok', True)
-        self.config.__setattr__(self.name_cfg + 'test_mode', False)
-        self.config.__setattr__(self.name_cfg + 'text_mode', False)
-        self.config.__setattr__(self.name_cfg + 'dehydrated_dns', False)
+        set_plugin_options(self.config, self.name_cfg, public_ip_logging_ok=True, handler_retry_backoff=0.0)
 
         self.mock_display = mock.Mock()
         zope.component.provideUtility(
@@ -321,6 +343,858 @@ class GetAuthorizationsTest(unittest.TestCase):
         self.mock_data.append(x)
 
 
+class HandlerModeTest(unittest.TestCase):
+    # pylint: disable=protected-access
+    """Tests perform / cleanup in the handler mode with a real handler script."""
+
+    HANDLER = """#!{python}
+import json, os, sys
+cmd = sys.argv[1]
+with open({log!r}, 'a') as fh:
+    fh.write(json.dumps([cmd, os.environ.get('cbot_domain'), os.environ.get('cbot_validations')]) + '\\n')
+if cmd.endswith('-batch'):
+    for rec in json.loads(sys.stdin.read()):
+        print(json.dumps({{'token': rec['token'], 'status': 'ok'}}))
+"""
+
+    DAEMON_HANDLER = """#!{python}
+import json, os, sys
+assert sys.argv[1] == 'daemon'
+for line in iter(sys.stdin.readline, ''):
+    req = json.loads(line)
+    with open({log!r}, 'a') as fh:
+        fh.write(json.dumps([req['cmd'], req['env'].get('cbot_domain'), os.getpid()]) + '\\n')
+    print(json.dumps({{'id': req['id'], 'status': 'ok', 'stdout': ''}}))
+    sys.stdout.flush()
+"""
+
+    DATA_HANDLER = """#!{python}
+import json, os, sys
+data = None
+if os.environ.get('cbot_json_file'):
+    with open(os.environ['cbot_json_file']) as fh:
+        data = json.load(fh)
+elif os.environ.get('cbot_json'):
+    data = json.loads(os.environ['cbot_json'])
+elif sys.argv[1] in ('perform', 'cleanup'):
+    data = json.loads(sys.stdin.read())
+with open({log!r}, 'a') as fh:
+    fh.write(json.dumps([sys.argv[1], data and data['domain'], sorted(os.environ.keys())]) + '\\n')
+"""
+
+    MODULE_HANDLER = """
+import json
+
+class Handler(object):
+    def _log(self, cmd, data=None):
+        with open({log!r}, 'a') as fh:
+            fh.write(json.dumps([cmd, data and data['domain'], isinstance(data, dict)]) + '\\n')
+
+    def pre_perform(self):
+        self._log('pre-perform')
+
+    def perform(self, record):
+        self._log('perform', record)
+
+    def cleanup(self, record):
+        self._log('cleanup', record)
+"""
+
+    def setUp(self):
+        from certbot_external_auth.plugin import AuthenticatorOut
+
+        self.name = 'certbot-external-auth'
+        self.name_cfg = self.name.replace('-', '_') + '_'
+        self.tempdir = tempfile.mkdtemp(dir=tempfile.gettempdir())
+        self.log_file = os.path.join(self.tempdir, 'handler.log')
+        self.handler_file = os.path.join(self.tempdir, 'handler.py')
+        self._write_handler(self.HANDLER)
+
+        self.config = configuration.NamespaceConfig(
+            mock.MagicMock(**constants.CLI_DEFAULTS)
+        )
+        self.config.config_dir = os.path.join(self.tempdir, 'config')
+        self.config.work_dir = os.path.join(self.tempdir, 'work')
+        self.config.logs_dir = os.path.join(self.tempdir, 'logs')
+        set_plugin_options(self.config, self.name_cfg, handler=self.handler_file,
+                           public_ip_logging_ok=True, handler_retry_backoff=0.0)
+
+        self.patch_http = mock.patch('acme.challenges.HTTP01Response.simple_verify')
+        self.patch_dns = mock.patch('acme.challenges.DNS01Response.simple_verify')
+        self.patch_stdout = mock.patch('sys.stdout', new=six.StringIO())
+        self.patch_http.start()
+        self.patch_dns.start()
+        self.patch_stdout.start()
+
+        self.auth = AuthenticatorOut(self.config, self.name)
+        self.achalls = [
+            auth_handler.challb_to_achall(
+                acme_util.chall_to_challb(challenges.DNS01(token=(b'%032d' % idx)), messages.STATUS_PENDING),
+                acme_util.JWK, 'd%d.example.org' % idx)
+            for idx in range(5)]
+
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        logging.disable(logging.NOTSET)
+        self.patch_http.stop()
+        self.patch_dns.stop()
+        self.patch_stdout.stop()
+
+    def _write_handler(self, body):
+        with open(self.handler_file, 'w') as fh:
+            fh.write(body.format(python=sys.executable, log=self.log_file))
+        os.chmod(self.handler_file, os.stat(self.handler_file).st_mode | stat.S_IEXEC)
+
+    def _handler_calls(self):
+        with open(self.log_file) as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_perform(self):
+        responses = self.auth.perform(self.achalls)
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls])
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform'] + ['perform'] * 5 + ['post-perform'])
+        self.assertEqual([x[1] for x in calls[1:-1]], [x.domain for x in self.achalls])
+
+    def test_perform_parallel(self):
+        self.config.__setattr__(self.name_cfg + 'max_parallel', 3)
+        responses = self.auth.perform(self.achalls)
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls])
+        calls = self._handler_calls()
+        self.assertEqual(calls[0][0], 'pre-perform')
+        self.assertEqual(calls[-1][0], 'post-perform')
+        self.assertEqual(sorted(x[1] for x in calls[1:-1]), sorted(x.domain for x in self.achalls))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio core requires Python 3.5+")
+    def test_perform_async(self):
+        self.config.__setattr__(self.name_cfg + 'async_core', True)
+        self.config.__setattr__(self.name_cfg + 'max_parallel', 3)
+        responses = self.auth.perform(self.achalls)
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls])
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform'] + ['perform'] * 5 + ['post-perform'])
+        self.assertEqual(sorted(x[1] for x in calls[1:-1]), sorted(x.domain for x in self.achalls))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio core requires Python 3.5+")
+    def test_perform_async_failure(self):
+        self.config.__setattr__(self.name_cfg + 'async_core', True)
+        self._write_handler(self.HANDLER + "if cmd == 'perform': sys.exit(1)\n")
+        self.assertRaises(errors.PluginError, self.auth.perform, self.achalls)
+
+    def test_perform_bulk_json(self):
+        self.config.__setattr__(self.name_cfg + 'handler', None)
+        self.config.__setattr__(self.name_cfg + 'bulk_json', True)
+        tokens = [json.dumps({'token': x.chall.encode('token')}) for x in self.achalls]
+        acks = ['unknown'] + list(reversed(tokens[1:])) + [tokens[0].replace('{', '{ ')]
+
+        with mock.patch('six.moves.input', side_effect=acks) as mock_input:
+            responses = self.auth.perform(self.achalls)
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls])
+        self.assertEqual(mock_input.call_count, 6)
+        records = [json.loads(x) for x in sys.stdout.getvalue().splitlines()]
+        self.assertEqual([x['domain'] for x in records], [x.domain for x in self.achalls])
+
+    def test_perform_bulk_json_ack_all(self):
+        self.config.__setattr__(self.name_cfg + 'handler', None)
+        self.config.__setattr__(self.name_cfg + 'bulk_json', True)
+
+        with mock.patch('six.moves.input', return_value='') as mock_input:
+            self.auth.perform(self.achalls)
+        self.assertEqual(mock_input.call_count, 1)
+
+    def test_output_file(self):
+        from certbot_external_auth.plugin import RUN_STATE
+
+        output_file = os.path.join(self.tempdir, 'out.json')
+        self.config.__setattr__(self.name_cfg + 'handler', None)
+        self.config.__setattr__(self.name_cfg + 'output_file', output_file)
+        self.addCleanup(setattr, RUN_STATE, 'output_writers', RUN_STATE.output_writers)
+        RUN_STATE.output_writers = {}
+
+        def read_records():
+            with open(output_file) as fh:
+                return [json.loads(x) for x in fh]
+
+        # Each record is written before the plugin waits for the input
+        seen = []
+        with mock.patch('six.moves.input', side_effect=lambda *args: seen.append(len(read_records()))):
+            self.auth.perform(self.achalls)
+        self.addCleanup(self.auth._get_output_writer().close)
+        self.auth.cleanup(self.achalls)
+
+        self.assertEqual(seen, [1, 2, 3, 4, 5])
+        self.assertEqual(sys.stdout.getvalue(), '')
+        self.assertEqual([x['cmd'] for x in read_records()], ['perform_challenge'] * 5 + ['cleanup'] * 5)
+
+    def test_run_state_shared(self):
+        from certbot_external_auth.plugin import AuthenticatorOut, RunState
+
+        with mock.patch('certbot_external_auth.plugin.RUN_STATE', new=RunState()), \
+                mock.patch('certbot_external_auth.plugin.atexit') as mock_atexit, \
+                mock.patch('certbot.reverter.Reverter') as mock_reverter, \
+                mock.patch('zope.component.getUtility'), \
+                mock.patch('zope.component.provideUtility') as mock_provide:
+            auths = [AuthenticatorOut(self.config, self.name) for _ in range(3)]
+            for auth in auths:
+                auth.prepare()
+
+        self.assertEqual(mock_reverter.call_count, 1)
+        self.assertEqual(mock_reverter.return_value.recovery_routine.call_count, 1)
+        self.assertEqual(mock_atexit.register.call_count, 1)
+        self.assertEqual(mock_provide.call_count, 2)
+        self.assertTrue(auths[0].messages is auths[2].messages)
+
+    def test_run_state_keyed_by_options(self):
+        from certbot_external_auth.plugin import AuthenticatorOut, RUN_STATE
+        for field in ('output_writers', 'journals', 'handler_caches', 'handler_retry_budgets'):
+            self.addCleanup(setattr, RUN_STATE, field, getattr(RUN_STATE, field))
+            setattr(RUN_STATE, field, {})
+
+        # Two lineages configured differently within the same run
+        auths = []
+        for idx in range(2):
+            config = configuration.NamespaceConfig(mock.MagicMock(**constants.CLI_DEFAULTS))
+            config.work_dir = os.path.join(self.tempdir, 'work')
+            set_plugin_options(config, self.name_cfg, handler=self.handler_file, public_ip_logging_ok=True,
+                               output_file=os.path.join(self.tempdir, 'out%d.json' % idx),
+                               journal=True, journal_file=os.path.join(self.tempdir, 'journal%d.jsonl' % idx),
+                               handler_cache=True, handler_cache_ttl=60 * (idx + 1),
+                               handler_cache_file=os.path.join(self.tempdir, 'cache%d.json' % idx),
+                               handler_retries=5, handler_retry_budget=idx + 1)
+            auths.append(AuthenticatorOut(config, self.name))
+
+        for idx, auth in enumerate(auths):
+            auth.perform(self.achalls[idx:idx + 1])
+            self.addCleanup(auth._get_output_writer().close)
+
+        self.assertFalse(auths[0]._get_output_writer() is auths[1]._get_output_writer())
+        for idx, auth in enumerate(auths):
+            self.assertEqual(auth._get_journal().path, os.path.join(self.tempdir, 'journal%d.jsonl' % idx))
+            self.assertEqual(auth._get_handler_cache().path, os.path.join(self.tempdir, 'cache%d.json' % idx))
+            self.assertEqual(auth._get_handler_cache().ttl, 60 * (idx + 1))
+            with open(os.path.join(self.tempdir, 'out%d.json' % idx)) as fh:
+                self.assertEqual([json.loads(x)['domain'] for x in fh], ['d%d.example.org' % idx])
+
+        # Each budget is taken separately
+        self.assertTrue(auths[0]._take_handler_retry('perform', 0))
+        self.assertFalse(auths[0]._take_handler_retry('perform', 0))
+        self.assertTrue(auths[1]._take_handler_retry('perform', 0))
+        self.assertTrue(auths[1]._take_handler_retry('perform', 0))
+        self.assertFalse(auths[1]._take_handler_retry('perform', 0))
+
+    def test_profile(self):
+        profile_file = os.path.join(self.tempdir, 'profile.json')
+        self.config.__setattr__(self.name_cfg + 'profile', True)
+        self.config.__setattr__(self.name_cfg + 'profile_file', profile_file)
+        self.auth.perform(self.achalls)
+        self.auth.cleanup(self.achalls)
+        self.auth.print_messages()
+
+        records = [json.loads(x) for x in sys.stdout.getvalue().splitlines() if x.startswith('{')]
+        self.assertEqual(records[-2]['cmd'], 'report')
+        self.assertEqual(records[-1]['cmd'], 'profile')
+        with open(profile_file) as fh:
+            profile = json.load(fh)
+
+        for stage in ('perform', 'cleanup', 'handler-spawn', 'handler-run', 'verify'):
+            self.assertTrue(profile['stages'][stage]['count'] >= 1)
+        self.assertTrue(profile['stages']['handler-run']['count'] >= 14)
+        for achall in self.achalls:
+            domain_stages = profile['domains'][achall.domain]
+            self.assertTrue(domain_stages['handler-run']['count'] >= 2)
+            self.assertTrue(domain_stages['verify']['total'] >= 0)
+
+    def test_handler_env_policy(self):
+        self.config.__setattr__(self.name_cfg + 'handler_env', 'allowlist')
+        self.config.__setattr__(self.name_cfg + 'handler_env_allow', 'CBOT_TEST_*')
+        self._write_handler(self.DATA_HANDLER)
+        with mock.patch.dict(os.environ, {'CBOT_TEST_VAR': '1', 'CBOT_OTHER_VAR': '1'}):
+            self.auth.perform(self.achalls[:1])
+
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform', 'perform', 'post-perform'])
+        self.assertTrue('CBOT_TEST_VAR' in calls[0][2])
+        self.assertFalse('CBOT_OTHER_VAR' in calls[0][2])
+        self.assertTrue('cbot_json' in calls[1][2])
+
+        self.config.__setattr__(self.name_cfg + 'handler_env', 'minimal')
+        base_env = self.auth._get_handler_base_env()
+        self.assertTrue(base_env is self.auth._get_handler_base_env())
+        self.assertTrue(set(base_env.keys()) <= set(self.auth.HANDLER_MINIMAL_ENV))
+
+    def test_handler_data_stdin(self):
+        self.config.__setattr__(self.name_cfg + 'handler_data', 'stdin')
+        self._write_handler(self.DATA_HANDLER)
+        self.auth.perform(self.achalls)
+        self.auth.cleanup(self.achalls)
+
+        calls = self._handler_calls()
+        self.assertEqual([x[1] for x in calls if x[0] in ('perform', 'cleanup')],
+                         [x.domain for x in self.achalls] * 2)
+        for call in calls:
+            self.assertFalse(any(x.startswith('cbot_') for x in call[2]))
+
+    def test_handler_data_file(self):
+        self.config.__setattr__(self.name_cfg + 'handler_data', 'file')
+        self._write_handler(self.DATA_HANDLER)
+        data_files = []
+
+        def mkstemp(*args, **kwargs):
+            res = orig_mkstemp(*args, **kwargs)
+            data_files.append(res[1])
+            return res
+
+        orig_mkstemp = tempfile.mkstemp
+        with mock.patch('tempfile.mkstemp', side_effect=mkstemp):
+            self.auth.perform(self.achalls)
+
+        calls = self._handler_calls()
+        self.assertEqual([x[1] for x in calls if x[0] == 'perform'], [x.domain for x in self.achalls])
+        self.assertEqual(len(data_files), 5)
+        self.assertFalse(any(os.path.exists(x) for x in data_files))
+
+    def test_handler_cache(self):
+        from certbot_external_auth.plugin import RUN_STATE
+        self.addCleanup(setattr, RUN_STATE, 'handler_caches', RUN_STATE.handler_caches)
+        RUN_STATE.handler_caches = {}
+        cache_file = os.path.join(self.tempdir, 'cache.json')
+        self.config.__setattr__(self.name_cfg + 'handler_cache', True)
+        self.config.__setattr__(self.name_cfg + 'handler_cache_file', cache_file)
+
+        self.auth.perform(self.achalls[:3])
+        self.assertTrue(os.path.exists(cache_file))
+
+        # Retry - already deployed records are skipped, new ones deployed
+        self.auth.perform(self.achalls[:3])
+        self.auth.perform(self.achalls[2:4])
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform'] + ['perform'] * 3 + ['post-perform'] +
+                         ['pre-perform', 'perform', 'post-perform'])
+        self.assertEqual(calls[-2][1], self.achalls[3].domain)
+
+        # Cleanup invalidates, the next perform deploys again
+        self.auth.cleanup(self.achalls[:1])
+        self.auth.perform(self.achalls[:2])
+        calls = self._handler_calls()
+        self.assertEqual([x[1] for x in calls if x[0] == 'perform'][-1:], [self.achalls[0].domain])
+
+    def test_handler_timeout(self):
+        self.config.__setattr__(self.name_cfg + 'handler_stage_timeouts', 'perform=1')
+        self._write_handler(self.HANDLER + "if cmd == 'perform':\n    import time; time.sleep(30)\n")
+        start = time.time()
+        self.assertRaises(errors.PluginError, self.auth.perform, self.achalls[:1])
+
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual([x[0] for x in self._handler_calls()], ['pre-perform', 'perform'])
+        self.assertEqual(self.auth._get_handler_timeout('perform'), 1)
+        self.assertTrue(self.auth._get_handler_timeout('cleanup') is None)
+
+    def test_handler_retry(self):
+        from certbot_external_auth.plugin import RUN_STATE
+        self.addCleanup(setattr, RUN_STATE, 'handler_retry_budgets', RUN_STATE.handler_retry_budgets)
+        RUN_STATE.handler_retry_budgets = {}
+        self.config.__setattr__(self.name_cfg + 'handler_retries', 2)
+        self.config.__setattr__(self.name_cfg + 'handler_retry_budget', 3)
+
+        # Fails the first perform of each domain
+        marker = os.path.join(self.tempdir, 'marker-')
+        self._write_handler(self.HANDLER + (
+            "if cmd == 'perform' and not os.path.exists({marker!r} + os.environ['cbot_domain']):\n"
+            "    open({marker!r} + os.environ['cbot_domain'], 'w').close(); sys.exit(1)\n").format(marker=marker))
+        self.auth.perform(self.achalls[:3])
+
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform'] + ['perform'] * 6 + ['post-perform'])
+        self.assertEqual(RUN_STATE.handler_retry_budgets, {3: 0})
+
+        # Budget exhausted
+        self.assertRaises(errors.PluginError, self.auth.perform, self.achalls[3:4])
+        self.assertTrue(self.auth._get_handler_stats()['retries'] >= 3)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio core requires Python 3.5+")
+    def test_handler_timeout_async(self):
+        self.config.__setattr__(self.name_cfg + 'async_core', True)
+        self.config.__setattr__(self.name_cfg + 'handler_timeout', 1)
+        self.config.__setattr__(self.name_cfg + 'handler_retries', 1)
+        self._write_handler(self.HANDLER + "if cmd == 'perform':\n    import time; time.sleep(30)\n")
+        start = time.time()
+        self.assertRaises(errors.PluginError, self.auth.perform, self.achalls[:2])
+
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual([x[0] for x in self._handler_calls()].count('perform'), 4)
+
+    def _test_stream_output(self):
+        self.config.__setattr__(self.name_cfg + 'handler_stream_output', True)
+        self.config.__setattr__(self.name_cfg + 'handler_output_limit', 1024)
+        self._write_handler(self.HANDLER + (
+            "if cmd == 'pre-perform':\n    print('NotImplemented'); sys.exit(1)\n"
+            "if cmd == 'perform':\n"
+            "    for idx in range(5000): print('line %d' % idx)\n"
+            "    sys.stderr.write('err\\n')\n"))
+
+        with mock.patch('certbot_external_auth.plugin.logger') as mock_logger:
+            responses = self.auth.perform(self.achalls[:2])
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls[:2]])
+        logged = [x[0][1:] for x in mock_logger.info.call_args_list if x[0][0].startswith('Handler %s %s')]
+        perform_lines = [x[2] for x in logged if x[:2] == ('perform', 'stdout')]
+        self.assertEqual(perform_lines, ['line %d' % x for x in range(5000)] * 2)
+        self.assertTrue(('perform', 'stderr', 'err') in logged)
+        self.assertTrue(any('does not implement' in x[0][0] for x in mock_logger.warning.call_args_list))
+
+    def test_stream_output(self):
+        self._test_stream_output()
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio core requires Python 3.5+")
+    def test_stream_output_async(self):
+        self.config.__setattr__(self.name_cfg + 'async_core', True)
+        self._test_stream_output()
+
+    def test_stream_output_limit(self):
+        self.config.__setattr__(self.name_cfg + 'handler_stream_output', True)
+        self.config.__setattr__(self.name_cfg + 'handler_output_limit', 64)
+        self._write_handler("#!/bin/sh\nfor i in $(seq 1 1000); do echo line $i; done\n")
+
+        stdout = self.auth._call_handler('perform')
+        self.assertTrue(stdout.startswith(b'[... '))
+        self.assertTrue(stdout.endswith(b'line 1000\n'))
+        self.assertTrue(len(stdout) < 100)
+
+    def _use_module_handler(self, body, name='cbot_test_handler'):
+        from certbot_external_auth.plugin import RUN_STATE
+
+        with open(os.path.join(self.tempdir, name + '.py'), 'w') as fh:
+            fh.write(body.format(log=self.log_file))
+        sys.path.insert(0, self.tempdir)
+        self.addCleanup(sys.path.remove, self.tempdir)
+        self.addCleanup(sys.modules.pop, name, None)
+        self.addCleanup(RUN_STATE.module_handlers.clear)
+        self.config.__setattr__(self.name_cfg + 'handler', None)
+        self.config.__setattr__(self.name_cfg + 'handler_module', name + ':Handler')
+
+    def _prepare(self):
+        from certbot_external_auth.plugin import RunState
+
+        with mock.patch('certbot_external_auth.plugin.RUN_STATE', new=RunState()), \
+                mock.patch('certbot_external_auth.plugin.atexit'), \
+                mock.patch('zope.component.getUtility'), \
+                mock.patch('zope.component.provideUtility'):
+            self.auth.prepare()
+
+    def test_module_handler(self):
+        self._use_module_handler(self.MODULE_HANDLER)
+        self._prepare()
+        responses = self.auth.perform(self.achalls)
+        self.auth.cleanup(self.achalls)
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls])
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform'] + ['perform'] * 5 + ['cleanup'] * 5)
+        self.assertEqual([x[1] for x in calls[1:6]], [x.domain for x in self.achalls])
+        self.assertTrue(all(x[2] for x in calls[1:]))
+
+    def test_module_handler_failure(self):
+        self._use_module_handler(self.MODULE_HANDLER.replace("self._log('perform', record)", "raise ValueError()"))
+        self.assertRaises(errors.PluginError, self.auth.perform, self.achalls)
+
+    def test_module_handler_invalid(self):
+        self.config.__setattr__(self.name_cfg + 'handler', None)
+        self.config.__setattr__(self.name_cfg + 'handler_module', 'cbot_missing_handler:Handler')
+        self.assertRaises(errors.PluginError, self._prepare)
+
+        self.config.__setattr__(self.name_cfg + 'handler', self.handler_file)
+        self.assertRaises(errors.PluginError, self._prepare)
+
+    def test_module_handler_batch(self):
+        self._use_module_handler(self.MODULE_HANDLER + """
+    def perform_batch(self, records):
+        self._log('perform-batch', records[0])
+        return dict((x['token'], 'ok') for x in records[1:])
+""")
+        self.config.__setattr__(self.name_cfg + 'handler_batch', True)
+        self.assertRaises(errors.PluginError, self.auth.perform, self.achalls)
+        self.assertEqual([x[0] for x in self._handler_calls()], ['pre-perform', 'perform-batch'])
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio core requires Python 3.5+")
+    def test_module_handler_async(self):
+        self._use_module_handler(self.MODULE_HANDLER.replace("def perform(", "async def perform("))
+        self.config.__setattr__(self.name_cfg + 'async_core', True)
+        self.config.__setattr__(self.name_cfg + 'max_parallel', 3)
+        responses = self.auth.perform(self.achalls)
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls])
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform'] + ['perform'] * 5)
+        self.assertEqual(sorted(x[1] for x in calls[1:]), sorted(x.domain for x in self.achalls))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio core requires Python 3.5+")
+    def test_module_handler_async_unlocked(self):
+        # Coroutine called from a worker thread does not hold the run state lock
+        self._use_module_handler(self.MODULE_HANDLER.replace("""    def cleanup(self, record):
+""", """    async def cleanup(self, record):
+        import threading
+        from certbot_external_auth.plugin import RUN_STATE
+        acquired = []
+        def probe():
+            acquired.append(RUN_STATE.lock.acquire(timeout=5))
+            if acquired[0]:
+                RUN_STATE.lock.release()
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        assert acquired[0]
+"""))
+        self.config.__setattr__(self.name_cfg + 'max_parallel', 3)
+        self.auth.cleanup(self.achalls)
+
+        calls = self._handler_calls()
+        self.assertEqual(sorted(x[1] for x in calls if x[0] == 'cleanup'), sorted(x.domain for x in self.achalls))
+
+    def test_cleanup(self):
+        self.auth.cleanup(self.achalls)
+
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-cleanup'] + ['cleanup'] * 5 + ['post-cleanup'])
+
+    def _test_cleanup_failures(self):
+        self._write_handler(self.HANDLER + "if cmd == 'cleanup' and os.environ['cbot_domain'] in "
+                                           "('d1.example.org', 'd3.example.org'): sys.exit(1)\n")
+        self.config.__setattr__(self.name_cfg + 'max_parallel', 3)
+        with self.assertRaises(errors.PluginError) as ctx:
+            self.auth.cleanup(self.achalls)
+        self.assertTrue('failed 2 of 5: d1.example.org, d3.example.org' in str(ctx.exception))
+
+        # All records are attempted, post-cleanup still runs
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-cleanup'] + ['cleanup'] * 5 + ['post-cleanup'])
+        self.assertEqual(sorted(x[1] for x in calls[1:-1]), sorted(x.domain for x in self.achalls))
+
+    def test_cleanup_failures(self):
+        self._test_cleanup_failures()
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio core requires Python 3.5+")
+    def test_cleanup_failures_async(self):
+        self.config.__setattr__(self.name_cfg + 'async_core', True)
+        self._test_cleanup_failures()
+
+    def test_cleanup_queue(self):
+        from certbot_external_auth import drain
+        from certbot_external_auth.cleanup_queue import CleanupQueue
+
+        queue_file = os.path.join(self.tempdir, 'cleanup.jsonl')
+        self.config.__setattr__(self.name_cfg + 'cleanup_queue', queue_file)
+        self.auth.cleanup(self.achalls)
+
+        self.assertFalse(os.path.exists(self.log_file))
+        queue = CleanupQueue(queue_file)
+        entries = queue.take()
+        queue.done(entries)
+        self.assertEqual(len(entries), 1)
+        self.assertEqual([x['domain'] for x in entries[0]['records']], [x.domain for x in self.achalls])
+        self.assertEqual(entries[0]['options']['handler'], self.handler_file)
+
+        self.assertEqual(drain.drain(queue_file), 0)
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-cleanup'] + ['cleanup'] * 5 + ['post-cleanup'])
+        self.assertEqual(len(CleanupQueue(queue_file)), 0)
+
+    def test_cleanup_queue_drain_failure(self):
+        from certbot_external_auth import drain
+        from certbot_external_auth.cleanup_queue import CleanupQueue
+
+        queue_file = os.path.join(self.tempdir, 'cleanup.jsonl')
+        self.config.__setattr__(self.name_cfg + 'cleanup_queue', queue_file)
+        self.auth.cleanup(self.achalls)
+        self._write_handler(self.HANDLER + "if cmd == 'cleanup' and os.environ['cbot_domain'] == 'd1.example.org': "
+                                           "sys.exit(1)\n")
+
+        self.assertEqual(drain.drain(queue_file, retries=1, backoff=0), 1)
+        calls = [x for x in self._handler_calls() if x[0] == 'cleanup']
+        self.assertEqual(len(calls), 6)
+        self.assertEqual(calls[-1][1], 'd1.example.org')
+
+        entries = CleanupQueue(queue_file).take()
+        self.assertEqual([x['domain'] for x in entries[0]['records']], ['d1.example.org'])
+        self.assertEqual(entries[0]['attempts'], 1)
+
+    def test_drain_plugin_older_entry(self):
+        from certbot_external_auth import drain
+        entry = self.auth._get_run_context()
+        # Queued by an older plugin version without these options
+        del entry['options']['dns-self-verify']
+        del entry['options']['journal-file']
+
+        plugin = drain.get_plugin(entry)
+        self.assertEqual(plugin.conf('handler'), self.handler_file)
+        self.assertFalse(plugin.conf('dns-self-verify'))
+        self.assertEqual(plugin.conf('journal-file'), None)
+
+    def test_journal_recovery(self):
+        from certbot_external_auth.plugin import RUN_STATE
+        from certbot_external_auth.journal import Journal
+
+        journal_file = os.path.join(self.tempdir, 'journal.jsonl')
+        self.config.__setattr__(self.name_cfg + 'journal', True)
+        self.config.__setattr__(self.name_cfg + 'journal_file', journal_file)
+        self.addCleanup(setattr, RUN_STATE, 'journals', RUN_STATE.journals)
+        RUN_STATE.journals = {}
+
+        # Cleaned up records are not recovered
+        self.auth.perform(self.achalls[:2])
+        self.auth.cleanup(self.achalls[:2])
+        # The run crashes before the cleanup
+        self.auth.perform(self.achalls[2:])
+        os.remove(self.log_file)
+
+        self.auth.recovery_routine()
+        self.assertFalse(os.path.exists(self.log_file))
+
+        # Next run, the crashed one is not running
+        with mock.patch('certbot_external_auth.journal.RUN_ID', 'next-run'), \
+                mock.patch('certbot_external_auth.journal.is_running', return_value=False):
+            self.auth.recovery_routine()
+            calls = self._handler_calls()
+            self.assertEqual([x[0] for x in calls], ['pre-cleanup'] + ['cleanup'] * 3 + ['post-cleanup'])
+            self.assertEqual([x[1] for x in calls[1:-1]], [x.domain for x in self.achalls[2:]])
+            self.assertEqual(Journal(journal_file).stale(), [])
+
+    def test_journal_recovery_handler_cache(self):
+        from certbot_external_auth.plugin import RUN_STATE
+        self.addCleanup(setattr, RUN_STATE, 'journals', RUN_STATE.journals)
+        self.addCleanup(setattr, RUN_STATE, 'handler_caches', RUN_STATE.handler_caches)
+        RUN_STATE.journals = {}
+        RUN_STATE.handler_caches = {}
+        self.config.__setattr__(self.name_cfg + 'journal', True)
+        self.config.__setattr__(self.name_cfg + 'journal_file', os.path.join(self.tempdir, 'journal.jsonl'))
+        self.config.__setattr__(self.name_cfg + 'handler_cache', True)
+        self.config.__setattr__(self.name_cfg + 'handler_cache_file', os.path.join(self.tempdir, 'cache.json'))
+
+        # The run crashes before the cleanup, the next run recovers and deploys the challenge again
+        self.auth.perform(self.achalls[:1])
+        with mock.patch('certbot_external_auth.journal.RUN_ID', 'next-run'), \
+                mock.patch('certbot_external_auth.journal.is_running', return_value=False):
+            self.auth.recovery_routine()
+        self.auth.perform(self.achalls[:1])
+
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform', 'perform', 'post-perform',
+                                                 'pre-cleanup', 'cleanup', 'post-cleanup',
+                                                 'pre-perform', 'perform', 'post-perform'])
+
+    def test_perform_cleanup_grouped(self):
+        self.config.__setattr__(self.name_cfg + 'group_challenges', True)
+        wildcard = auth_handler.challb_to_achall(
+            acme_util.chall_to_challb(challenges.DNS01(token=(b'%032d' % 99)), messages.STATUS_PENDING),
+            acme_util.JWK, self.achalls[1].domain)
+        achalls = self.achalls + [wildcard]
+
+        responses = self.auth.perform(achalls)
+        self.auth.cleanup(achalls)
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in achalls])
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform'] + ['perform'] * 5 + ['post-perform'] +
+                         ['pre-cleanup'] + ['cleanup'] * 5 + ['post-cleanup'])
+        for call in (calls[2], calls[9]):
+            self.assertEqual(call[1], wildcard.domain)
+            self.assertEqual(call[2].split(' '), [self.achalls[1].validation(self.achalls[1].account_key),
+                                                  wildcard.validation(wildcard.account_key)])
+
+    def test_cleanup_failures_grouped(self):
+        self.config.__setattr__(self.name_cfg + 'group_challenges', True)
+        self._write_handler(self.HANDLER + "if cmd == 'cleanup' and os.environ['cbot_domain'] == 'd1.example.org':"
+                                           " sys.exit(1)\n")
+        wildcard = auth_handler.challb_to_achall(
+            acme_util.chall_to_challb(challenges.DNS01(token=(b'%032d' % 99)), messages.STATUS_PENDING),
+            acme_util.JWK, self.achalls[1].domain)
+
+        # Counted in records, the grouped domain is one of them
+        with self.assertRaises(errors.PluginError) as ctx:
+            self.auth.cleanup(self.achalls + [wildcard])
+        self.assertTrue('failed 1 of 5: d1.example.org' in str(ctx.exception))
+
+    def test_zone_map(self):
+        from certbot_external_auth.plugin import RUN_STATE
+        self.addCleanup(setattr, RUN_STATE, 'zone_finders', RUN_STATE.zone_finders)
+        RUN_STATE.zone_finders = {}
+
+        zone_map = os.path.join(self.tempdir, 'zones')
+        with open(zone_map, 'w') as fh:
+            fh.write('example.org\nd3.example.org  # delegated\n')
+        self.config.__setattr__(self.name_cfg + 'dns_zone_map', zone_map)
+
+        responses = self.auth.perform(self.achalls)
+        self.auth.cleanup(self.achalls)
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls])
+        domains = ['d3.example.org'] + [x.domain for x in self.achalls if x.domain != 'd3.example.org']
+        calls = self._handler_calls()
+        self.assertEqual([x[1] for x in calls[1:6]], domains)
+        self.assertEqual([x[1] for x in calls[8:13]], domains)
+
+        _, records = self.auth._get_perform_records(self.achalls)
+        self.assertEqual([x[FIELD_ZONE] for x in records], ['d3.example.org'] + ['example.org'] * 4)
+        self.assertEqual(self.auth._get_cleanup_records(self.achalls)[0][FIELD_ZONE], 'd3.example.org')
+
+    def test_zone_map_missing(self):
+        self.config.__setattr__(self.name_cfg + 'dns_zone_map', os.path.join(self.tempdir, 'missing'))
+        self.assertRaises(errors.PluginError, self.auth.perform, self.achalls)
+
+    def test_group_http01(self):
+        self.config.__setattr__(self.name_cfg + 'group_challenges', True)
+        achalls = [auth_handler.challb_to_achall(
+            acme_util.chall_to_challb(challenges.HTTP01(token=(b'%032d' % idx)), messages.STATUS_PENDING),
+            acme_util.JWK, 'example.org') for idx in range(2)]
+        self.assertEqual(list(self.auth._group_achalls(achalls).values()), [[x] for x in achalls])
+
+    def test_verify_deadline(self):
+        self.config.__setattr__(self.name_cfg + 'verify_timeout', 1)
+        verified = threading.Event()
+
+        def verify(achall, response):  # pylint: disable=unused-argument
+            if achall.domain == self.achalls[2].domain:
+                verified.wait(5)
+            return achall.domain != self.achalls[0].domain
+
+        self.auth._verify_dns01_challenge = mock.Mock(side_effect=verify)
+        responses = [x.response(x.account_key) for x in self.achalls]
+        statuses = self.auth._verify_challenges(self.achalls, responses)
+        verified.set()
+
+        self.assertEqual(statuses, ['invalid', 'valid', 'timeout', 'valid', 'valid'])
+
+    @unittest.skipUnless(dnsutil.is_available(), "dnspython is not installed")
+    def test_perform_propagation_wait(self):
+        server = StubDnsServer()
+        self.addCleanup(server.close)
+        for achall in self.achalls:
+            server.add(achall.validation_domain_name(achall.domain), 'TXT',
+                       '"%s"' % achall.validation(achall.account_key))
+
+        self.config.__setattr__(self.name_cfg + 'dns_propagation_wait', True)
+        self.config.__setattr__(self.name_cfg + 'dns_resolvers', '127.0.0.1:%s' % server.port)
+        visible = self.auth._wait_for_propagation(self.achalls)
+
+        self.assertEqual(list(visible.values()), [True] * 5)
+        self.assertEqual(sorted(x[0] for x in server.queries),
+                         sorted(x.validation_domain_name(x.domain) + '.' for x in self.achalls))
+
+    @unittest.skipUnless(dnsutil.is_available(), "dnspython is not installed")
+    def test_dns_self_verify(self):
+        from certbot_external_auth.plugin import RUN_STATE
+        self.addCleanup(setattr, RUN_STATE, 'dns_caches', RUN_STATE.dns_caches)
+        RUN_STATE.dns_caches = {}
+
+        server = StubDnsServer()
+        self.addCleanup(server.close)
+        server.add('example.org', 'SOA', 'ns1.example.org. hostmaster.example.org. 1 7200 3600 1209600 300')
+        for achall in self.achalls[1:]:
+            server.add(achall.validation_domain_name(achall.domain), 'TXT',
+                       '"%s"' % achall.validation(achall.account_key))
+
+        self.config.__setattr__(self.name_cfg + 'dns_self_verify', True)
+        self.config.__setattr__(self.name_cfg + 'dns_resolvers', '127.0.0.1:%s' % server.port)
+        responses = [x.response(x.account_key) for x in self.achalls]
+        statuses = self.auth._verify_challenges(self.achalls, responses)
+
+        self.assertEqual(statuses, ['invalid'] + ['valid'] * 4)
+        self.assertEqual(len(RUN_STATE.dns_caches), 1)
+
+    def test_perform_cleanup_http_responder(self):
+        from certbot_external_auth.plugin import RUN_STATE
+        self.config.__setattr__(self.name_cfg + 'http_responder', True)
+        self.config.http01_port = 0
+        http_achalls = [
+            auth_handler.challb_to_achall(
+                acme_util.chall_to_challb(challenges.HTTP01(token=(b'%032d' % idx)), messages.STATUS_PENDING),
+                acme_util.JWK, 'h%d.example.org' % idx)
+            for idx in range(2)]
+        achalls = [http_achalls[0]] + self.achalls + [http_achalls[1]]
+
+        responses = self.auth.perform(achalls)
+        self.assertEqual(responses, [x.response(x.account_key) for x in achalls])
+
+        port = RUN_STATE.http_responder.port
+        for achall in http_achalls:
+            url = 'http://127.0.0.1:%s%s' % (port, achall.chall.path)
+            body = six.moves.urllib.request.urlopen(url).read()
+            self.assertEqual(body.decode('UTF-8'), achall.validation(achall.account_key))
+
+        self.auth.cleanup(achalls)
+        self.assertTrue(RUN_STATE.http_responder is None)
+        calls = self._handler_calls()
+        self.assertEqual([x[1] for x in calls if x[0] in ('perform', 'cleanup')],
+                         [x.domain for x in self.achalls] * 2)
+
+    def test_perform_cleanup_daemon(self):
+        self.config.__setattr__(self.name_cfg + 'handler_daemon', True)
+        self._write_handler(self.DAEMON_HANDLER)
+        try:
+            responses = self.auth.perform(self.achalls)
+            self.auth.cleanup(self.achalls)
+        finally:
+            self.auth._close_handler_daemon()
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls])
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform'] + ['perform'] * 5 + ['post-perform'] +
+                         ['pre-cleanup'] + ['cleanup'] * 5 + ['post-cleanup'])
+        self.assertEqual(len(set(x[2] for x in calls)), 1)
+
+    def test_daemon_crash(self):
+        self.config.__setattr__(self.name_cfg + 'handler_daemon', True)
+        self._write_handler(self.DAEMON_HANDLER.replace("print(json.dumps(", "sys.exit(2)\n    print(json.dumps("))
+        try:
+            self.assertRaises(errors.PluginError, self.auth.perform, self.achalls)
+        finally:
+            self.auth._close_handler_daemon()
+
+    def test_daemon_eof_before_request(self):
+        from certbot_external_auth.daemon import HandlerDaemon, HandlerDaemonError
+        # Closes the stdout, keeps reading the stdin
+        self._write_handler("#!{python}\nimport os, sys\nos.close(1)\nsys.stdin.read()\n")
+        handler_daemon = HandlerDaemon(self.handler_file, timeout=10)
+        handler_daemon.start()
+        self.addCleanup(handler_daemon.close)
+        handler_daemon._readers[0].join(5)
+
+        # EOF between the is_alive() check and the request registration
+        start = time.time()
+        with mock.patch.object(HandlerDaemon, 'is_alive', return_value=True):
+            self.assertRaises(HandlerDaemonError, handler_daemon.request, 'perform')
+        self.assertTrue(time.time() - start < 5)
+
+    def test_perform_cleanup_batch(self):
+        self.config.__setattr__(self.name_cfg + 'handler_batch', True)
+        responses = self.auth.perform(self.achalls)
+        self.auth.cleanup(self.achalls)
+
+        self.assertEqual(responses, [x.response(x.account_key) for x in self.achalls])
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform', 'perform-batch', 'post-perform',
+                                                 'pre-cleanup', 'cleanup-batch', 'post-cleanup'])
+
+    def test_perform_batch_failed_record(self):
+        self.config.__setattr__(self.name_cfg + 'handler_batch', True)
+        self._write_handler(self.HANDLER.replace("'status': 'ok'", "'status': 'error'"))
+        self.assertRaises(errors.PluginError, self.auth.perform, self.achalls)
+
+    def test_perform_batch_not_implemented(self):
+        self.config.__setattr__(self.name_cfg + 'handler_batch', True)
+        self._write_handler(self.HANDLER.replace(
+            "if cmd.endswith('-batch'):", "if cmd.endswith('-batch'):\n    print('NotImplemented'); sys.exit(1)"))
+        self.auth.perform(self.achalls)
+
+        calls = self._handler_calls()
+        self.assertEqual([x[0] for x in calls], ['pre-perform', 'perform-batch'] + ['perform'] * 5 + ['post-perform'])
+
+
 class PollChallengesTest(unittest.TestCase):
     # pylint: disable=protected-access
     """Test poll challenges."""
@@ -0,0 +1,53 @@
+"""Tests for certbot_external_auth.profiler."""
+import threading
+import unittest
+
+from certbot_external_auth import profiler
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = profiler.Profiler()
+
+    def test_record(self):
+        self.assertTrue(self.profiler.is_empty())
+        self.profiler.record('handler-run', 0.5, 'a.example.com')
+        self.profiler.record('handler-run', 1.5, 'b.example.com')
+        self.profiler.record('handler-run', 1.0, 'a.example.com')
+        self.profiler.record('perform', 3.0)
+
+        data = self.profiler.to_json()
+        self.assertEqual(list(data['stages'].keys()), ['handler-run', 'perform'])
+        self.assertEqual(data['stages']['handler-run'], {'count': 3, 'total': 3.0, 'min': 0.5, 'max': 1.5})
+        self.assertEqual(data['domains']['a.example.com']['handler-run']['count'], 2)
+        self.assertEqual(data['domains']['a.example.com']['handler-run']['total'], 1.5)
+        self.assertEqual(list(data['domains'].keys()), ['a.example.com', 'b.example.com'])
+        self.assertTrue(data['wall'] >= 0)
+
+    def test_measure(self):
+        with self.assertRaises(ValueError):
+            with self.profiler.measure('verify', 'a.example.com'):
+                raise ValueError()
+
+        stats = self.profiler.to_json()['domains']['a.example.com']['verify']
+        self.assertEqual(stats['count'], 1)
+        self.assertTrue(stats['total'] >= 0)
+
+    def test_threads(self):
+        def worker():
+            for _ in range(100):
+                self.profiler.record('verify', 0.25, 'a.example.com')
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.profiler.to_json()['stages']['verify']['count'], 800)
+        self.assertEqual(self.profiler.to_json()['stages']['verify']['total'], 200.0)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,48 @@
+"""Tests for certbot_external_auth.responder."""
+import unittest
+
+from six.moves.urllib import error as urllib_error  # pylint: disable=import-error
+from six.moves.urllib import request as urllib_request  # pylint: disable=import-error
+
+from certbot_external_auth.responder import HTTP01Responder
+
+
+class HTTP01ResponderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.responder = HTTP01Responder(0, '127.0.0.1')
+        self.responder.start()
+
+    def tearDown(self):
+        self.responder.stop()
+
+    def _get(self, path):
+        return urllib_request.urlopen('http://127.0.0.1:%s%s' % (self.responder.port, path), timeout=5).read()
+
+    def test_serve(self):
+        self.assertNotEqual(self.responder.port, 0)
+        self.responder.add('/.well-known/acme-challenge/a', 'val-a')
+        self.responder.add('/.well-known/acme-challenge/b', b'val-b')
+
+        self.assertEqual(self._get('/.well-known/acme-challenge/a'), b'val-a')
+        self.assertEqual(self._get('/.well-known/acme-challenge/b?x=1'), b'val-b')
+        self.assertEqual(len(self.responder), 2)
+
+    def test_remove(self):
+        self.responder.add('/.well-known/acme-challenge/a', 'val-a')
+        self.responder.remove('/.well-known/acme-challenge/a')
+        self.responder.remove('/.well-known/acme-challenge/unknown')
+
+        with self.assertRaises(urllib_error.HTTPError) as ctx:
+            self._get('/.well-known/acme-challenge/a')
+        self.assertEqual(ctx.exception.code, 404)
+        self.assertEqual(len(self.responder), 0)
+
+    def test_stop(self):
+        self.responder.stop()
+        self.assertFalse(self.responder.is_running())
+        self.responder.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
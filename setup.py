@@ -9,6 +9,16 @@ install_requires = [
     'certbot>=0.15',
 ]
 
+# DNS propagation checks
+dns_extras = [
+    'dnspython>=1.12',
+]
+
+# Faster JSON serialization of the records
+fast_json_extras = [
+    'orjson; python_version >= "3.6"',
+]
+
 setup(
     name='certbot-ext-auth',
     version=version,
@@ -41,10 +51,17 @@ setup(
     ],
 
     install_requires=install_requires,
+    extras_require={
+        'dns': dns_extras,
+        'fast-json': fast_json_extras,
+    },
     packages=find_packages(),
     entry_points={
         'certbot.plugins': [
             'out = certbot_external_auth.plugin:AuthenticatorOut',
         ],
+        'console_scripts': [
+            'certbot-ext-auth-drain = certbot_external_auth.drain:main',
+        ],
     },
 )